@@ -28,6 +28,11 @@ setup(
     author_email='dev-support@cloudsigma.com',
     url='https://github.com/cloudsigma/pycloudsigma',
     install_requires=required,
+    extras_require={
+        'async': ['aiohttp>=3.6; python_full_version >= "3.5.3"'],
+        'zstd': ['zstandard>=0.13'],
+        'columnar': ['numpy>=1.16', 'pyarrow>=0.15'],
+    },
     description="CloudSigma's official python library.",
     keywords=[
         'cloud',
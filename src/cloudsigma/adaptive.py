@@ -0,0 +1,160 @@
+from __future__ import division
+import logging
+import threading
+import time
+from builtins import object
+
+
+LOG = logging.getLogger(__name__)
+
+MIN_CHUNK_SIZE = 1024 ** 2
+MAX_CHUNK_SIZE = 64 * 1024 ** 2
+
+# Assumed link speed in bytes per second used for the initial chunk size,
+# before any throughput has been measured.
+ASSUMED_BANDWIDTH = 100 * 1000 ** 2 // 8
+
+
+def initial_chunk_size(
+        file_size,
+        rtt,
+        n_threads=4,
+        bandwidth=ASSUMED_BANDWIDTH,
+        min_chunk_size=MIN_CHUNK_SIZE,
+        max_chunk_size=MAX_CHUNK_SIZE
+):
+    """
+    Picks a chunk size for a file of *file_size* bytes.
+
+    Every chunk costs at least one round trip on top of its transfer time, so
+    the chunk should take several RTTs to send at the expected bandwidth.
+    On the other hand there should be enough chunks to keep all threads busy
+    and to make retries cheap.
+
+    :param file_size:
+        Size of the uploaded file in bytes.
+    :param rtt:
+        Observed round trip time to the API in seconds.
+    :param n_threads:
+        Number of threads that will send chunks in parallel.
+    :param bandwidth:
+        Expected bandwidth in bytes per second.
+    :return:
+        Chunk size in bytes, a multiple of 1MiB.
+    """
+    # one RTT of overhead per eight RTTs of transfer
+    size = int(bandwidth * rtt * 8)
+    # at least four chunks per thread
+    size = min(size, file_size // (4 * n_threads))
+    size = max(min_chunk_size, min(size, max_chunk_size))
+    return size - size % MIN_CHUNK_SIZE or MIN_CHUNK_SIZE
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limits the number of chunks in flight and tunes the limit by hill
+    climbing on the measured throughput.
+
+    Workers call :meth:`acquire` before sending a chunk and :meth:`release`
+    afterwards. After every window of completed chunks the throughput of the
+    window is compared to the previous one. The limit keeps moving in the
+    same direction while throughput improves and turns around when it does
+    not. An error rate above *error_threshold* or latency growing without a
+    throughput gain halves the limit.
+    """
+
+    def __init__(
+            self,
+            initial=2,
+            minimum=1,
+            maximum=16,
+            error_threshold=0.05,
+            min_gain=0.05
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.error_threshold = error_threshold
+        self.min_gain = min_gain
+
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._direction = 1
+        self._last_throughput = None
+        self._base_latency = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._window_chunks = 0
+        self._window_errors = 0
+        self._window_latency = 0.0
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, n_bytes, elapsed, ok=True):
+        """
+        :param n_bytes:
+            Size of the finished chunk.
+        :param elapsed:
+            Seconds it took to send the chunk.
+        :param ok:
+            False if sending the chunk failed.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self._window_chunks += 1
+            self._window_latency += elapsed
+            if ok:
+                self._window_bytes += n_bytes
+            else:
+                self._window_errors += 1
+            if self._window_chunks >= max(4, 2 * self.limit):
+                self._adjust()
+            self._cond.notify_all()
+
+    def _adjust(self):
+        duration = max(time.time() - self._window_start, 1e-6)
+        throughput = self._window_bytes / duration
+        latency = self._window_latency / self._window_chunks
+        error_rate = self._window_errors / self._window_chunks
+        old_limit = self.limit
+        if self._base_latency is None or latency < self._base_latency:
+            self._base_latency = latency
+
+        improved = self._last_throughput is not None and \
+            throughput > self._last_throughput * (1 + self.min_gain)
+
+        if error_rate > self.error_threshold:
+            self.limit = self.limit // 2
+            self._direction = 1
+            throughput = None
+        elif self._last_throughput is None:
+            self.limit += 1
+        elif not improved and latency > 2 * self._base_latency:
+            self.limit = self.limit // 2
+            self._direction = 1
+        elif improved:
+            self.limit += self._direction
+        else:
+            self._direction = -self._direction
+            self.limit += self._direction
+
+        self.limit = max(self.minimum, min(self.limit, self.maximum))
+        self._last_throughput = throughput
+        LOG.debug(
+            'Concurrency {} -> {}: {:0.1f} MB/s, latency {:0.2f}s, '
+            'errors {:.0%}'.format(
+                old_limit,
+                self.limit,
+                (throughput or 0) / 1024.0 ** 2,
+                latency,
+                error_rate
+            )
+        )
+        self._reset_window()
@@ -0,0 +1,343 @@
+"""
+An asyncio based upload path.
+
+Instead of a thread per chunk, all chunk requests of an upload are
+coroutines on one event loop sharing one aiohttp connection pool, so many
+chunks can be in flight without a thread each. File reads are done in a
+small thread pool so they do not block the loop.
+
+Requires Python 3.5 or newer and the optional aiohttp dependency, which is
+installed with the ``async`` extra::
+
+    pip install cloudsigma[async]
+"""
+import asyncio
+import concurrent.futures
+import time
+from logging import getLogger
+
+from .scheduler import FatalError, TaskResult, is_fatal
+from .transport import USER_AGENT
+from .upload_engine import ChunkLinkProtocol, ResumableJsProtocol, UploadEngine
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+LOG = getLogger(__name__)
+
+DEFAULT_MAX_IN_FLIGHT = 32
+
+
+class BufferedResponse(object):
+    """
+    A fully read aiohttp response with the interface of a requests response
+    which :meth:`cloudsigma.generic.GenericClient._process_response` uses.
+    """
+
+    def __init__(self, status_code, headers, content, json_codec):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.json_codec = json_codec
+
+    @classmethod
+    async def read(cls, response, json_codec):
+        return cls(
+            response.status,
+            response.headers,
+            await response.read(),
+            json_codec
+        )
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return self.json_codec.loads(self.content)
+
+
+class AsyncUploadEngine(UploadEngine):
+    """
+    Uploads a drive image like :class:`cloudsigma.upload_engine.UploadEngine`
+    but with the chunk requests running as coroutines on an event loop.
+
+    At most *max_in_flight* chunks are read and being sent at a time, which
+    bounds the memory used for chunk data to max_in_flight * chunk_size. A
+    chunk is read from the file only once a slot in this window is free,
+    and like in the threaded engine only after the probe or the upload link
+    request, so chunks already on the server are neither read nor counted
+    against the *throttle*.
+
+    Chunks are retried according to the *retry_policy*, keeping their slot
+    and their data while they back off. The adaptive concurrency of the
+    threaded engine is not used, the window has a fixed size.
+    """
+
+    def __init__(
+            self,
+            source,
+            protocol=None,
+            max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+            read_threads=2,
+            **kwargs
+    ):
+        """
+        :param source:
+            The image to upload, e.g. a
+            :class:`cloudsigma.upload_engine.FileSource`.
+        :param protocol:
+            A protocol instance or name, 'resumable' (default) or
+            'chunk_link'.
+        :param max_in_flight:
+            Maximum number of chunks being read or sent at a time, and the
+            size of the connection pool. Default is 32.
+        :param read_threads:
+            Number of threads reading chunks from the source. Default is 2.
+        :param kwargs:
+            Remaining arguments of
+            :class:`cloudsigma.upload_engine.UploadEngine`.
+        """
+        if aiohttp is None:
+            raise ImportError(
+                'The asyncio upload needs aiohttp, install cloudsigma[async]'
+            )
+        super(AsyncUploadEngine, self).__init__(
+            source,
+            protocol=protocol,
+            **kwargs
+        )
+        self.max_in_flight = max_in_flight
+        self.read_threads = read_threads
+        self._cancelled = False
+        self._loop = None
+
+    @property
+    def chunks_in_flight(self):
+        return self.max_in_flight
+
+    def upload(self):
+        """
+        Runs the upload on a new event loop and blocks until it is done.
+        Use :meth:`upload_async` from a running event loop instead.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.upload_async())
+        finally:
+            loop.close()
+
+    async def upload_async(self):
+        self._loop = asyncio.get_event_loop()
+        # creating the drive is a handful of blocking API calls
+        await self._loop.run_in_executor(None, self.prepare)
+        self._cancelled = False
+        result = TaskResult()
+
+        executor = concurrent.futures.ThreadPoolExecutor(self.read_threads)
+        try:
+            async with self._make_session() as session:
+                await self._run(session, executor, result)
+        finally:
+            executor.shutdown(wait=False)
+        return self.finish(result)
+
+    def cancel(self):
+        """
+        Stops starting new chunks. Chunks being sent are finished and
+        recorded in the journal, so the upload can be resumed. Can be called
+        from any thread.
+        """
+        self._cancelled = True
+
+    def _make_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        kwargs = {'headers': {'user-agent': USER_AGENT}}
+        if self.c.login_method == self.c.LOGIN_METHOD_BASIC:
+            kwargs['auth'] = aiohttp.BasicAuth(
+                self.c.username,
+                self.c.password
+            )
+        elif self.c.login_method == self.c.LOGIN_METHOD_SESSION:
+            kwargs['cookies'] = self.c._session.cookies.get_dict()
+            for header in ('X-CSRFToken', 'Referer'):
+                if header in self.c._session.headers:
+                    kwargs['headers'][header] = self.c._session.headers[header]
+        return aiohttp.ClientSession(connector=connector, **kwargs)
+
+    async def _run(self, session, executor, result):
+        window = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+
+        def chunk_finished(task):
+            tasks.discard(task)
+            window.release()
+
+        for chunk in self.pending_chunks():
+            await window.acquire()
+            if self._cancelled:
+                window.release()
+                break
+            task = asyncio.ensure_future(
+                self._upload_enqueued(session, executor, chunk, result)
+            )
+            tasks.add(task)
+            task.add_done_callback(chunk_finished)
+
+        if tasks:
+            await asyncio.wait(tasks)
+        if self._cancelled:
+            result.cancelled = True
+
+    async def _upload_enqueued(self, session, executor, chunk, result):
+        chunk_number, chunk_offset, real_chunk_size = chunk
+        # read on first use and kept for the retries
+        data = []
+
+        async def read():
+            if not data:
+                data.append(await self._loop.run_in_executor(
+                    executor,
+                    self.read_chunk,
+                    chunk_offset,
+                    real_chunk_size
+                ))
+            return data[0]
+
+        attempt = 0
+        while True:
+            self.progress.chunk_started()
+            started = time.time()
+            try:
+                sent = await self._upload_chunk(session, chunk_number, read)
+            except Exception as exc:
+                fatal = self.is_fatal(exc)
+                give_up = fatal or self._cancelled or \
+                    attempt >= self.retry_policy.max_retries
+                self.chunk_failed(chunk, exc, not give_up)
+                if give_up:
+                    LOG.error(
+                        'Giving up on {!r} after {} attempt(s): {!r}'.format(
+                            chunk,
+                            attempt + 1,
+                            exc
+                        )
+                    )
+                    result.failed[chunk] = exc
+                    if fatal:
+                        self._cancelled = True
+                    return
+
+                attempt += 1
+                delay = self.retry_policy.delay(attempt)
+                LOG.warning(
+                    'Error for {!r}, retrying in {:0.1f}s: {!r}'.format(
+                        chunk,
+                        delay,
+                        exc
+                    )
+                )
+                result.retries += 1
+                await asyncio.sleep(delay)
+                continue
+
+            self.chunk_done(chunk, sent, time.time() - started)
+            result.succeeded.append(chunk)
+            return
+
+    def is_fatal(self, exc):
+        if isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError)):
+            return False
+        return is_fatal(exc)
+
+    async def _upload_chunk(self, session, chunk_number, read):
+        """
+        Uploads one chunk with the protocol.
+
+        :param read: coroutine function returning the chunk data, called
+            only if the chunk has to be sent
+        :return: False if the chunk was already on the server
+        """
+        if self.protocol.name == ResumableJsProtocol.name:
+            return await self._upload_resumable_chunk(
+                session,
+                chunk_number,
+                read
+            )
+        if self.protocol.name == ChunkLinkProtocol.name:
+            return await self._upload_linked_chunk(session, chunk_number, read)
+        raise ValueError(
+            'No asyncio implementation of the {} protocol'.format(
+                self.protocol.name
+            )
+        )
+
+    async def _check(self, response):
+        response = await BufferedResponse.read(response, self.c.json)
+        return self.transport.check(response)
+
+    async def _upload_resumable_chunk(self, session, chunk_number, read):
+        upload_url = self.transport.url(
+            '/drives/{}/upload/'.format(self.drive_uuid)
+        )
+        resumable_js_data = {
+            'resumableChunkNumber': str(chunk_number),
+            'resumableChunkSize': str(self.chunk_size),
+            'resumableTotalSize': str(self.file_size),
+            'resumableIdentifier': self.source.name,
+            'resumableFilename': self.source.name,
+        }
+
+        if self.probe_chunks:
+            async with session.get(
+                    upload_url, params=resumable_js_data) as res:
+                await res.read()
+                if 199 < res.status < 300:
+                    return False
+
+        data = await read()
+        form = aiohttp.FormData()
+        for name, value in resumable_js_data.items():
+            form.add_field(name, value)
+        form.add_field('file', data, filename='file')
+        async with session.post(upload_url, data=form) as res:
+            await self._check(res)
+        return True
+
+    async def _upload_linked_chunk(self, session, chunk_number, read):
+        action_url = self.transport.url(
+            '/drives/{}/action/'.format(self.drive_uuid)
+        )
+        async with session.post(
+                action_url,
+                params={'do': 'upload_chunk'},
+                data=self.c.json.dumps({
+                    'chunk_number': chunk_number,
+                    'chunk_size': self.chunk_size
+                }),
+                headers={'content-type': 'application/json'}) as res:
+            if res.status == 416:
+                await res.read()
+                return False
+            link = (await self._check(res)).json()['link']
+
+        data = await read()
+        async with session.post(
+                self.transport.join(link),
+                data=data,
+                headers=self.upload_headers) as res:
+            if res.status == 415 and self.codec:
+                await res.read()
+                raise FatalError(
+                    'The server does not accept chunks with the {} content '
+                    'encoding, upload without content_encoding'.format(
+                        self.codec.name
+                    )
+                )
+            # timeouts, conflicts and throttling are retried with a fresh
+            # link, other 4xx responses cannot succeed and fail the upload
+            await self._check(res)
+        return True
@@ -0,0 +1,218 @@
+"""
+Batch clones with placement avoidance between the clones.
+
+The clone actions of drives, servers, snapshots and remote snapshots take an
+*avoid* list of uuids whose storage hosts the clone should not be put on. To
+spread the replicas of a cluster, every replica has to avoid the ones made
+before it, so its clone request needs their uuids. A :class:`CloneBatch`
+runs the clones as a :class:`cloudsigma.scheduler.TaskGraph`: a clone is
+requested as soon as the clones it avoids were requested, which is when
+their uuids exist, not when they finished copying. Clones which do not
+avoid each other, like the replicas of different clusters, are requested
+concurrently. The batch then waits for all clones to finish at once.
+
+Usage::
+
+    batch = CloneBatch()
+    for name, source in [('db', db_drive), ('cache', cache_drive)]:
+        batch.replicas(name, 'drives', source, 3)
+    batch.add('web', 'drives', web_drive, avoid=['db-0'])
+    batch.run().raise_for_failures()
+    print(batch.clones['db-2']['uuid'])
+"""
+from builtins import object, range
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+from . import resource
+from .fleet import StatusWatcher
+from .scheduler import (
+    FatalError,
+    RETRYABLE_CLIENT_STATUSES,
+    RetryPolicy,
+    TaskGraph,
+)
+from .transport import Transport
+
+LOG = getLogger(__name__)
+
+# the resource of the clones of each source resource, and their status when
+# the clone finished
+CLONES = {
+    'drives': ('drives', 'unmounted'),
+    'servers': ('servers', 'stopped'),
+    'snapshots': ('drives', 'unmounted'),
+    'remotesnapshots': ('drives', 'unmounted'),
+}
+
+
+def is_fatal(exc):
+    """
+    Only the clones the API refused, because of conflicts or throttling,
+    are retried. Other failures may have made the clone, and retrying them
+    could clone twice.
+    """
+    return getattr(exc, 'status_code', None) not in RETRYABLE_CLIENT_STATUSES
+
+
+class CloneBatch(object):
+    """
+    Clones many drives, servers or snapshots, with the clones avoiding
+    each other.
+
+    :ivar clones: dict of the clone definitions by key, once requested
+    """
+
+    def __init__(self, n_threads=8, timeout=3600, retry_policy=None,
+                 watcher=None, ws_endpoint=None, **kwargs):
+        """
+        :param n_threads:
+            Number of clone requests sent at once.
+        :param timeout:
+            Seconds the clones may take to finish after the last request.
+        :param retry_policy:
+            A :class:`cloudsigma.scheduler.RetryPolicy` for the refused
+            requests.
+        :param watcher:
+            A started :class:`cloudsigma.fleet.StatusWatcher` of drives and
+            servers to share. By default every run starts its own.
+        :param ws_endpoint:
+            The websocket of the api_endpoint, for the watcher.
+        :param kwargs:
+            The client arguments, like api_endpoint.
+        """
+        self.n_threads = n_threads
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=5)
+        self.watcher = watcher
+        self.ws_endpoint = ws_endpoint
+        self.client_kwargs = kwargs
+        self.requests = OrderedDict()
+        self.clones = {}
+        self._client = resource.Drive(**kwargs)
+        self._transport = None
+
+    def add(self, key, resource_name, uuid, data=None, avoid=()):
+        """
+        Adds a clone.
+
+        :param key: the name of the clone in the batch
+        :param resource_name: the resource of the source, e.g. 'drives'
+        :param uuid: the source
+        :param data: the clone options, like the name
+        :param avoid: uuids to avoid, and keys of clones of the batch,
+            which stand for the uuids of those clones
+        :return: the key
+        """
+        if resource_name not in CLONES:
+            raise ValueError('Cannot clone {}'.format(resource_name))
+        if key in self.requests:
+            raise ValueError('Duplicate clone {!r}'.format(key))
+        self.requests[key] = (resource_name, uuid, data or {}, list(avoid))
+        return key
+
+    def replicas(self, prefix, resource_name, uuid, count, data=None,
+                 avoid=()):
+        """
+        Adds *count* clones of a source which all avoid each other, keyed
+        and named '<prefix>-<index>'.
+
+        :param avoid: what all the replicas avoid besides each other
+        :return: list of the keys
+        """
+        keys = []
+        for index in range(count):
+            key = '{}-{}'.format(prefix, index)
+            replica_data = dict(data or {})
+            replica_data.setdefault('name', key)
+            keys.append(self.add(
+                key,
+                resource_name,
+                uuid,
+                replica_data,
+                list(avoid) + keys
+            ))
+        return keys
+
+    def plan(self):
+        """
+        :return: the :class:`cloudsigma.scheduler.TaskGraph` of the clone
+            requests, keyed like the clones
+        """
+        graph = TaskGraph(
+            n_threads=self.n_threads,
+            retry_policy=self.retry_policy,
+            is_fatal=is_fatal,
+            name='clone'
+        )
+        for key, (_, _, _, avoid) in self.requests.items():
+            graph.add(
+                key,
+                lambda key=key: self._clone(key),
+                [name for name in avoid if name in self.requests]
+            )
+        return graph
+
+    def run(self, wait=True):
+        """
+        Requests the clones and waits for them to finish.
+
+        :param wait: wait for the clones to finish copying
+        :return: the :class:`cloudsigma.scheduler.TaskResult` by key. Clones
+            which did not finish in time are failed, and the clones
+            avoiding failed clones are skipped.
+        """
+        watcher = self.watcher
+        if watcher is None and wait:
+            watcher = StatusWatcher(
+                resource_classes=[resource.Drive, resource.Server],
+                ws_endpoint=self.ws_endpoint,
+                **self.client_kwargs
+            ).start()
+        self._transport = Transport(self._client.c, pool_size=self.n_threads)
+        try:
+            result = self.plan().run()
+            if wait:
+                self._wait(watcher, result)
+        finally:
+            self._transport.close()
+            if watcher is not None and watcher is not self.watcher:
+                watcher.stop()
+        return result
+
+    def _clone(self, key):
+        resource_name, uuid, data, avoid = self.requests[key]
+        avoid = [
+            self.clones[name]['uuid'] if name in self.requests else name
+            for name in avoid
+        ]
+        query_params = {'do': 'clone'}
+        if avoid:
+            query_params['avoid'] = ','.join(avoid)
+        self.clones[key] = self._transport.api(
+            'POST',
+            '/{}/{}/action/'.format(resource_name, uuid),
+            data=data,
+            query_params=query_params
+        )
+        LOG.debug('Cloned %s into %s', key, self.clones[key]['uuid'])
+
+    def _wait(self, watcher, result):
+        deadline = time.time() + self.timeout
+        keys = {}
+        for key in result.succeeded:
+            status = CLONES[self.requests[key][0]][1]
+            keys.setdefault(status, {})[self.clones[key]['uuid']] = key
+        for status, by_uuid in keys.items():
+            remaining = max(deadline - time.time(), 0)
+            for uuid in watcher.wait_all(by_uuid, status, remaining):
+                key = by_uuid[uuid]
+                result.succeeded.remove(key)
+                result.failed[key] = FatalError(
+                    'Clone {} is not {} after {}s'.format(
+                        uuid,
+                        status,
+                        self.timeout
+                    )
+                )
@@ -0,0 +1,486 @@
+"""
+Columnar exports of resource lists, for reports over a whole fleet.
+
+The objects of a list are streamed into one array per field, so
+aggregations run vectorized instead of looping over dicts. Lists nested in
+the objects, like the drives of a server, become separate relation tables
+keyed by the uuid of their parent object. The columns are NumPy arrays when
+numpy is installed, plain lists otherwise, and a snapshot of the tables can
+be written to Parquet files with pyarrow, or to a compressed NumPy archive.
+Both are installed with the ``columnar`` extra::
+
+    pip install cloudsigma[columnar]
+
+Usage::
+
+    snapshot = columnar.snapshot([Server(), Drive()])
+    servers = snapshot['servers']
+    running = servers.filter(servers['status'] == 'running')
+    print(running.aggregate('cpu_type', 'mem', how='sum'))
+    snapshot.write('inventory-2020-02-01')
+"""
+from __future__ import division
+import os
+from builtins import object
+
+from past.builtins import basestring
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    INTEGER_TYPES = set([int, long])  # noqa: F821
+except NameError:
+    INTEGER_TYPES = set([int])
+
+SERVER_COLUMNS = [
+    'uuid',
+    'name',
+    'status',
+    'cpu',
+    'mem',
+    'smp',
+    'cpu_type',
+    'hv_relaxed',
+    'hv_tsc',
+    ('owner_uuid', 'owner.uuid'),
+]
+
+SERVER_RELATIONS = [
+    (
+        'server_drives',
+        'drives',
+        [
+            ('drive_uuid', 'drive.uuid'),
+            'boot_order',
+            'device',
+            'dev_channel',
+        ],
+    ),
+    (
+        'server_nics',
+        'nics',
+        [
+            'mac',
+            'model',
+            ('ip_v4_conf', 'ip_v4_conf.conf'),
+            ('ip_v4', 'runtime.ip_v4.uuid'),
+            ('vlan_uuid', 'vlan.uuid'),
+            ('firewall_policy_uuid', 'firewall_policy.uuid'),
+        ],
+    ),
+]
+
+DRIVE_COLUMNS = [
+    'uuid',
+    'name',
+    'status',
+    'size',
+    'media',
+    'storage_type',
+    'allow_multimount',
+    ('owner_uuid', 'owner.uuid'),
+]
+
+DRIVE_RELATIONS = [
+    ('drive_mounts', 'mounted_on', [('server_uuid', 'uuid')]),
+]
+
+# default columns and relations by resource name
+EXPORTS = {
+    'servers': (SERVER_COLUMNS, SERVER_RELATIONS),
+    'drives': (DRIVE_COLUMNS, DRIVE_RELATIONS),
+}
+
+
+def column_spec(column):
+    """
+    :param column:
+        A field name, a dotted path into nested objects, or a tuple of the
+        column name and the path.
+    :return: tuple of the column name and the path as a tuple of keys
+    """
+    if isinstance(column, basestring):
+        name, path = column.replace('.', '_'), column
+    else:
+        name, path = column
+    return name, tuple(path.split('.')) if path else ()
+
+
+def get_path(obj, path):
+    """
+    :return: the value at a path of keys, or None if any key is missing
+    """
+    for key in path:
+        if obj is None:
+            return None
+        try:
+            obj = obj[key]
+        except (KeyError, TypeError, IndexError):
+            return None
+    return obj
+
+
+def to_array(values):
+    """
+    Converts a column to a NumPy array of the narrowest fitting type:
+    bool, int64, float64 with NaN for missing numbers, or object.
+    """
+    if numpy is None:
+        return values
+    kinds = set(value.__class__ for value in values)
+    has_none = type(None) in kinds
+    kinds.discard(type(None))
+    if kinds == set([bool]) and not has_none:
+        return numpy.array(values, dtype=bool)
+    if kinds and kinds <= INTEGER_TYPES | set([float]):
+        if kinds <= INTEGER_TYPES and not has_none:
+            try:
+                return numpy.array(values, dtype=numpy.int64)
+            except OverflowError:
+                pass
+        return numpy.array(
+            [numpy.nan if value is None else value for value in values],
+            dtype=numpy.float64
+        )
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+class Table(object):
+    """
+    Equally long columns of NumPy arrays, or of lists without numpy.
+    """
+
+    def __init__(self, name, columns):
+        """
+        :param columns: list of (column name, values) tuples
+        """
+        self.name = name
+        self.columns = list(columns)
+        self._index = dict(
+            (column, index)
+            for index, (column, _) in enumerate(self.columns)
+        )
+
+    def __repr__(self):
+        return '<Table({}, {} rows, columns={})>'.format(
+            self.name,
+            len(self),
+            self.column_names
+        )
+
+    @property
+    def column_names(self):
+        return [column for column, _ in self.columns]
+
+    def __len__(self):
+        return len(self.columns[0][1]) if self.columns else 0
+
+    def __getitem__(self, column):
+        return self.columns[self._index[column]][1]
+
+    def __contains__(self, column):
+        return column in self._index
+
+    def rows(self):
+        """
+        Yields the rows as dicts.
+        """
+        names = self.column_names
+        for values in zip(*[values for _, values in self.columns]):
+            yield dict(zip(names, values))
+
+    def filter(self, mask):
+        """
+        :param mask: a boolean array, e.g. ``table['status'] == 'running'``
+        :return: a table of the rows where *mask* is true
+        """
+        require_numpy()
+        mask = numpy.asarray(mask, dtype=bool)
+        return Table(
+            self.name,
+            [
+                (column, numpy.asarray(values)[mask])
+                for column, values in self.columns
+            ]
+        )
+
+    def aggregate(self, by, column=None, how='sum'):
+        """
+        Groups the rows by the values of a column, vectorized.
+
+        :param by:
+            The column to group by. Object columns are grouped by their
+            string values, so missing values form the group 'None'.
+        :param column:
+            The numeric column to aggregate. Not needed for 'count'.
+        :param how:
+            'count', 'sum', 'mean', 'min' or 'max'.
+        :return: a table with the columns *by* and ``<column>_<how>``
+        """
+        require_numpy()
+        keys = numpy.asarray(self[by])
+        if keys.dtype == object:
+            keys = keys.astype(str)
+        groups, inverse = numpy.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        counts = numpy.bincount(inverse, minlength=len(groups))
+        if how == 'count':
+            return Table(self.name, [(by, groups), ('count', counts)])
+
+        values = numpy.asarray(self[column], dtype=numpy.float64)
+        if how in ('sum', 'mean'):
+            result = numpy.bincount(
+                inverse,
+                weights=values,
+                minlength=len(groups)
+            )
+            if how == 'mean':
+                result = result / counts
+        elif how in ('min', 'max'):
+            ufunc = numpy.minimum if how == 'min' else numpy.maximum
+            result = numpy.full(
+                len(groups),
+                numpy.inf if how == 'min' else -numpy.inf
+            )
+            ufunc.at(result, inverse, values)
+        else:
+            raise ValueError('Unknown aggregation {!r}'.format(how))
+        return Table(
+            self.name,
+            [(by, groups), ('{}_{}'.format(column, how), result)]
+        )
+
+    def to_arrow(self):
+        """
+        :return: a pyarrow.Table
+        """
+        require_pyarrow()
+        arrays = []
+        for _, values in self.columns:
+            if numpy is not None and isinstance(values, numpy.ndarray):
+                arrays.append(pyarrow.array(values, from_pandas=True))
+            else:
+                arrays.append(pyarrow.array(values))
+        return pyarrow.Table.from_arrays(arrays, names=self.column_names)
+
+    @classmethod
+    def from_arrow(cls, name, table):
+        columns = []
+        for column_name, column in zip(table.column_names, table.columns):
+            values = column.to_pylist()
+            columns.append((column_name, to_array(values)))
+        return cls(name, columns)
+
+
+class TableBuilder(object):
+    """
+    Collects the values of objects column by column.
+    """
+
+    def __init__(self, name, columns, parent_column=None):
+        """
+        :param columns: see :func:`column_spec`
+        :param parent_column:
+            Name of a first column holding the key of the parent object,
+            for relation tables.
+        """
+        self.name = name
+        self.specs = [column_spec(column) for column in columns]
+        self.parent_column = parent_column
+        self.values = [[] for _ in self.specs]
+        self.parent_keys = []
+
+    def append(self, obj, parent_key=None):
+        if self.parent_column:
+            self.parent_keys.append(parent_key)
+        for values, (_, path) in zip(self.values, self.specs):
+            values.append(get_path(obj, path))
+
+    def build(self):
+        columns = []
+        if self.parent_column:
+            columns.append((self.parent_column, to_array(self.parent_keys)))
+        for values, (name, _) in zip(self.values, self.specs):
+            columns.append((name, to_array(values)))
+        return Table(self.name, columns)
+
+
+class Snapshot(dict):
+    """
+    Tables by name, e.g. servers, drives and their relation tables.
+    """
+
+    def write(self, path, format=None):
+        """
+        Writes the tables to the directory *path*, one file per table.
+
+        :param format:
+            'parquet' (default with pyarrow) or 'npz' (default without).
+        """
+        format = format or ('parquet' if pyarrow is not None else 'npz')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name, table in self.items():
+            target = os.path.join(path, '{}.{}'.format(name, format))
+            if format == 'parquet':
+                pyarrow.parquet.write_table(table.to_arrow(), target)
+            elif format == 'npz':
+                require_numpy()
+                numpy.savez_compressed(
+                    target,
+                    **dict(
+                        (column, numpy.asarray(values))
+                        for column, values in table.columns
+                    )
+                )
+            else:
+                raise ValueError('Unknown format {!r}'.format(format))
+
+    @classmethod
+    def read(cls, path):
+        """
+        Reads the tables written by :meth:`write`.
+        """
+        snapshot = cls()
+        for filename in sorted(os.listdir(path)):
+            name, extension = os.path.splitext(filename)
+            filename = os.path.join(path, filename)
+            if extension == '.parquet':
+                require_pyarrow()
+                snapshot[name] = Table.from_arrow(
+                    name,
+                    pyarrow.parquet.read_table(filename)
+                )
+            elif extension == '.npz':
+                require_numpy()
+                with numpy.load(filename, allow_pickle=True) as archive:
+                    snapshot[name] = Table(
+                        name,
+                        [(column, archive[column]) for column in archive.files]
+                    )
+        return snapshot
+
+
+def export(objects, columns, relations=(), name='objects', key='uuid',
+           release=False):
+    """
+    Streams objects into columns.
+
+    :param objects:
+        An iterable of dicts or :mod:`cloudsigma.models` objects.
+    :param columns:
+        The columns of the main table, see :func:`column_spec`.
+    :param relations:
+        Tuples of (table name, list field, columns) for lists nested in the
+        objects. Every item of the list field is a row of the relation
+        table, with the *key* of its parent object as first column, named
+        after the main table, e.g. server_uuid.
+    :param key:
+        The field identifying an object.
+    :param release:
+        Drop every object from the *objects* list once its values are
+        collected, so the list and the columns do not both stay in memory.
+    :return: a :class:`Snapshot` of the main and the relation tables
+    """
+    main = TableBuilder(name, columns)
+    singular = name[:-1] if name.endswith('s') else name
+    parent_column = '{}_{}'.format(singular, key)
+    related = [
+        (field, TableBuilder(table, table_columns, parent_column))
+        for table, field, table_columns in relations
+    ]
+    for index, obj in enumerate(objects):
+        main.append(obj)
+        parent_key = get_path(obj, (key,))
+        for field, builder in related:
+            for item in get_path(obj, (field,)) or ():
+                builder.append(item, parent_key)
+        if release:
+            objects[index] = None
+
+    snapshot = Snapshot()
+    snapshot[name] = main.build()
+    for _, builder in related:
+        snapshot[builder.name] = builder.build()
+    return snapshot
+
+
+def infer_columns(obj):
+    """
+    :return: the fields of an object with scalar values
+    """
+    return sorted(
+        key for key, value in obj.items()
+        if not isinstance(value, (dict, list)) and
+        not hasattr(value, 'keys') and not hasattr(value, 'append')
+    )
+
+
+def export_resource(resource, columns=None, relations=None,
+                    query_params=None):
+    """
+    Lists the details of a resource into columns.
+
+    :param resource:
+        A :class:`cloudsigma.resource.ResourceBase` instance.
+    :param columns:
+        Defaults to the :data:`EXPORTS` of the resource, or to all fields
+        with scalar values.
+    :param relations:
+        Defaults to the :data:`EXPORTS` of the resource.
+    :return: a :class:`Snapshot`
+    """
+    objects = resource.list_detail(query_params=query_params)
+    default_columns, default_relations = EXPORTS.get(
+        resource.resource_name,
+        (None, ())
+    )
+    if columns is None:
+        columns = default_columns
+        if columns is None:
+            columns = infer_columns(objects[0]) if objects else ['uuid']
+    if relations is None:
+        relations = default_relations
+    return export(
+        objects,
+        columns,
+        relations,
+        name=resource.resource_name.replace('/', '_'),
+        release=True
+    )
+
+
+def snapshot(resources):
+    """
+    Exports several resources with their default columns into one snapshot.
+    """
+    result = Snapshot()
+    for resource in resources:
+        result.update(export_resource(resource))
+    return result
+
+
+def require_numpy():
+    if numpy is None:
+        raise ImportError(
+            'Vectorized operations need numpy, install cloudsigma[columnar]'
+        )
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ImportError(
+            'Arrow tables and Parquet files need pyarrow, install '
+            'cloudsigma[columnar]'
+        )
@@ -0,0 +1,170 @@
+"""
+Content encodings for uploading compressible images.
+
+Chunks are compressed on the client and sent with a Content-Encoding
+header, so that the server stores the decompressed data. gzip is always
+available. zstd needs the optional zstandard package, which is installed
+with the ``zstd`` extra::
+
+    pip install cloudsigma[zstd]
+"""
+import concurrent.futures
+import threading
+import zlib
+from builtins import object
+
+from past.builtins import basestring
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class GzipCodec(object):
+    name = 'gzip'
+    default_level = 1
+
+    def __init__(self, level=None):
+        """
+        :param level:
+            Compression level from 1 (fastest) to 9 (smallest). Default is 1,
+            which is usually enough to be faster than the network.
+        """
+        self.level = level if level is not None else self.default_level
+
+    def compress(self, data):
+        # zlib releases the GIL, so compressing threads run in parallel
+        compressor = zlib.compressobj(
+            self.level,
+            zlib.DEFLATED,
+            16 + zlib.MAX_WBITS
+        )
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class ZstdCodec(object):
+    name = 'zstd'
+    default_level = 3
+
+    def __init__(self, level=None):
+        """
+        :param level:
+            Compression level from 1 (fastest) to 22 (smallest). Default is 3.
+        """
+        if zstandard is None:
+            raise ImportError(
+                'The zstd content encoding needs zstandard, install '
+                'cloudsigma[zstd]'
+            )
+        self.level = level if level is not None else self.default_level
+        # compressor objects may not be shared between threads
+        self._local = threading.local()
+
+    def compress(self, data):
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = zstandard.ZstdCompressor(level=self.level)
+            self._local.compressor = compressor
+        return compressor.compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = {
+    GzipCodec.name: GzipCodec,
+    ZstdCodec.name: ZstdCodec,
+}
+
+
+def get_codec(content_encoding, level=None):
+    """
+    :param content_encoding:
+        A codec, or the name of a content encoding, 'gzip' or 'zstd'. None
+        means no compression.
+    :return: a codec instance or None
+    """
+    if content_encoding is None or not isinstance(
+            content_encoding, basestring):
+        return content_encoding
+    try:
+        codec_class = CODECS[content_encoding]
+    except KeyError:
+        raise ValueError(
+            'Unknown content encoding {!r}, use one of {}'.format(
+                content_encoding,
+                ', '.join(sorted(CODECS))
+            )
+        )
+    return codec_class(level)
+
+
+class CompressionPipeline(object):
+    """
+    Reads and compresses the chunks of a source in a thread pool ahead of
+    the threads sending them.
+
+    The chunks are expected to be sent roughly in the given order. When a
+    chunk is taken, the next *lookahead* chunks are submitted, so at most
+    lookahead compressed chunks wait in memory besides the ones being sent.
+    """
+
+    def __init__(self, source, codec, chunks, n_threads=2, lookahead=4):
+        """
+        :param source:
+            The source with a read(offset, size) method.
+        :param codec:
+            The codec compressing the chunks.
+        :param chunks:
+            The (chunk_number, chunk_offset, real_chunk_size) tuples in the
+            order they will be sent.
+        """
+        self.source = source
+        self.codec = codec
+        self.chunks = list(chunks)
+        self.lookahead = lookahead
+        self._positions = dict(
+            (chunk[1], position) for position, chunk in enumerate(self.chunks)
+        )
+        self._futures = {}
+        self._submitted = 0
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(n_threads)
+
+    def _compress(self, chunk_offset, real_chunk_size):
+        return self.codec.compress(
+            self.source.read(chunk_offset, real_chunk_size)
+        )
+
+    def get(self, chunk_offset, real_chunk_size):
+        """
+        :return: the compressed data of a chunk
+        """
+        with self._lock:
+            position = self._positions.get(chunk_offset)
+            if position is not None:
+                end = min(position + 1 + self.lookahead, len(self.chunks))
+                for chunk in self.chunks[max(self._submitted, position):end]:
+                    self._futures[chunk[1]] = self._executor.submit(
+                        self._compress,
+                        chunk[1],
+                        chunk[2]
+                    )
+                self._submitted = max(self._submitted, end)
+            future = self._futures.pop(chunk_offset, None)
+
+        if future is None:
+            # a retried chunk, or one outside the planned order
+            return self._compress(chunk_offset, real_chunk_size)
+        return future.result()
+
+    def close(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self._executor.shutdown(wait=False)
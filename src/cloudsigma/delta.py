@@ -0,0 +1,457 @@
+"""
+Delta uploads: only the chunks of an image which differ from the drive are
+sent.
+
+The image is cut into the chunks of the chunk link protocol and every chunk
+is hashed. The hashes are compared with a :class:`BlockManifest` of the
+revision last uploaded to the drive, which is saved locally after every
+delta upload, or with hashes of the drive itself computed from ranged
+downloads. Unchanged chunks are skipped, changed ones are uploaded with the
+drive's upload_chunk action.
+
+The upload_chunk action refuses chunks which were already uploaded, with a
+416, and every chunk of a drive whose upload finished was. Deltas therefore
+only apply to drives which are still uploading, e.g. to resume an upload
+with a changed image. Changing a finished drive is refused before anything
+is sent, and a 416 on a changed chunk fails the upload, without saving the
+manifest.
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+from builtins import object, range
+from logging import getLogger
+
+from .conf import config
+from .download import Download
+from .scheduler import FatalError
+from .upload_engine import ChunkLinkProtocol, StreamSource, UploadEngine
+
+
+LOG = getLogger(__name__)
+
+DEFAULT_MANIFEST_DIR = os.path.join(
+    os.path.expanduser('~'),
+    '.cloudsigma',
+    'manifests'
+)
+
+
+def chunk_layout(size, chunk_size):
+    """
+    Yields (index, chunk_offset, real_chunk_size) tuples of the chunks of an
+    image, numbered from 0. Like the upload chunks, the last chunk also
+    holds the remainder, so it may be up to twice the chunk size.
+    """
+    n_chunks = max(1, size // chunk_size)
+    for index in range(n_chunks - 1):
+        yield index, index * chunk_size, chunk_size
+    last_offset = (n_chunks - 1) * chunk_size
+    yield n_chunks - 1, last_offset, size - last_offset
+
+
+def hash_source(source, chunk_size, algorithm='sha256', n_threads=4):
+    """
+    Hashes the chunks of a source in parallel. hashlib releases the GIL
+    for large buffers, so the threads hash on several cores.
+
+    :param source:
+        A source with random access reads, e.g. a
+        :class:`cloudsigma.upload_engine.FileSource`.
+    :return: a list of hex digests, one per chunk of :func:`chunk_layout`
+    """
+    def hash_chunk(chunk):
+        _, chunk_offset, real_chunk_size = chunk
+        return hashlib.new(
+            algorithm,
+            source.read(chunk_offset, real_chunk_size)
+        ).hexdigest()
+
+    executor = concurrent.futures.ThreadPoolExecutor(n_threads)
+    try:
+        return list(executor.map(
+            hash_chunk,
+            chunk_layout(source.size, chunk_size)
+        ))
+    finally:
+        executor.shutdown()
+
+
+class BlockManifest(object):
+    """
+    Hashes of the chunks of an image revision, as uploaded to a drive.
+    """
+
+    def __init__(self, size, chunk_size, hashes, algorithm='sha256',
+                 drive_uuid=None):
+        """
+        :param size:
+            Size of the image in bytes.
+        :param chunk_size:
+            Size of the hashed chunks. See :func:`chunk_layout`.
+        :param hashes:
+            List of the hex digests of the chunks.
+        :param algorithm:
+            The :mod:`hashlib` algorithm of the digests.
+        """
+        self.size = size
+        self.chunk_size = chunk_size
+        self.hashes = list(hashes)
+        self.algorithm = algorithm
+        self.drive_uuid = drive_uuid
+
+    def __repr__(self):
+        return '<BlockManifest(drive={}, size={}, chunk_size={}, ' \
+               'chunks={})>'.format(self.drive_uuid, self.size,
+                                    self.chunk_size, len(self.hashes))
+
+    @classmethod
+    def from_source(cls, source, chunk_size, algorithm='sha256',
+                    n_threads=4, drive_uuid=None):
+        return cls(
+            source.size,
+            chunk_size,
+            hash_source(source, chunk_size, algorithm, n_threads),
+            algorithm=algorithm,
+            drive_uuid=drive_uuid
+        )
+
+    @staticmethod
+    def default_path(drive_uuid, manifest_dir=None):
+        """
+        :param manifest_dir:
+            Defaults to the *manifest_dir* config option or
+            ~/.cloudsigma/manifests
+        """
+        manifest_dir = manifest_dir or config.get(
+            'manifest_dir',
+            DEFAULT_MANIFEST_DIR
+        )
+        return os.path.join(manifest_dir, drive_uuid + '.manifest')
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: the manifest, or None if the file does not exist
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(
+            data['size'],
+            data['chunk_size'],
+            data['hashes'],
+            algorithm=data['algorithm'],
+            drive_uuid=data.get('drive_uuid')
+        )
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write a new file and rename it, so an interrupted save cannot leave
+        # a manifest that claims chunks the drive does not have
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({
+                'drive_uuid': self.drive_uuid,
+                'size': self.size,
+                'chunk_size': self.chunk_size,
+                'algorithm': self.algorithm,
+                'hashes': self.hashes,
+            }, f)
+        if hasattr(os, 'replace'):
+            os.replace(temp_path, path)
+            return
+        # Python 2 cannot rename over an existing file on Windows only
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+
+    def matches(self, other):
+        """
+        True if the hashes of both manifests are of the same chunks.
+        """
+        return (
+            self.size == other.size and
+            self.chunk_size == other.chunk_size and
+            self.algorithm == other.algorithm
+        )
+
+    def changed(self, other):
+        """
+        :return: the set of the chunk indexes which differ from *other*
+        """
+        if not self.matches(other):
+            return set(range(len(self.hashes)))
+        return set(
+            index for index, (mine, theirs)
+            in enumerate(zip(self.hashes, other.hashes))
+            if mine != theirs
+        )
+
+
+class DeltaUpload(UploadEngine):
+    """
+    Uploads the chunks of an image which differ from the drive.
+
+    The unchanged chunks are found by comparing the block hashes of the
+    image either with the manifest saved by the previous upload to the
+    drive, or with hashes of the drive computed from ranged downloads when
+    *remote* is True. Without a drive uuid a new drive is created and the
+    whole image uploaded, which saves the manifest for the next delta.
+
+    A manifest only describes the drive as long as nothing else writes to
+    it, e.g. a server which has the drive mounted. Use *remote* hashing when
+    in doubt. It downloads the drive once, but needs no trust in the local
+    state.
+
+    The image must have the size of the drive. The chunk size is taken from
+    the manifest. If it cannot be reused, the whole image is uploaded.
+
+    Only drives which are still uploading accept changed chunks, see the
+    module documentation.
+    """
+
+    def __init__(
+            self,
+            source,
+            drive_uuid=None,
+            base=None,
+            remote=False,
+            chunk_size=None,
+            algorithm='sha256',
+            hash_threads=4,
+            manifest_dir=None,
+            save_manifest=True,
+            **kwargs
+    ):
+        """
+        :param source:
+            The image to upload, a source with random access reads like
+            :class:`cloudsigma.upload_engine.FileSource`.
+        :param drive_uuid:
+            UUID of the drive to update.
+        :param base:
+            A :class:`BlockManifest`, or the path of one, of the revision on
+            the drive. Defaults to the manifest saved by the last delta
+            upload to the drive.
+        :param remote:
+            Compare with hashes of the drive's data instead of a manifest.
+        :param algorithm:
+            The :mod:`hashlib` algorithm of the block hashes. Default is
+            sha256.
+        :param hash_threads:
+            Number of threads hashing the image. Default is 4.
+        :param manifest_dir:
+            Directory of the saved manifests. See
+            :meth:`BlockManifest.default_path`.
+        :param save_manifest:
+            Save the manifest of the image after a successful upload.
+            Default is True.
+
+        The remaining keyword arguments are passed on to
+        :class:`cloudsigma.upload_engine.UploadEngine`. The protocol is
+        always the chunk link protocol.
+        """
+        if isinstance(source, StreamSource):
+            raise ValueError(
+                'Delta uploads need random access to the image, '
+                'streams cannot be hashed ahead of the upload'
+            )
+        super(DeltaUpload, self).__init__(
+            source,
+            protocol=ChunkLinkProtocol(),
+            drive_uuid=drive_uuid,
+            chunk_size=chunk_size,
+            **kwargs
+        )
+        self.base = base
+        self.remote = remote
+        self.algorithm = algorithm
+        self.hash_threads = hash_threads
+        self.manifest_dir = manifest_dir
+        self.save_manifest = save_manifest
+        self.manifest = None
+        self.changed_chunks = None
+        # whether the drive was created by this upload, so that only its own
+        # earlier attempts can have uploaded a chunk
+        self.created_drive = False
+        self._unsent = set()
+
+    @property
+    def manifest_path(self):
+        return BlockManifest.default_path(self.drive_uuid, self.manifest_dir)
+
+    @property
+    def changed_size(self):
+        """
+        Number of bytes in the changed chunks.
+        """
+        if self.changed_chunks is None:
+            return None
+        return sum(
+            real_chunk_size
+            for index, _, real_chunk_size
+            in chunk_layout(self.file_size, self.chunk_size)
+            if index in self.changed_chunks
+        )
+
+    def load_base(self):
+        """
+        :return: the manifest to compare with, or None
+        """
+        base = self.base
+        if base is None and self.drive_uuid:
+            base = self.manifest_path
+        if base is None or isinstance(base, BlockManifest):
+            return base
+        manifest = BlockManifest.load(base)
+        if manifest is None:
+            LOG.warning('No manifest at {}'.format(base))
+        elif manifest.drive_uuid not in (None, self.drive_uuid):
+            LOG.warning(
+                'Manifest {} is of drive {}, not {}'.format(
+                    base,
+                    manifest.drive_uuid,
+                    self.drive_uuid
+                )
+            )
+            return None
+        return manifest
+
+    def remote_manifest(self):
+        """
+        Hashes the chunks of the drive with ranged downloads.
+        """
+        download = Download(
+            self.drive_uuid,
+            None,
+            chunk_size=self.chunk_size,
+            n_threads=self.n_threads,
+            use_journal=False,
+            retry_policy=self.retry_policy,
+            transport=self.transport,
+            generic_client_kwargs=self.generic_client_kwargs
+        )
+        download.drive_size = self.remote_size
+        digests = download.hash_chunks(
+            chunk_layout(self.remote_size, self.chunk_size),
+            algorithm=self.algorithm
+        )
+        return BlockManifest(
+            self.remote_size,
+            self.chunk_size,
+            [digests[index] for index in range(len(digests))],
+            algorithm=self.algorithm,
+            drive_uuid=self.drive_uuid
+        )
+
+    def prepare(self):
+        base = None
+        if self.drive_uuid and not self.remote:
+            base = self.load_base()
+            if base is not None and base.algorithm != self.algorithm:
+                LOG.warning(
+                    'Manifest hashes are {}, not {}. Uploading the whole '
+                    'image.'.format(base.algorithm, self.algorithm)
+                )
+                base = None
+            if base is not None and not self.chunk_size:
+                self.chunk_size = base.chunk_size
+        if not self.drive_uuid:
+            self.created_drive = True
+        super(DeltaUpload, self).prepare()
+
+        self.manifest = BlockManifest.from_source(
+            self.source,
+            self.chunk_size,
+            algorithm=self.algorithm,
+            n_threads=self.hash_threads,
+            drive_uuid=self.drive_uuid
+        )
+        if self.remote and not self.probe_chunks:
+            # a new drive is empty
+            base = None
+        elif self.remote:
+            base = self.remote_manifest()
+        if base is not None and not self.manifest.matches(base):
+            LOG.warning(
+                'Manifest of {} bytes in {} byte chunks does not match the '
+                'image. Uploading the whole image.'.format(
+                    base.size,
+                    base.chunk_size
+                )
+            )
+
+        if base is None:
+            self.changed_chunks = set(range(len(self.manifest.hashes)))
+        else:
+            self.changed_chunks = self.manifest.changed(base)
+        LOG.info(
+            '{} of {} chunks changed, {:0.1f} MB to upload'.format(
+                len(self.changed_chunks),
+                len(self.manifest.hashes),
+                self.changed_size / 1024.0 ** 2
+            )
+        )
+        if self.changed_chunks and not self.created_drive:
+            status = self.dc.get(self.drive_uuid)['status']
+            if status != 'uploading':
+                raise FatalError(
+                    'Drive {} is {}, its upload finished and the changed '
+                    'chunks cannot be uploaded over it. Upload the image '
+                    'to a new drive.'.format(self.drive_uuid, status)
+                )
+        self._unsent = set()
+        # the rates are of the upload, not of the hashing
+        self.progress.reset()
+
+    def pending_chunks(self):
+        """
+        Yields the changed chunks which are not recorded as done in the
+        journal. Unchanged chunks are reported as skipped.
+        """
+        first = self.protocol.first_chunk_number
+        for chunk in super(DeltaUpload, self).pending_chunks():
+            if chunk[0] - first not in self.changed_chunks:
+                self.progress.skip(chunk[2], chunk=chunk)
+                continue
+            self._unsent.add(chunk[0])
+            yield chunk
+
+    def upload_chunk(self, chunk_number, chunk_offset, real_chunk_size):
+        sent = super(DeltaUpload, self).upload_chunk(
+            chunk_number,
+            chunk_offset,
+            real_chunk_size
+        )
+        if not sent and not self.created_drive:
+            raise FatalError(
+                'Chunk {} of drive {} changed, but the server already has '
+                'the chunk and refused the new data'.format(
+                    chunk_number,
+                    self.drive_uuid
+                )
+            )
+        return sent
+
+    def chunk_done(self, chunk, sent, latency=None):
+        # on a drive of this upload, a chunk already on the server was sent
+        # by an earlier attempt whose response was lost
+        self._unsent.discard(chunk[0])
+        super(DeltaUpload, self).chunk_done(chunk, sent, latency)
+
+    def finish(self, result):
+        result = super(DeltaUpload, self).finish(result)
+        if self._unsent:
+            raise FatalError(
+                'Chunks {} of drive {} were not sent, not saving the '
+                'manifest'.format(sorted(self._unsent), self.drive_uuid)
+            )
+        if self.save_manifest:
+            self.manifest.drive_uuid = self.drive_uuid
+            self.manifest.save(self.manifest_path)
+        return result
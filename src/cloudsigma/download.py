@@ -0,0 +1,385 @@
+from __future__ import division
+import hashlib
+import os
+import threading
+import time
+from builtins import range
+from logging import getLogger
+
+from .journal import ChunkJournal
+from .progress import TransferProgress
+from .resource import ResourceBase
+from .scheduler import FatalError, RetryableError, RetryPolicy, TaskScheduler
+from .transport import Transport
+
+
+LOG = getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 32 * 1024 ** 2
+
+# Granularity of writes and of the zero block detection
+BLOCK_SIZE = 1024 ** 2
+ZERO_BLOCK = b'\0' * BLOCK_SIZE
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def is_zero(block):
+    if len(block) == BLOCK_SIZE:
+        return block == ZERO_BLOCK
+    return block.count(b'\0') == len(block)
+
+
+if hasattr(os, 'pwrite'):
+    def pwrite(fd, data, offset, lock):
+        os.pwrite(fd, data, offset)
+else:
+    def pwrite(fd, data, offset, lock):
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+class Download(ResourceBase):
+    resource_name = 'drives'
+
+    def __init__(
+            self,
+            drive_uuid,
+            target_path,
+            chunk_size=DEFAULT_CHUNK_SIZE,
+            n_threads=4,
+            progress_callback=None,
+            progress_report_interval=1,
+            checksum=None,
+            checksum_algorithm='md5',
+            use_journal=True,
+            journal_dir=None,
+            retry_policy=None,
+            transport=None,
+            generic_client_kwargs=None
+    ):
+        """
+        Downloads a drive image with parallel HTTP range requests.
+
+        The target file is preallocated as a sparse file and every range is
+        written at its offset. Blocks of zeroes are not written, so they stay
+        holes in the target file.
+
+        :param drive_uuid:
+            UUID of the drive to download.
+        :param target_path:
+            Path of the local image file. An existing file is resumed if the
+            journal has records for it, otherwise it is overwritten.
+        :param chunk_size:
+            Size of a range request in bytes. Default is 32MB.
+        :param n_threads:
+            Number of parallel range requests. Default is 4.
+        :param progress_callback:
+            Called as progress_callback(downloaded_size, drive_size) when
+            chunks are done, at most every *progress_report_interval*
+            seconds. Subscribe to *progress* for detailed progress events.
+        :param progress_report_interval:
+            Minimum seconds between *progress_callback* calls. Default is 1
+            second.
+        :param checksum:
+            Expected hex digest of the image. When given, the downloaded file
+            is verified and :class:`ChecksumError` is raised on mismatch.
+        :param checksum_algorithm:
+            A :mod:`hashlib` algorithm name. Default is md5.
+        :param use_journal:
+            Keep an on-disk journal of the downloaded chunks, so an
+            interrupted download can be resumed. Default is True.
+        :param journal_dir:
+            Directory for the journal files. See
+            :class:`cloudsigma.journal.ChunkJournal`.
+        :param retry_policy:
+            A :class:`cloudsigma.scheduler.RetryPolicy` for failed chunks.
+        :param transport:
+            A :class:`cloudsigma.transport.Transport` to share with other
+            transfers. By default the download creates its own.
+        :param generic_client_kwargs:
+            Keyword arguments for the GenericClient __init__
+        """
+        self.generic_client_kwargs = generic_client_kwargs or {}
+        super(Download, self).__init__(**self.generic_client_kwargs)
+        self.drive_uuid = drive_uuid
+        self.target_path = target_path
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads
+        self.progress = TransferProgress(
+            callback=progress_callback,
+            report_interval=progress_report_interval
+        )
+        self.progress_report_interval = progress_report_interval
+        self.checksum = checksum
+        self.checksum_algorithm = checksum_algorithm
+        self.use_journal = use_journal
+        self.journal_dir = journal_dir
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        self.drive_size = None
+        self.journal = None
+        self.scheduler = None
+        self.result = None
+        self.digest = None
+        self._fd = None
+        self._write_lock = threading.Lock()
+        self._resuming = False
+        self._transport = transport
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            self._transport = Transport(self.c, pool_size=self.n_threads)
+        return self._transport
+
+    @property
+    def downloaded_size(self):
+        return self.progress.done
+
+    @property
+    def download_url(self):
+        return self.transport.url(
+            '/{}/{}/download/'.format(self.resource_name, self.drive_uuid)
+        )
+
+    def chunks(self):
+        """
+        Yields tuples (chunk_number, chunk_offset, real_chunk_size) covering
+        the drive. Numbering starts from 0 and the last chunk may be smaller.
+        """
+        for chunk_number, offset in enumerate(
+                range(0, self.drive_size, self.chunk_size)):
+            yield chunk_number, offset, min(
+                self.chunk_size,
+                self.drive_size - offset
+            )
+
+    def download(self):
+        self.drive_size = int(self.get(self.drive_uuid)['size'])
+        self.progress.total = self.drive_size
+        self.progress.reset()
+
+        if self.use_journal:
+            self.journal = ChunkJournal.for_download(
+                self.drive_uuid,
+                self.drive_size,
+                self.target_path,
+                self.chunk_size,
+                journal_dir=self.journal_dir
+            )
+        self._resuming = bool(self.journal and self.journal.exists) and \
+            os.path.exists(self.target_path)
+        if self.journal and not self._resuming:
+            self.journal.discard()
+
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if not self._resuming:
+            flags |= os.O_TRUNC
+        self._fd = os.open(self.target_path, flags, 0o644)
+        try:
+            # extending with ftruncate allocates no blocks
+            os.ftruncate(self._fd, self.drive_size)
+            self.scheduler = TaskScheduler(
+                self.download_enqueued,
+                n_threads=self.n_threads,
+                retry_policy=self.retry_policy,
+                item_size=lambda chunk: chunk[2],
+                on_failure=self.chunk_failed,
+                name='download'
+            )
+            self.scheduler.start(self.pending_chunks())
+            try:
+                self.scheduler.wait()
+            except BaseException:
+                self.scheduler.cancel()
+                raise
+            self.progress.finish()
+            self.result = self.scheduler.result
+            if self.result.ok:
+                os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+        if self.journal:
+            if self.result.ok:
+                self.journal.discard()
+            else:
+                self.journal.close()
+        self.result.raise_for_failures()
+
+        if self.checksum:
+            self.verify()
+        return self.result
+
+    def pending_chunks(self):
+        for chunk in self.chunks():
+            if self.journal and self.journal.is_done(chunk[0]):
+                self.progress.skip(chunk[2], chunk=chunk)
+                continue
+            yield chunk
+
+    def cancel(self):
+        if self.scheduler:
+            self.scheduler.cancel()
+
+    def download_enqueued(self, chunk):
+        chunk_number, chunk_offset, real_chunk_size = chunk
+        self.progress.chunk_started()
+        started = time.time()
+        written = self.download_chunk(chunk_offset, real_chunk_size)
+        if self.journal:
+            self.journal.mark_done(chunk_number)
+        self.progress.chunk_done(
+            real_chunk_size,
+            latency=time.time() - started,
+            chunk=chunk
+        )
+        LOG.debug(
+            'Chunk {}:{}:{} downloaded, {} bytes written'.format(
+                chunk_number,
+                chunk_offset,
+                real_chunk_size,
+                written
+            )
+        )
+
+    def chunk_failed(self, chunk, exc, retrying):
+        self.progress.chunk_failed(exc, retrying, chunk=chunk)
+
+    def download_chunk(self, chunk_offset, real_chunk_size):
+        """
+        Fetches a range of the drive and writes it at its offset.
+
+        :return: number of bytes written, not counting skipped zero blocks
+        """
+        offset = chunk_offset
+        written = 0
+        for block in self.fetch_range(chunk_offset, real_chunk_size):
+            # On a fresh file zero blocks are holes already. When
+            # resuming, the region may hold data of an interrupted write.
+            if self._resuming or not is_zero(block):
+                pwrite(self._fd, block, offset, self._write_lock)
+                written += len(block)
+            offset += len(block)
+        return written
+
+    def hash_chunks(self, chunks, algorithm='sha256'):
+        """
+        Computes digests of ranges of the drive in parallel, without storing
+        the drive.
+
+        :param chunks:
+            Tuples (chunk_number, chunk_offset, real_chunk_size) of the
+            ranges to hash.
+        :param algorithm:
+            A :mod:`hashlib` algorithm name. Default is sha256.
+        :return:
+            A dictionary of chunk_number to hex digest.
+        """
+        if self.drive_size is None:
+            self.drive_size = int(self.get(self.drive_uuid)['size'])
+        chunks = list(chunks)
+        self.progress.total = sum(chunk[2] for chunk in chunks)
+        self.progress.reset()
+        digests = {}
+
+        def hash_chunk(chunk):
+            chunk_number, chunk_offset, real_chunk_size = chunk
+            self.progress.chunk_started()
+            started = time.time()
+            digest = hashlib.new(algorithm)
+            for block in self.fetch_range(chunk_offset, real_chunk_size):
+                digest.update(block)
+            digests[chunk_number] = digest.hexdigest()
+            self.progress.chunk_done(
+                real_chunk_size,
+                latency=time.time() - started,
+                chunk=chunk
+            )
+
+        self.scheduler = TaskScheduler(
+            hash_chunk,
+            n_threads=self.n_threads,
+            retry_policy=self.retry_policy,
+            item_size=lambda chunk: chunk[2],
+            on_failure=self.chunk_failed,
+            name='hash'
+        )
+        self.result = self.scheduler.run(chunks)
+        self.progress.finish()
+        self.result.raise_for_failures()
+        return digests
+
+    def fetch_range(self, chunk_offset, real_chunk_size):
+        """
+        Yields the blocks of a range of the drive as they arrive.
+
+        :raises cloudsigma.scheduler.RetryableError:
+            if the server sent less than the range
+        """
+        last_byte = chunk_offset + real_chunk_size - 1
+        res = self.transport.session.get(
+            self.download_url,
+            headers={'Range': 'bytes={}-{}'.format(chunk_offset, last_byte)},
+            stream=True
+        )
+        try:
+            if res.status_code == 200 and real_chunk_size != self.drive_size:
+                raise FatalError(
+                    'The server ignored the range request for {}'.format(
+                        self.download_url
+                    )
+                )
+            if res.status_code not in (200, 206):
+                # raises the matching ApiClientError for 4xx and 5xx statuses
+                self.c._process_response(res)
+                raise RetryableError(
+                    'Unexpected status {} for range {}-{}'.format(
+                        res.status_code,
+                        chunk_offset,
+                        last_byte
+                    )
+                )
+
+            offset = chunk_offset
+            for block in res.iter_content(BLOCK_SIZE):
+                offset += len(block)
+                yield block
+        finally:
+            res.close()
+
+        if offset != chunk_offset + real_chunk_size:
+            raise RetryableError(
+                'Short read for range {}-{}: got {} bytes'.format(
+                    chunk_offset,
+                    last_byte,
+                    offset - chunk_offset
+                )
+            )
+
+    def verify(self):
+        """
+        Computes the digest of the downloaded file and compares it to
+        *checksum*.
+        """
+        digest = hashlib.new(self.checksum_algorithm)
+        with open(self.target_path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                digest.update(block)
+        self.digest = digest.hexdigest()
+        if self.digest.lower() != self.checksum.lower():
+            raise ChecksumError(
+                'Checksum mismatch for {}: expected {}, got {}'.format(
+                    self.target_path,
+                    self.checksum,
+                    self.digest
+                )
+            )
+
+    def report_progress(self):
+        self.progress.report()
@@ -0,0 +1,507 @@
+"""
+Lifecycle actions on fleets of servers: starting, stopping, shutting down
+and restarting many servers at once.
+
+The actions are sent concurrently, at most *rate* requests per second, in
+waves: an optional canary wave first, then waves of *wave_size* servers.
+A wave starts when every server of the previous wave reached its target
+status, and the run stops if a wave had more than *max_failures* failures.
+All servers are watched by one :class:`StatusWatcher`, which lists the
+statuses of the whole account periodically and refreshes servers as the
+websocket announces their changes, instead of every server being polled on
+its own.
+
+Usage::
+
+    report = Fleet().run('restart', uuids, canary=1, wave_size=100)
+    print(report.summary())
+    for outcome in report.failed:
+        print(outcome.uuid, outcome.error)
+"""
+from __future__ import division
+from builtins import object, range
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from logging import getLogger
+
+from . import errors, resource
+from .scheduler import FatalError, RetryPolicy, TaskScheduler
+from .throttle import TokenBucket
+from .transport import Transport
+
+LOG = getLogger(__name__)
+
+# the status a server is in when each action is done
+TARGET_STATUS = {
+    'start': 'running',
+    'stop': 'stopped',
+    'shutdown': 'stopped',
+    'restart': 'running',
+}
+
+RESOURCE_URI = re.compile(r'/([a-z_]+)/([0-9a-fA-F-]{36})/?$')
+
+
+class StatusWatcher(object):
+    """
+    Tracks the statuses of the servers of an account, or of other resources
+    with a status, for many waiters.
+
+    A thread lists all objects every *poll_interval* seconds. With a
+    websocket, objects are also refreshed as soon as an event about them
+    arrives, and the listing is only a fallback for missed events. Deleted
+    objects have no status.
+
+    :ivar changed: dict of the time by uuid when the read was sent which
+        first saw the current status of the object, or which followed an
+        event about it
+    """
+
+    def __init__(self, poll_interval=None, use_websocket=True,
+                 resource_classes=None, ws_endpoint=None, **kwargs):
+        """
+        :param poll_interval:
+            Seconds between listings. Default is 15 with a websocket and 2
+            without.
+        :param use_websocket:
+            Subscribe to the websocket events. Falls back to polling if the
+            subscription fails, or if an api_endpoint is given without its
+            ws_endpoint.
+        :param resource_classes:
+            The resources to watch. Default is [resource.Server].
+        :param ws_endpoint:
+            The websocket of the api_endpoint. Default is the one of the
+            config.
+        :param kwargs:
+            The client arguments, like api_endpoint.
+        """
+        self.clients = OrderedDict(
+            (cls.resource_name, cls(**kwargs))
+            for cls in resource_classes or [resource.Server]
+        )
+        self.statuses = {}
+        self.changed = {}
+        self.transport = None
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._threads = []
+        self.websocket = None
+        if use_websocket and kwargs.get('api_endpoint') and not ws_endpoint:
+            # the websocket of the config belongs to another endpoint
+            LOG.info('Polling the statuses, no ws_endpoint for %s',
+                     kwargs['api_endpoint'])
+        elif use_websocket:
+            try:
+                self.websocket = resource.Websocket(
+                    timeout=1,
+                    ws_endpoint=ws_endpoint,
+                    **kwargs
+                )
+            except Exception as exc:
+                LOG.info('Polling the statuses, no websocket: %r', exc)
+        if poll_interval is None:
+            poll_interval = 15 if self.websocket else 2
+        self.poll_interval = poll_interval
+
+    def start(self):
+        self.poll()
+        targets = [self._poll_forever]
+        if self.websocket:
+            # the listener refreshes objects next to the polling thread
+            client = next(iter(self.clients.values())).c
+            self.transport = Transport(client, pool_size=1)
+            targets.append(self._listen)
+        for target in targets:
+            thread = threading.Thread(target=target, name='status-watcher')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def update(self, uuid, status, observed=None, event=False):
+        """
+        :param status: the new status, None if the object was deleted
+        :param observed: when the read of the status was sent. Default is
+            now.
+        :param event: the read followed an event about the object, which
+            changed even if its status looks the same
+        """
+        if observed is None:
+            observed = time.time()
+        with self._cond:
+            self._set(uuid, status, observed, event)
+            self._cond.notify_all()
+
+    def _set(self, uuid, status, observed, changed):
+        # must hold self._cond. Deleted objects keep their time of change,
+        # so that listings sent before the deletion cannot bring them back.
+        if changed or self.statuses.get(uuid) != status:
+            self.changed[uuid] = observed
+        if status is None:
+            self.statuses.pop(uuid, None)
+        else:
+            self.statuses[uuid] = status
+
+    def poll(self):
+        """
+        Lists the statuses of all objects. Objects which changed after the
+        listing was sent keep their newer status.
+        """
+        observed = time.time()
+        statuses = {}
+        for client in self.clients.values():
+            for obj in client.list():
+                statuses[obj['uuid']] = obj['status']
+        with self._cond:
+            for uuid in set(self.statuses) | set(statuses):
+                if self.changed.get(uuid, 0) <= observed:
+                    self._set(uuid, statuses.get(uuid), observed, False)
+            self._cond.notify_all()
+
+    def _poll_forever(self):
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as exc:
+                LOG.warning('Listing the servers failed: %r', exc)
+
+    def _listen(self):
+        while not self._stopped.is_set():
+            try:
+                frame = self.websocket.ws.recv(timeout=1)
+            except Exception:
+                # timeouts, and errors the polling covers for
+                continue
+            match = RESOURCE_URI.search(frame.get('resource_uri') or '')
+            if not match or match.group(1) not in self.clients:
+                continue
+            uuid = match.group(2)
+            observed = time.time()
+            try:
+                obj = self.transport.api(
+                    'GET',
+                    '/{}/{}/'.format(match.group(1), uuid)
+                )
+            except errors.ClientError as exc:
+                if exc.status_code == 404:
+                    self.update(uuid, None, observed, event=True)
+                continue
+            except Exception as exc:
+                LOG.debug('Refreshing %s failed: %r', uuid, exc)
+                continue
+            self.update(uuid, obj['status'], observed, event=True)
+
+    def wait_for(self, uuid, status, timeout=None, since=None):
+        """
+        Waits until an object is in *status*, or is deleted for None.
+
+        :return: True, or False if *timeout* seconds passed first
+        """
+        return not self.wait_all([uuid], status, timeout, since=since)
+
+    def wait_all(self, uuids, status, timeout=None, on_reached=None,
+                 since=None):
+        """
+        Waits until all objects are in *status*, or are deleted for None.
+
+        :param on_reached: called with each uuid as its object gets there
+        :param since: dict of a time by uuid. An object only counts once
+            it changed after its time, so that e.g. a restarted server is
+            not taken as restarted from the status it had before. Polling
+            without a websocket misses changes which are undone between two
+            listings.
+        :return: the set of the uuids whose objects did not get there
+            within *timeout* seconds
+        """
+        pending = set(uuids)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                reached = [
+                    uuid for uuid in pending
+                    if self.statuses.get(uuid) == status and (
+                        since is None or
+                        self.changed.get(uuid, 0) >= since[uuid]
+                    )
+                ]
+                for uuid in reached:
+                    pending.discard(uuid)
+                    if on_reached:
+                        on_reached(uuid)
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if not pending or remaining is not None and remaining <= 0:
+                    return pending
+                self._cond.wait(remaining)
+
+
+class Outcome(object):
+    """
+    What happened to one server of a fleet action.
+
+    :ivar state: 'done', 'already' if the server was in the target status,
+        'failed', 'timeout' or 'skipped' after an aborted wave
+    """
+
+    def __init__(self, uuid, wave):
+        self.uuid = uuid
+        self.wave = wave
+        self.state = 'skipped'
+        self.error = None
+        self.seconds = None
+
+    @property
+    def ok(self):
+        return self.state in ('done', 'already')
+
+    def __repr__(self):
+        return '<Outcome({}, wave={}, state={}, error={!r})>'.format(
+            self.uuid,
+            self.wave,
+            self.state,
+            self.error
+        )
+
+
+class FleetReport(object):
+    """
+    The outcomes of a fleet action by server uuid, in the order of the
+    servers.
+    """
+
+    def __init__(self, action, outcomes):
+        self.action = action
+        self.outcomes = outcomes
+        self.aborted = False
+        self.seconds = None
+
+    @property
+    def ok(self):
+        return all(outcome.ok for outcome in self.outcomes.values())
+
+    @property
+    def failed(self):
+        return [
+            outcome for outcome in self.outcomes.values()
+            if outcome.state in ('failed', 'timeout')
+        ]
+
+    def summary(self):
+        """
+        :return: dict of the number of servers by state
+        """
+        return dict(Counter(
+            outcome.state for outcome in self.outcomes.values()
+        ))
+
+    def __repr__(self):
+        return '<FleetReport({}, {}, aborted={})>'.format(
+            self.action,
+            self.summary(),
+            self.aborted
+        )
+
+
+def make_waves(uuids, canary=0, wave_size=None):
+    """
+    :return: list of the waves, lists of uuids
+    """
+    uuids = list(uuids)
+    waves = []
+    if canary:
+        waves.append(uuids[:canary])
+        uuids = uuids[canary:]
+    wave_size = wave_size or len(uuids)
+    for index in range(0, len(uuids), wave_size or 1):
+        waves.append(uuids[index:index + wave_size])
+    return waves
+
+
+class Fleet(object):
+    """
+    Runs lifecycle actions on many servers.
+    """
+
+    def __init__(self, rate=10, n_threads=32, timeout=600,
+                 retry_policy=None, watcher=None, ws_endpoint=None,
+                 **kwargs):
+        """
+        :param rate:
+            Maximum action requests per second. None for no limit.
+        :param n_threads:
+            Number of action requests sent at once.
+        :param timeout:
+            Seconds the servers of a wave may take to reach their target
+            status, after the requests of the wave were sent.
+        :param retry_policy:
+            A :class:`cloudsigma.scheduler.RetryPolicy` for the action
+            requests. Conflicts and throttling are retried.
+        :param watcher:
+            A started :class:`StatusWatcher` to share, e.g. between fleets.
+            By default every run starts its own.
+        :param ws_endpoint:
+            The websocket of the api_endpoint, for the watcher.
+        :param kwargs:
+            The client arguments, like api_endpoint.
+        """
+        self.bucket = TokenBucket(rate, burst=rate)
+        self.n_threads = n_threads
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=3)
+        self.watcher = watcher
+        self.ws_endpoint = ws_endpoint
+        self.client_kwargs = kwargs
+        self.server = resource.Server(**kwargs)
+
+    def run(self, action, uuids, canary=0, wave_size=None, max_failures=0,
+            wait=True):
+        """
+        :param action: 'start', 'stop', 'shutdown' or 'restart'
+        :param uuids: the servers
+        :param canary: number of servers acted on in a first wave of their
+            own
+        :param wave_size: servers per wave after the canary. Default is
+            all.
+        :param max_failures: failures a wave may have before the run stops
+        :param wait: wait for the servers to reach their target status.
+            Without waiting, a wave is done when its requests are accepted.
+        :return: a :class:`FleetReport`
+        """
+        if action not in TARGET_STATUS:
+            raise ValueError('Unknown action {!r}'.format(action))
+        waves = make_waves(uuids, canary, wave_size)
+        report = FleetReport(action, OrderedDict(
+            (uuid, Outcome(uuid, index))
+            for index, wave in enumerate(waves) for uuid in wave
+        ))
+        started = time.time()
+
+        watcher = self.watcher
+        if watcher is None and wait:
+            watcher = StatusWatcher(
+                ws_endpoint=self.ws_endpoint,
+                **self.client_kwargs
+            ).start()
+        transport = Transport(self.server.c, pool_size=self.n_threads)
+        try:
+            for index, wave in enumerate(waves):
+                self._run_wave(
+                    action,
+                    wave,
+                    report,
+                    transport,
+                    watcher if wait else None
+                )
+                failures = sum(
+                    1 for uuid in wave if not report.outcomes[uuid].ok
+                )
+                LOG.info(
+                    '%s wave %d of %d: %d servers, %d failed',
+                    action,
+                    index + 1,
+                    len(waves),
+                    len(wave),
+                    failures
+                )
+                if failures > max_failures and index < len(waves) - 1:
+                    LOG.error(
+                        'Stopping the %s after %d failures in wave %d',
+                        action,
+                        failures,
+                        index + 1
+                    )
+                    report.aborted = True
+                    break
+        finally:
+            transport.close()
+            if watcher is not None and watcher is not self.watcher:
+                watcher.stop()
+        report.seconds = time.time() - started
+        return report
+
+    def _run_wave(self, action, wave, report, transport, watcher):
+        # the workers only send the requests, the servers of the wave are
+        # then waited for together
+        target = TARGET_STATUS[action]
+        requested = {}
+
+        def act(uuid):
+            if watcher is not None and action != 'restart' and \
+                    watcher.statuses.get(uuid) == target:
+                report.outcomes[uuid].state = 'already'
+                return
+            self.bucket.consume(1)
+            sent = time.time()
+            transport.api(
+                'POST',
+                '/servers/{}/action/'.format(uuid),
+                data={},
+                query_params={'do': action}
+            )
+            requested[uuid] = sent
+
+        def on_failure(uuid, exc, retrying):
+            report.outcomes[uuid].error = exc
+            if not retrying:
+                report.outcomes[uuid].state = 'failed'
+
+        def on_reached(uuid):
+            outcome = report.outcomes[uuid]
+            outcome.state = 'done'
+            outcome.seconds = time.time() - requested[uuid]
+
+        TaskScheduler(
+            act,
+            n_threads=min(self.n_threads, len(wave)) or 1,
+            retry_policy=self.retry_policy,
+            abort_on_fatal=False,
+            on_failure=on_failure,
+            name='fleet'
+        ).run(wave)
+
+        if watcher is None:
+            for uuid in requested:
+                on_reached(uuid)
+            return
+        # only statuses read after the requests were sent count, a restart
+        # is not done while the server still runs from before it
+        for uuid in watcher.wait_all(
+                requested,
+                target,
+                self.timeout,
+                on_reached=on_reached,
+                since=requested):
+            outcome = report.outcomes[uuid]
+            outcome.state = 'timeout'
+            outcome.error = FatalError(
+                'Not {} after {}s'.format(target, self.timeout)
+            )
+
+    def start(self, uuids, **kwargs):
+        return self.run('start', uuids, **kwargs)
+
+    def stop(self, uuids, **kwargs):
+        return self.run('stop', uuids, **kwargs)
+
+    def shutdown(self, uuids, **kwargs):
+        return self.run('shutdown', uuids, **kwargs)
+
+    def restart(self, uuids, **kwargs):
+        return self.run('restart', uuids, **kwargs)
@@ -1,19 +1,27 @@
 from __future__ import division
 from . import errors
 from .conf import config
+from .json_codec import get_json_codec
+from .models import to_models
 from websocket import create_connection
 from past.utils import old_div
-import simplejson
 import requests
-import copy
 import logging
 import sys
+import threading
 from builtins import object
 from builtins import str
 from future import standard_library
 standard_library.install_aliases()
 
 
+if sys.version_info >= (3, 3):
+    from urllib.parse import parse_qsl, unquote, urljoin, urlparse, \
+        urlunparse
+else:
+    from urlparse import parse_qsl, unquote, urljoin, urlparse, urlunparse
+
+
 LOG = logging.getLogger(__name__)
 
 
@@ -32,36 +40,93 @@ def wrap_with_log_hook(log_level, next_hook=None):
         return next_hook
 
     def log_hook(response, *args, **kwargs):
-        request = response.request
-
-        req_msg = '-----RECONSTRUCTED-REQUEST:\n{req.method} {req.path_url} ' \
-                  'HTTP/1.1\r\n{headers}\r\n\r\n{body}\n-----' \
-                  'RECONSTRUCTED-REQUEST-END'.format(
-                      req=request,
-                      headers='\r\n'.join(
-                          '{}: {}'.format(k, v) for k, v in list(
-                              request.headers.items())
-                      ),
-                      body=request.body if request.body else ''
-                  )
-
-        resp_msg = '-----RECONSTRUCTED-RESPONSE:\nHTTP/1.1' \
-                   ' {resp.status_code}' \
-                   ' {resp.reason}\r\n{headers}\r\n\r\n{body}' \
-                   '\n-----RECONSTRUCTED-RESPONSE-END'.format(
-                       resp=response,
-                       headers='\r\n'.join(
-                           '{}: {}'.format(k, v) for k, v in list(
-                               response.headers.items())
-                       ),
-                       body=response.content if response.content else ''
-                   )
-        LOG.log(level, '{}\n\n{}'.format(req_msg, resp_msg))
-
+        # formatting copies the bodies, only do it if the record is emitted
+        if LOG.isEnabledFor(level):
+            LOG.log(level, format_exchange(response))
         next_hook(response, *args, **kwargs)
     return log_hook
 
 
+def format_exchange(response):
+    """
+    Reconstructs the raw HTTP request and response for the debug log.
+    """
+    request = response.request
+
+    req_msg = '-----RECONSTRUCTED-REQUEST:\n{req.method} {req.path_url} ' \
+              'HTTP/1.1\r\n{headers}\r\n\r\n{body}\n-----' \
+              'RECONSTRUCTED-REQUEST-END'.format(
+                  req=request,
+                  headers='\r\n'.join(
+                      '{}: {}'.format(k, v) for k, v in list(
+                          request.headers.items())
+                  ),
+                  body=request.body if request.body else ''
+              )
+
+    resp_msg = '-----RECONSTRUCTED-RESPONSE:\nHTTP/1.1' \
+               ' {resp.status_code}' \
+               ' {resp.reason}\r\n{headers}\r\n\r\n{body}' \
+               '\n-----RECONSTRUCTED-RESPONSE-END'.format(
+                   resp=response,
+                   headers='\r\n'.join(
+                       '{}: {}'.format(k, v) for k, v in list(
+                           response.headers.items())
+                   ),
+                   body=response.content if response.content else ''
+               )
+    return '{}\n\n{}'.format(req_msg, resp_msg)
+
+
+class SingleFlight(object):
+    """
+    Runs concurrent calls with the same key once. The calls arriving while
+    one is in flight wait for it and share its result or exception.
+
+    :ivar shared: number of calls which got the result of another call
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
 class GenericClient(object):
     """
     Handles all low level HTTP, authentication, parsing and error handling.
@@ -74,6 +139,8 @@ class GenericClient(object):
         LOGIN_METHOD_SESSION,
         LOGIN_METHOD_NONE,
     )
+    # Maximum number of resolved URLs remembered by _get_full_url
+    url_cache_size = 4096
 
     def __init__(
             self,
@@ -81,8 +148,39 @@ class GenericClient(object):
             username=None,
             password=None,
             login_method=LOGIN_METHOD_BASIC,
-            request_log_level=None
+            request_log_level=None,
+            json_codec=None,
+            coalesce_gets=None
     ):
+        """
+        :param json_codec:
+            A codec from :mod:`cloudsigma.json_codec`, or the name of one,
+            for the request and response bodies. Defaults to the
+            *json_codec* config option or the fastest available codec.
+        :param coalesce_gets:
+            Let a GET wait for an identical GET of this client in flight in
+            another thread, and share its response, instead of sending it
+            again. The shared response may have been requested a moment
+            before the call, but never before a PUT, POST or DELETE of this
+            client which completed before the call. Off by default, or set
+            by the *coalesce_gets* config option. GETs with a response hook
+            or request logging are always sent.
+        """
+        self.json = get_json_codec(json_codec or config.get('json_codec'))
+        if coalesce_gets is None:
+            coalesce_gets = config.as_bool('coalesce_gets') \
+                if 'coalesce_gets' in config else False
+        self.coalesce_gets = coalesce_gets
+        self.single_flight = SingleFlight()
+        # counts the writes, so GETs started after a write do not share the
+        # response of a GET started before it
+        self._writes = 0
+        self._url_cache = {}
+        self._req_args = None
+        self._req_args_key = None
+        self._hooks = None
+        self._response_hook = None
+        self._request_log_level = None
         self.api_endpoint = api_endpoint if api_endpoint \
             else config['api_endpoint']
         self.username = username if username else config['username']
@@ -96,8 +194,6 @@ class GenericClient(object):
         self.response_hook = None
         self.request_log_level = request_log_level if request_log_level else \
             config.get('request_log_level', None)
-        if self.request_log_level:
-            self.request_log_level = self.request_log_level.upper()
 
         if login_method == self.LOGIN_METHOD_SESSION:
             self._login_session()
@@ -107,7 +203,7 @@ class GenericClient(object):
         self._session = requests.Session()
         full_url = self._get_full_url('/accounts/action/')
         kwargs = self._get_req_args(query_params={'do': 'login'})
-        data = simplejson.dumps(
+        data = self.json.dumps(
             {
                 "username": self.username,
                 "password": self.password
@@ -123,11 +219,34 @@ class GenericClient(object):
             }
         )
 
+    @property
+    def api_endpoint(self):
+        return self._api_endpoint
+
+    @api_endpoint.setter
+    def api_endpoint(self, api_endpoint):
+        self._api_endpoint = api_endpoint
+        self._parsed_endpoint = None
+        self._url_cache.clear()
+
     def _get_full_url(self, url):
-        urlparse = get_urlparse()
-        urlunparse = get_urlunparse()
-        urljoin = get_urljoin()
-        api_endpoint = urlparse(self.api_endpoint)
+        # Runs for every request, so resolved URLs are remembered. The cache
+        # is dropped when full, URLs with uuids would grow it without bound.
+        try:
+            return self._url_cache[url]
+        except KeyError:
+            pass
+        full_url = self._resolve_url(url)
+        if len(self._url_cache) >= self.url_cache_size:
+            self._url_cache.clear()
+        self._url_cache[url] = full_url
+        return full_url
+
+    def _resolve_url(self, url):
+        api_endpoint = self._parsed_endpoint
+        if api_endpoint is None:
+            api_endpoint = urlparse(self.api_endpoint)
+            self._parsed_endpoint = api_endpoint
         if url.startswith(api_endpoint.path):
             full_url = list(api_endpoint)
             full_url[2] = url
@@ -143,15 +262,21 @@ class GenericClient(object):
 
         return full_url
 
-    def _process_response(self, resp, return_list=False):
+    def _process_response(self, resp, return_list=False, model=None,
+                          compact=False):
         resp_data = None
         request_id = resp.headers.get('X-REQUEST-ID', None)
         if resp.status_code in (200, 201, 202):
-            resp_data = copy.deepcopy(resp.json())
+            # a freshly decoded document, nothing else refers to it
+            resp_data = self.json.loads(resp.content)
             if 'objects' in resp_data:
                 resp_data = resp_data['objects']
+                if model is not None:
+                    to_models(model, resp_data, compact=compact)
                 if len(resp_data) == 1 and not return_list:
                     resp_data = resp_data[0]
+            elif model is not None and isinstance(resp_data, dict):
+                resp_data = to_models(model, [resp_data], compact=compact)[0]
         elif resp.status_code == 401:
             raise errors.AuthError(request_id, status_code=resp.status_code)
         elif resp.status_code == 403:
@@ -175,27 +300,55 @@ class GenericClient(object):
 
         return resp_data
 
-    def _get_req_args(self, body=None, query_params=None):
-        kwargs = {}
-        if self.login_method == self.LOGIN_METHOD_BASIC:
-            kwargs['auth'] = (self.username, self.password)
+    @property
+    def response_hook(self):
+        return self._response_hook
 
-        kwargs['headers'] = {
-            'content-type': 'application/json',
-            'user-agent': 'CloudSigma turlo client',
-        }
+    @response_hook.setter
+    def response_hook(self, response_hook):
+        self._response_hook = response_hook
+        self._hooks = None
 
+    @property
+    def request_log_level(self):
+        return self._request_log_level
+
+    @request_log_level.setter
+    def request_log_level(self, request_log_level):
+        self._request_log_level = request_log_level.upper() \
+            if request_log_level else request_log_level
+        self._hooks = None
+
+    def _get_req_args(self, body=None, query_params=None):
+        # The arguments only change with the credentials and the hooks, so
+        # they are built once and copied for every request. The headers and
+        # hooks dicts are shared and must not be modified by the caller.
+        key = (self.login_method, self.username, self.password)
+        if self._req_args_key != key:
+            req_args = {
+                'headers': {
+                    'content-type': 'application/json',
+                    'user-agent': 'CloudSigma turlo client',
+                },
+            }
+            if self.login_method == self.LOGIN_METHOD_BASIC:
+                req_args['auth'] = (self.username, self.password)
+            self._req_args = req_args
+            self._req_args_key = key
+
+        kwargs = dict(self._req_args)
         if query_params:
-            if 'params' not in kwargs:
-                kwargs['params'] = {}
-            kwargs['params'].update(query_params)
-
-        kwargs['hooks'] = {
-            'response': wrap_with_log_hook(
-                self.request_log_level,
-                self.response_hook
-            )
-        }
+            kwargs['params'] = dict(query_params)
+
+        if self._hooks is None:
+            self._hooks = {}
+            if self._request_log_level or self._response_hook:
+                self._hooks['response'] = wrap_with_log_hook(
+                    self._request_log_level,
+                    self._response_hook
+                )
+        if self._hooks:
+            kwargs['hooks'] = self._hooks
 
         return kwargs
 
@@ -205,42 +358,85 @@ class GenericClient(object):
             return self._session
         return requests
 
-    def get(self, url, query_params=None, return_list=False):
+    def get(self, url, query_params=None, return_list=False, model=None,
+            compact=False):
+        """
+        :param model:
+            A :class:`cloudsigma.models.Record` class to decode the objects
+            of the response into. Default is plain dicts.
+        :param compact:
+            Materialize the nested values of the models right away.
+        """
         kwargs = self._get_req_args(query_params=query_params)
-        self.resp = self.http.get(self._get_full_url(url), **kwargs)
-        return self._process_response(self.resp, return_list)
+        full_url = self._get_full_url(url)
+        if self.coalesce_gets and 'hooks' not in kwargs:
+            # every caller decodes the shared response itself, so they do
+            # not share the decoded objects
+            resp = self.single_flight.do(
+                self._flight_key(full_url, query_params),
+                lambda: self.http.get(full_url, **kwargs)
+            )
+        else:
+            resp = self.http.get(full_url, **kwargs)
+        self.resp = resp
+        return self._process_response(
+            resp,
+            return_list,
+            model=model,
+            compact=compact
+        )
+
+    def _flight_key(self, full_url, query_params):
+        query = tuple(sorted(
+            (str(name), str(value))
+            for name, value in (query_params or {}).items()
+        ))
+        return full_url, query, self._writes
 
     def put(self, url, data, query_params=None, return_list=False):
         kwargs = self._get_req_args(body=data, query_params=query_params)
-        self.resp = self.http.put(
+        self.resp = self._write(
+            self.http.put,
             self._get_full_url(url),
-            data=simplejson.dumps(data),
+            data=self.json.dumps(data),
             **kwargs
         )
         return self._process_response(self.resp, return_list)
 
     def post(self, url, data, query_params=None, return_list=False):
         kwargs = self._get_req_args(body=data, query_params=query_params)
-        self.resp = self.http.post(
+        self.resp = self._write(
+            self.http.post,
             self._get_full_url(url),
-            data=simplejson.dumps(data),
+            data=self.json.dumps(data),
             **kwargs
         )
         return self._process_response(self.resp, return_list)
 
     def delete(self, url, query_params=None):
-        self.resp = self.http.delete(
+        self.resp = self._write(
+            self.http.delete,
             self._get_full_url(url),
             **self._get_req_args(query_params=query_params)
         )
         return self._process_response(self.resp)
 
+    def _write(self, method, full_url, **kwargs):
+        # counted before and after, so GETs started after the write share
+        # no response with GETs started before or during it
+        self._writes += 1
+        try:
+            return method(full_url, **kwargs)
+        finally:
+            self._writes += 1
+
 
 class WebsocketClient(object):
 
-    def __init__(self, cookie, timeout=10):
+    def __init__(self, cookie, timeout=10, json_codec=None, ws_endpoint=None):
+        self.json = get_json_codec(json_codec or config.get('json_codec'))
         self.conn = create_connection(
-            config['ws_endpoint'],
+            ws_endpoint or config['ws_endpoint'],
             timeout=timeout,
             header=['Cookie: async_auth=%s' % (cookie,)]
         )
@@ -256,7 +452,7 @@ class WebsocketClient(object):
             finally:
                 self.conn.settimeout(old_timeout)
         if not return_raw:
-            ret = simplejson.loads(ret)
+            ret = self.json.loads(ret)
         return ret
 
 
@@ -276,46 +472,20 @@ def get_client():
 
 
 def get_urlparse():
-    if sys.version_info >= (3, 3):
-        from urllib.parse import urlparse
-    else:
-        from urlparse import urlparse
     return urlparse
 
 
 def get_urljoin():
-    if sys.version_info >= (3, 3):
-        from urllib.parse import urljoin
-    else:
-        from urlparse import urljoin
     return urljoin
 
 
 def get_urlunparse():
-    if sys.version_info >= (3, 3):
-        from urllib.parse import urlunparse
-    else:
-        from urlparse import urlunparse
     return urlunparse
 
 
 def get_unquote():
-    if sys.version_info >= (3, 3):
-        from urllib.parse import unquote
-    else:
-        from urlparse import unquote
     return unquote
 
 
 def get_parse_qsl():
-    if sys.version_info >= (3, 3):
-        from urllib.parse import parse_qsl
-    else:
-        from urlparse import parse_qsl
     return parse_qsl
-
-
-
-
-
-
@@ -0,0 +1,265 @@
+"""
+A local SQLite store of the history of time-indexed resources, like the
+ledger and the audit logs, so recurring reports only download what is new.
+
+The store remembers per account and resource the time range it has
+synchronized. A sync fetches only the parts of the requested range outside
+of it, starting a little before its end to pick up entries which were
+recorded late, and entries already stored are skipped. The entries are
+indexed by time for local queries.
+
+Usage::
+
+    store = HistoryStore()
+    store.sync(Ledger(), start=datetime(2020, 1, 1))
+    for entry in store.query(Ledger(), start=datetime(2020, 2, 1)):
+        print(entry['time'], entry['amount'])
+"""
+from builtins import object
+import hashlib
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from logging import getLogger
+
+from .conf import config
+from .json_codec import get_json_codec
+from .timeline import EPOCH, to_datetime, to_microseconds
+
+LOG = getLogger(__name__)
+
+DEFAULT_HISTORY_PATH = os.path.join(
+    os.path.expanduser('~'),
+    '.cloudsigma',
+    'history.sqlite'
+)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS entries (
+        account TEXT NOT NULL,
+        resource TEXT NOT NULL,
+        key TEXT NOT NULL,
+        time INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (account, resource, key)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS entries_time
+    ON entries (account, resource, time)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS synced (
+        account TEXT NOT NULL,
+        resource TEXT NOT NULL,
+        start INTEGER NOT NULL,
+        end INTEGER NOT NULL,
+        PRIMARY KEY (account, resource)
+    )
+    """,
+]
+
+
+# the fields identifying the entries without an id, by resource name. The
+# uuid of a usage is the one of the billed server or drive, which has a usage
+# per resource and poll.
+ENTRY_KEYS = {
+    'usage': ('uuid', 'resource', 'poll_time'),
+}
+
+
+def from_microseconds(microseconds):
+    return EPOCH + timedelta(microseconds=microseconds)
+
+
+def account_of(resource):
+    """
+    The account of a resource client, by its user and API endpoint.
+    """
+    return '{}@{}'.format(resource.c.username, resource.c.api_endpoint)
+
+
+class HistoryStore(object):
+    """
+    Entries of time-indexed resources in an SQLite database.
+    """
+    # entries inserted per transaction while syncing
+    batch_size = 1000
+
+    def __init__(self, path=None, overlap=timedelta(minutes=15),
+                 json_codec=None):
+        """
+        :param path:
+            The database file. Defaults to the *history_path* config option
+            or ~/.cloudsigma/history.sqlite. ':memory:' keeps the store in
+            memory.
+        :param overlap:
+            How far before the end of the synchronized range a sync starts
+            fetching, for entries recorded after their time.
+        """
+        self.path = path or config.get('history_path', DEFAULT_HISTORY_PATH)
+        self.overlap = overlap
+        self.json = get_json_codec(json_codec)
+        directory = os.path.dirname(self.path)
+        if self.path != ':memory:' and directory and \
+                not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(self.path)
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+    def close(self):
+        self.db.close()
+
+    def synced_range(self, resource, account=None):
+        """
+        :return: tuple of the start and the end of the synchronized range,
+            or None if the resource was never synchronized
+        """
+        row = self.db.execute(
+            'SELECT start, end FROM synced WHERE account = ? AND resource = ?',
+            (account or account_of(resource), resource.resource_name)
+        ).fetchone()
+        if row is None:
+            return None
+        return from_microseconds(row[0]), from_microseconds(row[1])
+
+    def high_water_mark(self, resource, account=None):
+        """
+        :return: the end of the synchronized range, or None
+        """
+        synced = self.synced_range(resource, account)
+        return synced[1] if synced else None
+
+    def sync(self, resource, start=None, end=None, **kwargs):
+        """
+        Fetches the entries of [*start*, *end*) which are not stored yet.
+
+        :param resource:
+            A resource with a time_field, like a
+            :class:`cloudsigma.resource.Ledger`.
+        :param start:
+            Needed for the first sync. Later syncs continue from the end of
+            the synchronized range, and only fetch before its start if
+            *start* is earlier.
+        :param end:
+            Defaults to now.
+        :param kwargs:
+            Options of :meth:`cloudsigma.resource.ResourceBase.list_range`.
+        :return: the number of new entries
+        """
+        account = account_of(resource)
+        end = to_datetime(end or datetime.utcnow())
+        synced = self.synced_range(resource, account)
+        if synced is None:
+            if start is None:
+                raise ValueError(
+                    'The first sync of {} needs a start time'.format(
+                        resource.resource_name
+                    )
+                )
+            ranges = [(to_datetime(start), end)]
+            synced_start = synced_end = to_datetime(start)
+        else:
+            synced_start, synced_end = synced
+            ranges = []
+            if start is not None and to_datetime(start) < synced_start:
+                ranges.append((to_datetime(start), synced_start))
+            if end > synced_end:
+                ranges.append((synced_end - self.overlap, end))
+
+        added = 0
+        for range_start, range_end in ranges:
+            added += self._fetch(
+                resource,
+                account,
+                range_start,
+                range_end,
+                kwargs
+            )
+        # the range is recorded after its entries, so an interrupted sync
+        # fetches them again
+        synced_start = min([synced_start] + [r[0] for r in ranges])
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO synced VALUES (?, ?, ?, ?)',
+                (
+                    account,
+                    resource.resource_name,
+                    to_microseconds(synced_start),
+                    to_microseconds(max(synced_end, end)),
+                )
+            )
+        LOG.info(
+            'Synced %d new %s entries of %s',
+            added,
+            resource.resource_name,
+            account
+        )
+        return added
+
+    def _fetch(self, resource, account, start, end, kwargs):
+        time_field = resource.time_field
+        added = 0
+        batch = []
+        for entry in resource.list_range(start, end, **kwargs):
+            batch.append((
+                account,
+                resource.resource_name,
+                entry_key(entry, self.json, resource.resource_name),
+                to_microseconds(entry[time_field]),
+                self.json.dumps(entry),
+            ))
+            if len(batch) >= self.batch_size:
+                added += self._insert(batch)
+                batch = []
+        if batch:
+            added += self._insert(batch)
+        return added
+
+    def _insert(self, rows):
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            return self.db.total_changes - before
+
+    def query(self, resource, start=None, end=None, account=None):
+        """
+        Yields the stored entries of [*start*, *end*) in time order, without
+        fetching anything.
+        """
+        sql = 'SELECT data FROM entries WHERE account = ? AND resource = ?'
+        params = [account or account_of(resource), resource.resource_name]
+        if start is not None:
+            sql += ' AND time >= ?'
+            params.append(to_microseconds(start))
+        if end is not None:
+            sql += ' AND time < ?'
+            params.append(to_microseconds(end))
+        for row in self.db.execute(sql + ' ORDER BY time', params):
+            yield self.json.loads(bytes(row[0]))
+
+    def count(self, resource, account=None):
+        return self.db.execute(
+            'SELECT COUNT(*) FROM entries WHERE account = ? AND resource = ?',
+            (account or account_of(resource), resource.resource_name)
+        ).fetchone()[0]
+
+
+def entry_key(entry, json_codec, resource_name=None):
+    """
+    Identifies an entry by its id, by the fields of :data:`ENTRY_KEYS` for
+    its resource, or by its content. The uuid of an entry may be the one of
+    the object it is about, so it is no key on its own.
+    """
+    if entry.get('id') is not None:
+        return str(entry['id'])
+    fields = ENTRY_KEYS.get(resource_name)
+    if fields and all(entry.get(field) is not None for field in fields):
+        return '/'.join(str(entry[field]) for field in fields)
+    return hashlib.sha1(json_codec.dumps(entry)).hexdigest()
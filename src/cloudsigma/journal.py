@@ -0,0 +1,178 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from builtins import object
+
+from .conf import config
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_JOURNAL_DIR = os.path.join(
+    os.path.expanduser('~'),
+    '.cloudsigma',
+    'journal'
+)
+
+
+class ChunkJournal(object):
+    """
+    An append-only on-disk record of the chunks of a transfer which are known
+    to be complete.
+
+    The journal is keyed by everything that makes a chunk number meaningful
+    (the local file, its size and modification time, the drive and the chunk
+    size), so a journal is only ever reused for exactly the same transfer.
+    The file starts with a JSON header describing the key, followed by one
+    completed chunk number per line. A truncated last line, as left by a
+    killed process, is ignored on load.
+    """
+
+    def __init__(self, key, journal_dir=None):
+        """
+        :param key:
+            A tuple identifying the transfer. Must be JSON serializable.
+        :param journal_dir:
+            Directory for the journal files. Defaults to the *journal_dir*
+            config option or ~/.cloudsigma/journal
+        """
+        self.key = list(key)
+        self.journal_dir = journal_dir or config.get(
+            'journal_dir',
+            DEFAULT_JOURNAL_DIR
+        )
+        digest = hashlib.sha1(
+            json.dumps(self.key).encode('utf-8')
+        ).hexdigest()
+        self.path = os.path.join(self.journal_dir, digest + '.journal')
+        self._lock = threading.Lock()
+        self._fh = None
+        self._completed = self._load()
+
+    @classmethod
+    def for_upload(
+            cls,
+            image_path,
+            drive_uuid,
+            chunk_size,
+            protocol,
+            journal_dir=None
+    ):
+        """
+        Creates the journal for uploading *image_path* to *drive_uuid*.
+
+        :param protocol:
+            Name of the upload protocol. Chunk numbering differs between
+            protocols, so it is part of the key.
+        """
+        stat = os.stat(image_path)
+        key = (
+            'upload',
+            protocol,
+            os.path.abspath(image_path),
+            stat.st_size,
+            int(stat.st_mtime),
+            drive_uuid,
+            chunk_size,
+        )
+        return cls(key, journal_dir=journal_dir)
+
+    @classmethod
+    def for_download(
+            cls,
+            drive_uuid,
+            drive_size,
+            target_path,
+            chunk_size,
+            journal_dir=None
+    ):
+        """
+        Creates the journal for downloading *drive_uuid* into *target_path*.
+        """
+        key = (
+            'download',
+            drive_uuid,
+            drive_size,
+            os.path.abspath(target_path),
+            chunk_size,
+        )
+        return cls(key, journal_dir=journal_dir)
+
+    def _load(self):
+        completed = set()
+        if not os.path.exists(self.path):
+            return completed
+
+        with open(self.path, 'r') as f:
+            header = f.readline()
+            try:
+                if json.loads(header) != self.key:
+                    LOG.warning(
+                        'Journal {} belongs to a different transfer, '
+                        'ignoring it'.format(self.path)
+                    )
+                    return completed
+            except ValueError:
+                LOG.warning('Corrupt journal header in {}'.format(self.path))
+                return completed
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    completed.add(int(line))
+                except ValueError:
+                    break
+        return completed
+
+    @property
+    def exists(self):
+        """
+        True if a previous run left records for this transfer.
+        """
+        return bool(self._completed)
+
+    @property
+    def completed(self):
+        with self._lock:
+            return frozenset(self._completed)
+
+    def is_done(self, chunk_number):
+        return chunk_number in self._completed
+
+    def mark_done(self, chunk_number):
+        with self._lock:
+            if chunk_number in self._completed:
+                return
+            if self._fh is None:
+                self._open_for_append()
+            self._fh.write('{}\n'.format(chunk_number))
+            self._fh.flush()
+            self._completed.add(chunk_number)
+
+    def _open_for_append(self):
+        if not os.path.isdir(self.journal_dir):
+            os.makedirs(self.journal_dir)
+        # Rewrite whatever was loaded instead of appending to the old file, so
+        # a truncated last line cannot get glued to the next record.
+        self._fh = open(self.path, 'w')
+        self._fh.write(json.dumps(self.key) + '\n')
+        for chunk_number in sorted(self._completed):
+            self._fh.write('{}\n'.format(chunk_number))
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def discard(self):
+        """
+        Removes the journal. Called once the transfer has finished.
+        """
+        self.close()
+        with self._lock:
+            self._completed = set()
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,136 @@
+"""
+JSON codecs for the API requests and responses.
+
+Decoding large list responses is the main CPU cost of the client, so the
+fastest available library is used: orjson, then ujson, then simplejson,
+which is always installed. Set the *json_codec* config option or the
+GenericClient *json_codec* argument to pick one.
+
+All codecs decode from and encode to UTF-8 bytes. An object the fast
+library cannot encode, e.g. a Decimal or an integer beyond 64 bits, is
+passed on to simplejson, and so is a document it fails to decode, so the
+codecs give the same results. The exception is orjson decoding integers
+beyond 64 bits as floats, which the API does not send.
+"""
+from builtins import object
+
+import simplejson
+from past.builtins import basestring
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def encode_default(obj):
+    """
+    Encodes objects with a to_dict method, like the records of
+    :mod:`cloudsigma.models`, as their dicts.
+    """
+    to_dict = getattr(obj, 'to_dict', None)
+    if to_dict is None:
+        raise TypeError(
+            'Object of type {} is not JSON serializable'.format(
+                obj.__class__.__name__
+            )
+        )
+    return to_dict()
+
+
+class SimplejsonCodec(object):
+    name = 'simplejson'
+
+    def loads(self, data):
+        return simplejson.loads(data)
+
+    def dumps(self, obj):
+        return simplejson.dumps(obj, default=encode_default).encode(
+            'utf-8'
+        )
+
+
+class OrjsonCodec(SimplejsonCodec):
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('The orjson codec needs orjson')
+
+    def loads(self, data):
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # simplejson raises the error if the document is invalid
+            return simplejson.loads(data)
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj, default=encode_default)
+        except TypeError:
+            return SimplejsonCodec.dumps(self, obj)
+
+
+class UjsonCodec(SimplejsonCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        if ujson is None:
+            raise ImportError('The ujson codec needs ujson')
+
+    def loads(self, data):
+        try:
+            return ujson.loads(data)
+        except ValueError:
+            return simplejson.loads(data)
+
+    def dumps(self, obj):
+        try:
+            return ujson.dumps(
+                obj,
+                ensure_ascii=False,
+                escape_forward_slashes=False,
+                default=encode_default
+            ).encode('utf-8')
+        except (TypeError, OverflowError):
+            return SimplejsonCodec.dumps(self, obj)
+
+
+# in order of preference
+CODECS = [
+    (OrjsonCodec.name, OrjsonCodec, orjson),
+    (UjsonCodec.name, UjsonCodec, ujson),
+    (SimplejsonCodec.name, SimplejsonCodec, simplejson),
+]
+
+
+def available_codecs():
+    """
+    :return: names of the codecs which can be used, fastest first
+    """
+    return [name for name, _, module in CODECS if module is not None]
+
+
+def get_json_codec(codec=None):
+    """
+    :param codec:
+        A codec instance, or the name of one. None picks the fastest
+        available codec.
+    :return: a codec instance
+    """
+    if codec is not None and not isinstance(codec, basestring):
+        return codec
+    for name, codec_class, module in CODECS:
+        if codec in (None, name) and module is not None:
+            return codec_class()
+    raise ValueError(
+        'Unknown or unavailable JSON codec {!r}, use one of {}'.format(
+            codec,
+            ', '.join(available_codecs())
+        )
+    )
@@ -0,0 +1,509 @@
+"""
+Compact model objects for API resources.
+
+Resources are plain dicts by default. For large inventories the typed
+models generated from a resource's schema hold the same data in less
+memory: the fields of a model are ``__slots__``, so objects carry no
+per-object dict, and equal short strings are shared between the objects of
+a response. Nested dicts and lists stay as decoded until they are first
+accessed. They are then turned into records, slotted objects of the same
+shape, whose classes are cached by their keys. Compact models materialize
+all nested values right away and take the least memory, less than half of
+the dicts for a list of servers.
+
+Models and records behave like dicts (``server['name']``, ``get``,
+``keys``, ``items``, ``in``, ``==`` with dicts, ...) and also allow
+attribute access (``server.name``). Keys which are not valid Python
+identifiers, or which are not in the schema, are kept in a small overflow
+dict and can only be accessed as items. :meth:`Record.to_dict` converts
+back to plain dicts.
+
+Usage::
+
+    servers = Server().list_detail(models='compact')
+    for server in servers:
+        print(server.name, server.nics[0].mac)
+"""
+import keyword
+import re
+import threading
+from builtins import object
+
+from past.builtins import basestring
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+# schema types whose values are nested objects or lists
+NESTED_TYPES = frozenset(['dict', 'list', 'related'])
+
+# prefix of the slots holding the raw values of nested fields
+RAW_PREFIX = '_raw_'
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# type of decoded JSON strings
+TEXT = type(u'')
+
+# strings up to this length are shared between the objects of a response
+SHARED_STRING_LENGTH = 64
+
+_MISSING = object()
+
+
+class NestedField(object):
+    """
+    A descriptor turning the decoded dict or list of a field into records
+    on first access.
+    """
+    __slots__ = ('name', 'slot')
+
+    def __init__(self, name, slot):
+        self.name = name
+        self.slot = slot
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = self.slot.__get__(obj, owner)
+        if value.__class__ is dict or value.__class__ is list:
+            value = materialize(value)
+            self.slot.__set__(obj, value)
+        return value
+
+    def __set__(self, obj, value):
+        self.slot.__set__(obj, value)
+
+    def __delete__(self, obj):
+        self.slot.__delete__(obj)
+
+
+class Record(object):
+    """
+    A dict-compatible object with slots for a fixed set of keys.
+
+    Subclasses are generated by :func:`make_record_class`. Their *_fields*
+    map every key to the attribute holding it.
+    """
+    __slots__ = ('_extra',)
+    _fields = {}
+    _nested = frozenset()
+    # key to the slot holding its value, the raw slot for nested keys
+    _slot_names = {}
+
+    def __init__(self, data=None, **kwargs):
+        self._extra = None
+        if data:
+            self.update(data)
+        if kwargs:
+            self.update(kwargs)
+
+    @classmethod
+    def from_dict(cls, data, strings=None, lazy=True):
+        """
+        Creates a record from a decoded dict.
+
+        :param strings:
+            A dict to share equal short strings through. Decoders make a new
+            string for every value, although statuses, URIs and the like
+            repeat in every object.
+        :param lazy:
+            Keep nested dicts and lists as they are until they are accessed.
+            Otherwise they are materialized right away.
+        """
+        record = cls.__new__(cls)
+        extra = None
+        slot_names = cls._slot_names
+        for key, value in data.items():
+            if value.__class__ is TEXT:
+                if strings is not None and \
+                        len(value) <= SHARED_STRING_LENGTH:
+                    value = strings.setdefault(value, value)
+            elif not lazy and (
+                    value.__class__ is dict or value.__class__ is list):
+                value = materialize(value, strings, lazy=False)
+            slot = slot_names.get(key)
+            if slot is None:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+            else:
+                setattr(record, slot, value)
+        record._extra = extra
+        return record
+
+    def __getitem__(self, key):
+        attribute = self._fields.get(key)
+        if attribute is None:
+            if self._extra is None:
+                raise KeyError(key)
+            return materialize_in(self._extra, key)
+        try:
+            return getattr(self, attribute)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        attribute = self._fields.get(key)
+        if attribute is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        else:
+            setattr(self, attribute, value)
+
+    def __delitem__(self, key):
+        attribute = self._fields.get(key)
+        try:
+            if attribute is None:
+                if self._extra is None:
+                    raise KeyError(key)
+                del self._extra[key]
+            else:
+                delattr(self, attribute)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key, attribute in self._fields.items():
+            if self._has(attribute):
+                yield key
+        if self._extra:
+            for key in list(self._extra):
+                yield key
+
+    def _has(self, attribute):
+        if attribute in self._nested:
+            attribute = RAW_PREFIX + attribute
+        try:
+            getattr(self, attribute)
+        except AttributeError:
+            return False
+        return True
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        attribute = self._fields.get(key)
+        if attribute is None:
+            return self._extra is not None and key in self._extra
+        return self._has(attribute)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def pop(self, key, default=_MISSING):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is _MISSING:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def update(self, other=(), **kwargs):
+        if hasattr(other, 'keys'):
+            for key in other.keys():
+                self[key] = other[key]
+        else:
+            for key, value in other:
+                self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def copy(self):
+        return self.__class__.from_dict(dict(self.items()))
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, Record)):
+            return self.to_dict() == to_plain(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<{}({!r})>'.format(self.__class__.__name__, self.to_dict())
+
+    def to_dict(self):
+        """
+        :return: the record as plain nested dicts and lists
+        """
+        return dict(
+            (key, to_plain(self._raw(key))) for key in self
+        )
+
+    def _raw(self, key):
+        # the value without materializing it
+        attribute = self._fields.get(key)
+        if attribute is None:
+            return self._extra[key]
+        if attribute in self._nested:
+            attribute = RAW_PREFIX + attribute
+        return getattr(self, attribute)
+
+    def compact(self, strings=None):
+        """
+        Materializes all nested values, which then take less memory than
+        the decoded dicts and lists.
+
+        :param strings: see :meth:`from_dict`
+        :return: the record
+        """
+        for key in self:
+            value = self._raw(key)
+            if value.__class__ is dict or value.__class__ is list:
+                self[key] = materialize(value, strings, lazy=False)
+            elif isinstance(value, (Record, RecordList)):
+                value.compact(strings)
+        return self
+
+
+MutableMapping.register(Record)
+
+
+class RecordList(list):
+    """
+    A list whose dict items were turned into records.
+    """
+    __slots__ = ()
+
+    def compact(self, strings=None):
+        for value in self:
+            if isinstance(value, (Record, RecordList)):
+                value.compact(strings)
+        return self
+
+
+def to_plain(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, dict):
+        return dict((key, to_plain(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [to_plain(item) for item in value]
+    return value
+
+
+def materialize(value, strings=None, lazy=True):
+    """
+    Turns a decoded dict into a record and the dicts in a decoded list into
+    records. Other values are returned as they are.
+
+    :param lazy:
+        Keep the nested values of the records as they are until they are
+        accessed. Otherwise all levels are materialized.
+    """
+    if value.__class__ is dict:
+        return record_class_for(value, lazy).from_dict(value, strings, lazy)
+    if value.__class__ is list:
+        return RecordList(
+            materialize(item, strings, lazy) for item in value
+        )
+    return value
+
+
+def materialize_in(container, key):
+    value = container[key]
+    if value.__class__ is dict or value.__class__ is list:
+        value = materialize(value)
+        container[key] = value
+    return value
+
+
+def is_attribute_name(key, base=Record):
+    """
+    True if *key* can be a slot of a subclass of *base*.
+    """
+    return (
+        isinstance(key, basestring) and
+        IDENTIFIER.match(key) is not None and
+        not keyword.iskeyword(key) and
+        not key.startswith(RAW_PREFIX) and
+        not hasattr(base, key)
+    )
+
+
+def make_record_class(name, fields, nested=(), base=Record, namespace=None):
+    """
+    Creates a record class.
+
+    :param fields:
+        The keys of the records, in order.
+    :param nested:
+        The keys whose values are materialized lazily.
+    :param base:
+        The base class, :class:`Record` or a subclass.
+    """
+    nested = frozenset(nested)
+    slots = []
+    field_attributes = {}
+    slot_names = {}
+    attributes = dict(namespace or {})
+    nested_attributes = set()
+    for key in fields:
+        if not is_attribute_name(key, base):
+            # kept in the overflow dict
+            continue
+        field_attributes[key] = key
+        if key in nested:
+            slot_names[key] = RAW_PREFIX + key
+            nested_attributes.add(key)
+        else:
+            slot_names[key] = key
+        slots.append(slot_names[key])
+    attributes.update({
+        '__slots__': tuple(slots),
+        '_fields': field_attributes,
+        '_slot_names': slot_names,
+        '_nested': frozenset(nested_attributes),
+    })
+    cls = type(str(name), (base,), attributes)
+    for key in nested_attributes:
+        setattr(cls, key, NestedField(key, getattr(cls, RAW_PREFIX + key)))
+    return cls
+
+
+_record_classes = {}
+_record_classes_lock = threading.Lock()
+
+
+def record_class_for(data, lazy=True):
+    """
+    :return:
+        the record class of the keys of a decoded dict. In lazy classes the
+        keys holding dicts or lists are materialized on access, the other
+        keys are plain slots.
+    """
+    nested = ()
+    if lazy:
+        nested = tuple(
+            key for key, value in data.items()
+            if value.__class__ is dict or value.__class__ is list
+        )
+    shape = (tuple(data), nested, lazy)
+    cls = _record_classes.get(shape)
+    if cls is None:
+        cls = make_record_class('Record', shape[0], nested=nested)
+        with _record_classes_lock:
+            cls = _record_classes.setdefault(shape, cls)
+    return cls
+
+
+class Model(Record):
+    """
+    Base class of the resource models generated by
+    :func:`model_from_schema`.
+
+    :cvar schema_types: the schema type of every field
+    """
+    __slots__ = ()
+    schema_types = {}
+
+    @classmethod
+    def compact_model(cls):
+        """
+        The model class with the same fields, all of them plain slots, for
+        models whose nested values are materialized right away.
+        """
+        compact = cls.__dict__.get('_compact_model')
+        if compact is None:
+            compact = make_record_class(
+                cls.__name__,
+                list(cls._fields),
+                base=Model,
+                namespace={'schema_types': cls.schema_types}
+            )
+            compact._compact_model = compact
+            cls._compact_model = compact
+        return compact
+
+
+def model_from_schema(name, schema):
+    """
+    Creates the model class of a resource from its schema, as returned by
+    :meth:`cloudsigma.resource.ResourceBase.get_schema`.
+    """
+    fields = schema.get('fields', {})
+    nested = set(
+        key for key, spec in fields.items()
+        if spec.get('type') in NESTED_TYPES
+    )
+    return make_record_class(
+        name,
+        list(fields),
+        nested=nested,
+        base=Model,
+        namespace={
+            'schema_types': dict(
+                (key, spec.get('type')) for key, spec in fields.items()
+            ),
+        }
+    )
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(resource):
+    """
+    The model class of a resource, generated from its schema on first use.
+
+    :param resource: a :class:`cloudsigma.resource.ResourceBase` instance
+    """
+    key = (resource.c.api_endpoint, resource.resource_name)
+    model = _models.get(key)
+    if model is None:
+        model = model_from_schema(
+            resource.__class__.__name__,
+            resource.get_schema()
+        )
+        with _models_lock:
+            model = _models.setdefault(key, model)
+    return model
+
+
+def to_models(model, objects, compact=False):
+    """
+    Turns a list of decoded dicts into models in place, so every dict can
+    be freed as soon as its model is made.
+
+    :param compact:
+        Materialize the nested values right away, into the
+        :meth:`Model.compact_model` of *model*.
+    :return: the list
+    """
+    strings = {}
+    if compact:
+        model = model.compact_model()
+    for index, data in enumerate(objects):
+        objects[index] = model.from_dict(data, strings, lazy=not compact)
+    return objects
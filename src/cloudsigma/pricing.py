@@ -0,0 +1,266 @@
+"""
+Local subscription pricing, instead of one SubscriptionCalculator request
+per quote.
+
+The price list and the discounts are loaded once and kept for a time to
+live. The prices are indexed by resource, level and currency, and a
+subscription is priced as::
+
+    amount * period in seconds * price / multiplier * (1 - discount)
+
+where the multiplier of a price converts its unit, e.g. GHz per month, to
+the base unit per second, and the discount is the one of the longest
+discount period not longer than the subscription period.
+
+Usage::
+
+    engine = PricingEngine(currency='CHF')
+    engine.price(2000, '1 month', 'cpu')
+    engine.price_many([
+        {'amount': 2000, 'period': '1 year', 'resource': 'cpu'},
+        {'amount': 4 * 1024 ** 3, 'period': '1 year', 'resource': 'mem'},
+    ])
+"""
+from builtins import object
+import bisect
+import re
+import threading
+import time
+from decimal import Decimal
+from logging import getLogger
+
+from . import resource
+from .conf import config
+from .transport import Transport
+
+LOG = getLogger(__name__)
+
+PERIOD_UNITS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+    'week': 7 * 86400,
+    'month': 30 * 86400,
+    'year': 365 * 86400,
+}
+
+PERIOD = re.compile(r'^\s*(\d+)\s*([a-z]+?)s?\s*$')
+
+
+def period_seconds(period):
+    """
+    :param period: a period like '1 month' or '3 years', or seconds
+    :return: the length of the period in seconds
+    """
+    if isinstance(period, (int, float, Decimal)):
+        return int(period)
+    match = PERIOD.match(period.lower())
+    if not match or match.group(2) not in PERIOD_UNITS:
+        raise ValueError('Invalid period {!r}'.format(period))
+    return int(match.group(1)) * PERIOD_UNITS[match.group(2)]
+
+
+class PriceTables(object):
+    """
+    The price list and discounts of an account, indexed for lookups.
+
+    :ivar prices: dict of (price, multiplier) by (resource, level, currency)
+    :ivar levels: dict of the current level of the account by resource
+    :ivar currencies: the currencies of the price list
+    :ivar currency: the currency of the account, if known
+    """
+
+    def __init__(self, prices, levels=None, discounts=(), currency=None):
+        """
+        :param prices: the objects of the price list
+        :param levels: the current level of the account by resource
+        :param discounts: the objects of the discount list
+        """
+        self.currency = currency
+        self.prices = {}
+        self.currencies = set()
+        for price in prices:
+            self.prices[(price['resource'], price['level'],
+                         price['currency'])] = (
+                Decimal(str(price['price'])),
+                Decimal(str(price['multiplier'])),
+            )
+            self.currencies.add(price['currency'])
+        self.levels = dict(levels or {})
+
+        thresholds = sorted(
+            (period_seconds(discount['period']), discount_fraction(discount))
+            for discount in discounts
+        )
+        self.discount_periods = [seconds for seconds, _ in thresholds]
+        self.discount_values = [value for _, value in thresholds]
+
+    def discount(self, seconds):
+        """
+        :return: the discount of a subscription period as a fraction
+        """
+        index = bisect.bisect_right(self.discount_periods, seconds)
+        return self.discount_values[index - 1] if index else Decimal(0)
+
+    def lookup(self, resource_type, currency, level=None):
+        """
+        :return: tuple of the price and the multiplier
+        """
+        if level is None:
+            level = self.levels.get(resource_type, 0)
+        try:
+            return self.prices[(resource_type, level, currency)]
+        except KeyError:
+            raise KeyError(
+                'No {} price of level {} for {}'.format(
+                    currency,
+                    level,
+                    resource_type
+                )
+            )
+
+
+def discount_fraction(discount):
+    """
+    :return: the discount of a discount object as a fraction, from its
+        percentage
+    """
+    value = discount.get('discount_percent', discount.get('discount'))
+    return Decimal(str(value or 0)) / 100
+
+
+class PricingEngine(object):
+    """
+    Prices subscriptions locally from the price list and discounts, which
+    are reloaded after *ttl* seconds.
+    """
+
+    def __init__(self, currency=None, ttl=3600, **kwargs):
+        """
+        :param currency:
+            The currency of the prices. Defaults to the *currency* config
+            option, or to the currency of the account balance.
+        :param ttl:
+            Seconds the price list is used before it is loaded again.
+        :param kwargs:
+            The client arguments, like api_endpoint.
+        """
+        self.currency = currency or config.get('currency')
+        self.ttl = ttl
+        self.pricing = resource.Pricing(**kwargs)
+        self.discounts = resource.Discount(**kwargs)
+        self.balance = resource.Balance(**kwargs)
+        self._tables = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Loads the price list and the discounts from the API.
+        """
+        # the current levels are a key of the response next to the objects,
+        # so the response is decoded here rather than by the client
+        transport = Transport(self.pricing.c, pool_size=1)
+        try:
+            response = transport.check(transport.session.get(
+                transport.url('/pricing/'),
+                params={'limit': 0}
+            ))
+        finally:
+            transport.close()
+        document = self.pricing.c.json.loads(response.content)
+        prices = document['objects']
+        levels = document.get('current') or {}
+        discounts = self.discounts.list()
+        currency = None
+        if self.currency is None:
+            currency = self.balance.get().get('currency')
+        tables = PriceTables(prices, levels, discounts, currency)
+        LOG.debug(
+            'Loaded %d prices and %d discounts',
+            len(tables.prices),
+            len(discounts)
+        )
+        return tables
+
+    @property
+    def tables(self):
+        """
+        The :class:`PriceTables`, loaded when older than the ttl.
+        """
+        with self._lock:
+            if self._tables is None or \
+                    time.time() - self._loaded_at > self.ttl:
+                self._tables = self.load()
+                self._loaded_at = time.time()
+            return self._tables
+
+    def invalidate(self):
+        with self._lock:
+            self._tables = None
+
+    def _currency(self, tables, currency):
+        currency = currency or self.currency or tables.currency
+        if currency is None:
+            if len(tables.currencies) != 1:
+                raise ValueError(
+                    'The price list has the currencies {}, pick one'.format(
+                        ', '.join(sorted(tables.currencies))
+                    )
+                )
+            currency = next(iter(tables.currencies))
+        return currency
+
+    def price(self, amount, period, resource_type, currency=None,
+              level=None):
+        """
+        The price of a subscription, like SubscriptionCalculator.get_price.
+
+        :param amount: the amount in the base unit, e.g. MHz or bytes
+        :param period: e.g. '1 month', or seconds
+        :param level: the price level. Default is the current level of the
+            account.
+        :return: the price as a Decimal
+        """
+        return self._price(
+            self.tables,
+            amount,
+            period,
+            resource_type,
+            currency,
+            level
+        )
+
+    def _price(self, tables, amount, period, resource_type, currency,
+               level):
+        seconds = period_seconds(period)
+        price, multiplier = tables.lookup(
+            resource_type,
+            self._currency(tables, currency),
+            level
+        )
+        return Decimal(str(amount)) * seconds * price / multiplier * \
+            (1 - tables.discount(seconds))
+
+    def price_many(self, items, currency=None):
+        """
+        Prices a bill of materials with one snapshot of the price list.
+
+        :param items: dicts with amount, period and resource, and optionally
+            level
+        :return: tuple of the list of the prices and their total
+        """
+        tables = self.tables
+        prices = [
+            self._price(
+                tables,
+                item['amount'],
+                item['period'],
+                item['resource'],
+                currency,
+                item.get('level')
+            )
+            for item in items
+        ]
+        return prices, sum(prices, Decimal(0))
@@ -0,0 +1,345 @@
+from __future__ import division
+import collections
+import math
+import threading
+import time
+from builtins import object, range
+
+
+class LatencyHistogram(object):
+    """
+    Counts latencies in buckets whose upper bounds double, starting at
+    *smallest* seconds. The last bucket has no upper bound.
+    """
+
+    def __init__(self, smallest=0.001, n_buckets=20):
+        self.bounds = [smallest * 2 ** i for i in range(n_buckets - 1)]
+        self.bounds.append(float('inf'))
+        self.counts = [0] * n_buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        index = 0
+        if latency > self.bounds[0]:
+            index = min(
+                int(math.ceil(math.log(latency / self.bounds[0], 2))),
+                len(self.bounds) - 1
+            )
+        self.counts[index] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    @property
+    def buckets(self):
+        """
+        List of (upper_bound, count) tuples of the non-empty buckets.
+        """
+        return [
+            (bound, count)
+            for bound, count in zip(self.bounds, self.counts)
+            if count
+        ]
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket containing the given fraction of the
+        latencies, e.g. 0.99. The last bucket reports the maximum.
+        """
+        if not self.count:
+            return None
+        needed = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= needed and count:
+                return min(bound, self.max)
+        return self.max
+
+    def copy(self):
+        histogram = LatencyHistogram.__new__(LatencyHistogram)
+        histogram.__dict__.update(self.__dict__)
+        histogram.bounds = list(self.bounds)
+        histogram.counts = list(self.counts)
+        return histogram
+
+
+class ProgressEvent(object):
+    """
+    A snapshot of a :class:`TransferProgress`, pushed to its listeners.
+
+    :ivar kind: what happened, one of the TransferProgress event kinds
+    :ivar chunk: the chunk the event is about, if any
+    :ivar latency: seconds the chunk took, for chunk events
+    :ivar error: the exception of a failed chunk
+    :ivar done: bytes transferred or skipped
+    :ivar total: size of the transfer in bytes
+    :ivar in_flight: number of chunks being transferred
+    :ivar retries: number of failed chunk attempts which are retried
+    :ivar failures: number of chunks which were given up
+    :ivar rate: bytes per second over the last *window* seconds
+    :ivar ewma_rate: exponentially weighted moving average of the rate
+    :ivar eta: estimated seconds until done, based on the EWMA rate
+    :ivar elapsed: seconds since the transfer started
+    :ivar latencies: a :class:`LatencyHistogram` of the chunk latencies
+    """
+
+    def __init__(self, kind, progress, chunk=None, latency=None, error=None):
+        self.kind = kind
+        self.chunk = chunk
+        self.latency = latency
+        self.error = error
+        self.done = progress.done
+        self.total = progress.total
+        self.transferred = progress.transferred
+        self.skipped = progress.skipped
+        self.chunks = progress.chunks
+        self.in_flight = progress.in_flight
+        self.retries = progress.retries
+        self.failures = progress.failures
+        self.rate = progress.instant_rate
+        self.ewma_rate = progress.ewma_rate
+        self.eta = progress.eta
+        self.elapsed = progress.elapsed
+        self.latencies = progress.latencies.copy()
+
+    def __repr__(self):
+        return '<ProgressEvent({s.kind}, done={s.done}/{s.total}, ' \
+               'in_flight={s.in_flight}, retries={s.retries}, ' \
+               'rate={s.ewma_rate:0.0f}B/s, eta={s.eta})>'.format(s=self)
+
+
+class TransferProgress(object):
+    """
+    Thread-safe progress and throughput counters of a transfer.
+
+    Bytes are either *transferred* by the transfer itself or *skipped*
+    because they were known to be done, e.g. from a journal. Both count
+    towards :attr:`done`, only transferred bytes count towards the rates.
+
+    Workers report chunks as they start, finish and fail, and every change
+    is pushed as a :class:`ProgressEvent` to the subscribed listeners, from
+    the worker's thread. :meth:`wait` blocks until the transfer finished.
+    """
+    STARTED = 'started'
+    CHUNK_DONE = 'chunk_done'
+    CHUNK_SKIPPED = 'chunk_skipped'
+    RETRY = 'retry'
+    CHUNK_FAILED = 'chunk_failed'
+    FINISHED = 'finished'
+
+    def __init__(self, total=0, callback=None, report_interval=0,
+                 window=1.0, ewma_time_constant=5.0):
+        """
+        :param total:
+            Size of the whole transfer in bytes.
+        :param callback:
+            Called as callback(done, total) on progress, at most every
+            *report_interval* seconds, and when the transfer finished.
+        :param report_interval:
+            Minimum seconds between *callback* calls.
+        :param window:
+            Seconds over which the instantaneous rate is measured.
+        :param ewma_time_constant:
+            Seconds after which a rate sample weighs 1/e in the EWMA rate.
+        """
+        self.total = total
+        self.callback = callback
+        self.report_interval = report_interval
+        self.window = window
+        self.ewma_time_constant = ewma_time_constant
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.transferred = 0
+            self.skipped = 0
+            self.chunks = 0
+            self.in_flight = 0
+            self.retries = 0
+            self.failures = 0
+            self.ewma_rate = None
+            self.latencies = LatencyHistogram()
+            self.started_at = time.time()
+            self.finished_at = None
+            self._samples = collections.deque()
+            self._sampled_at = self.started_at
+            self._reported_at = None
+            self._finished.clear()
+        self._emit(self.STARTED)
+
+    def subscribe(self, listener):
+        """
+        Adds a callable which is called with every :class:`ProgressEvent`.
+        Listeners are called from the worker threads and should be quick.
+        """
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    @property
+    def done(self):
+        return self.transferred + self.skipped
+
+    def chunk_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def chunk_done(self, n_bytes, sent=True, latency=None, chunk=None):
+        """
+        Records a chunk started with :meth:`chunk_started` as done.
+
+        :param sent:
+            False if the chunk did not need to be transferred after all.
+        """
+        with self._lock:
+            self.in_flight -= 1
+        if sent:
+            self.add(n_bytes, latency=latency, chunk=chunk)
+        else:
+            self.skip(n_bytes, chunk=chunk)
+
+    def chunk_failed(self, error, retrying, chunk=None):
+        """
+        Records a failed attempt of a chunk started with
+        :meth:`chunk_started`.
+
+        :param retrying: True if the chunk will be tried again
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if retrying:
+                self.retries += 1
+            else:
+                self.failures += 1
+        self._emit(
+            self.RETRY if retrying else self.CHUNK_FAILED,
+            chunk=chunk,
+            error=error
+        )
+
+    def add(self, n_bytes, latency=None, chunk=None):
+        """
+        Records a transferred chunk.
+        """
+        with self._lock:
+            self.transferred += n_bytes
+            self.chunks += 1
+            if latency is not None:
+                self.latencies.add(latency)
+            self._sample(n_bytes)
+        self._emit(self.CHUNK_DONE, chunk=chunk, latency=latency)
+
+    def skip(self, n_bytes, chunk=None):
+        """
+        Records a chunk which did not need to be transferred.
+        """
+        with self._lock:
+            self.skipped += n_bytes
+            self.chunks += 1
+        self._emit(self.CHUNK_SKIPPED, chunk=chunk)
+
+    def _sample(self, n_bytes):
+        # must hold self._lock
+        now = time.time()
+        self._samples.append((now, n_bytes))
+        while self._samples[0][0] < now - self.window:
+            self._samples.popleft()
+
+        elapsed = max(now - self._sampled_at, 1e-6)
+        self._sampled_at = now
+        sample_rate = n_bytes / elapsed
+        if self.ewma_rate is None:
+            self.ewma_rate = n_bytes / max(now - self.started_at, 1e-6)
+        else:
+            # the weight of a sample grows with the time it covers, so
+            # chunks finishing at the same moment do not skew the average
+            weight = 1 - math.exp(-elapsed / self.ewma_time_constant)
+            self.ewma_rate += weight * (sample_rate - self.ewma_rate)
+
+    @property
+    def instant_rate(self):
+        """
+        Bytes per second over the last *window* seconds.
+        """
+        now = self.finished_at or time.time()
+        span = min(self.window, max(now - self.started_at, 1e-6))
+        return sum(
+            n_bytes for at, n_bytes in list(self._samples)
+            if at >= now - self.window
+        ) / span
+
+    @property
+    def eta(self):
+        """
+        Estimated seconds until the transfer is done, None if unknown.
+        """
+        if self.finished_at:
+            return 0
+        if not self.ewma_rate:
+            return None
+        return max(self.total - self.done, 0) / self.ewma_rate
+
+    def finish(self):
+        self.finished_at = time.time()
+        self._finished.set()
+        self._emit(self.FINISHED)
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until :meth:`finish` is called.
+
+        :return: True if the transfer finished within *timeout*
+        """
+        return self._finished.wait(timeout)
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def rate(self):
+        """
+        Average transfer rate in bytes per second.
+        """
+        return self.transferred / max(self.elapsed, 1e-6)
+
+    def _emit(self, kind, chunk=None, latency=None, error=None):
+        if self.listeners:
+            event = ProgressEvent(
+                kind,
+                self,
+                chunk=chunk,
+                latency=latency,
+                error=error
+            )
+            for listener in list(self.listeners):
+                listener(event)
+
+        if self.callback and kind != self.STARTED:
+            now = time.time()
+            with self._lock:
+                due = kind == self.FINISHED or self._reported_at is None or \
+                    now - self._reported_at >= self.report_interval
+                if due:
+                    self._reported_at = now
+            if due:
+                self.report()
+
+    def report(self):
+        if self.callback:
+            self.callback(self.done, self.total)
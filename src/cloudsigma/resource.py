@@ -7,10 +7,13 @@ import requests
 from past.builtins import basestring
 
 from cloudsigma.generic import get_client, WebsocketClient, GenericClient
+from cloudsigma.transport import Transport
 
 
 class ResourceBase(object):
     resource_name = None
+    # the field ordering the objects of time-indexed resources
+    time_field = None
 
     def __init__(self, *args, **kwargs):
         self.c = get_client()(*args, **kwargs)
@@ -26,7 +29,7 @@ class ResourceBase(object):
             'Descendant class must set the resource_name field'
         return '/%s/' % (self.resource_name,)
 
-    def get(self, uuid=None):
+    def get(self, uuid=None, models=False):
         url = self._get_url()
         if uuid is not None:
             if isinstance(uuid, bytes):
@@ -34,32 +37,137 @@ class ResourceBase(object):
             else:
                 uuid_str = uuid
             url += uuid_str
-        return self.c.get(url, return_list=False)
+        return self.c.get(
+            url,
+            return_list=False,
+            model=self._model(models),
+            compact=models == 'compact'
+        )
 
     def get_schema(self):
         url = self._get_url() + 'schema'
         return self.c.get(url)
 
+    def get_model(self):
+        """
+        The typed model class of the resource, generated from its schema.
+        See :mod:`cloudsigma.models`.
+        """
+        from cloudsigma.models import get_model
+        return get_model(self)
+
+    def _model(self, models):
+        return self.get_model() if models else None
+
     def get_from_url(self, url):
         return self.c.get(url, return_list=False)
 
-    def list(self, query_params=None):
+    def list(self, query_params=None, models=False):
+        """
+        :param models:
+            True to return model objects instead of dicts, whose nested
+            values are materialized on first access. 'compact' to
+            materialize them right away, which takes the least memory. See
+            :mod:`cloudsigma.models`.
+        """
         url = self._get_url()
         _query_params = {
             'limit': 0,  # get all results, do not use pagination
         }
         if query_params:
             _query_params.update(query_params)
-        return self.c.get(url, query_params=_query_params, return_list=True)
+        return self.c.get(
+            url,
+            query_params=_query_params,
+            return_list=True,
+            model=self._model(models),
+            compact=models == 'compact'
+        )
 
-    def list_detail(self, query_params=None):
+    def list_detail(self, query_params=None, models=False):
+        """
+        :param models:
+            True to return model objects instead of dicts, whose nested
+            values are materialized on first access. 'compact' to
+            materialize them right away, which takes the least memory. See
+            :mod:`cloudsigma.models`.
+        """
         url = self._get_url() + 'detail/'
         _query_params = {
             'limit': 0,  # get all results, do not use pagination
         }
         if query_params:
             _query_params.update(query_params)
-        return self.c.get(url, query_params=_query_params, return_list=True)
+        return self.c.get(
+            url,
+            query_params=_query_params,
+            return_list=True,
+            model=self._model(models),
+            compact=models == 'compact'
+        )
+
+    def list_range(self, start, end, query_params=None, n_threads=4,
+                   **kwargs):
+        """
+        Lists the objects of a time-indexed resource from *start*, inclusive,
+        to *end*, exclusive, fetching windows of the range concurrently over
+        a pooled connection. See :func:`cloudsigma.timeline.fetch_range`
+        for the window options.
+
+        :param start: a datetime or an ISO 8601 string
+        :param end: a datetime or an ISO 8601 string
+        :return: a generator of the objects in time order
+        """
+        assert self.time_field, \
+            'Only resources with a time_field can be listed by time'
+        return self._list_range(start, end, query_params, n_threads, kwargs)
+
+    def _list_range(self, start, end, query_params, n_threads, kwargs):
+        from cloudsigma.timeline import fetch_range
+        url = self._get_url()
+
+        def fetch(window_start, window_end):
+            _query_params = {
+                'limit': 0,  # get all results, do not use pagination
+                self.time_field + '__gte': window_start.isoformat(),
+                self.time_field + '__lt': window_end.isoformat(),
+            }
+            if query_params:
+                _query_params.update(query_params)
+            return transport.api(
+                'GET',
+                url,
+                query_params=_query_params,
+                return_list=True
+            )
+
+        transport = Transport(self.c, pool_size=n_threads)
+        try:
+            for obj in fetch_range(
+                    fetch,
+                    start,
+                    end,
+                    self.time_field,
+                    n_threads=n_threads,
+                    **kwargs):
+                yield obj
+        finally:
+            transport.close()
+
+    def list_columns(self, columns=None, relations=None, query_params=None):
+        """
+        Lists the details into columns, with nested lists like the drives of
+        servers as relation tables. See :mod:`cloudsigma.columnar`.
+
+        :return: a :class:`cloudsigma.columnar.Snapshot`
+        """
+        from cloudsigma.columnar import export_resource
+        return export_resource(
+            self,
+            columns=columns,
+            relations=relations,
+            query_params=query_params
+        )
 
     def _pepare_data(self, data):
         res_data = data
@@ -227,7 +335,25 @@ class Drive(ResourceBase):
         res_data = self._action(uuid, 'upload_chunk', {'chunk_number': chunk_number, 'chunk_size': chunk_size})
         return res_data['link']
 
-    def upload_chunk(self, link, image_path, chunk_number, chunk_size):
+    def upload_chunk(self, link, image_path, chunk_number, chunk_size,
+                     content_encoding=None):
+        """
+        Upload a chunk to a link from :meth:`get_upload_chunk_link`.
+
+        :param link:
+            The upload link of the chunk.
+        :param image_path:
+            Path of the image the chunk is read from.
+        :param chunk_number:
+            The number of the chunk, counting from 0.
+        :param chunk_size:
+            The chunk size the link was requested with.
+        :param content_encoding:
+            Compress the chunk with 'gzip' or 'zstd' before sending it.
+            Default is no compression.
+        :return:
+            The response of the upload request.
+        """
         chunk_offset = chunk_number * chunk_size
         file_size = os.path.getsize(image_path)
         n_chunks = file_size // chunk_size
@@ -237,7 +363,7 @@ class Drive(ResourceBase):
             real_chunk_size = chunk_size
         else:
             real_chunk_size = file_size - chunk_offset
-        with open(image_path, 'r') as f:
+        with open(image_path, 'rb') as f:
             f.seek(chunk_offset)
             data = f.read(real_chunk_size)
 
@@ -246,6 +372,11 @@ class Drive(ResourceBase):
             'Content-Type': 'application/octet-stream',
             'Accept': 'application/json'
         }
+        if content_encoding:
+            from cloudsigma.compression import get_codec
+            codec = get_codec(content_encoding)
+            data = codec.compress(data)
+            headers['Content-Encoding'] = codec.name
         return requests.post(self.c._get_full_url(link), data=data, headers=headers)
 
 
@@ -265,14 +396,17 @@ class InitUpload(ResourceBase):
             to the drives attached to the server.
         :param image_path:
             A path to the drive image to be uploaded. If given, and no name is specified in data, filename will be used
-            as a drive name, also if the size parameter is not preset the file size will be used.
+            as a drive name, also if the size parameter is not preset the file size will be used. When uploading
+            from a stream, leave it out and give the name and the size in data.
         :return:
             New drive definition.
         """
         query_params = {}
-        if not data.get('name'):
+        if not data.get('name') and image_path:
             data['name'] = os.path.split(image_path)[1]
         if not data.get('size'):
+            if not image_path:
+                raise TypeError('The drive size is required without an image_path')
             data['size'] = os.path.getsize(image_path)
         if avoid:
             if isinstance(avoid, basestring):
@@ -444,6 +578,7 @@ class SubscriptionCalculator(Subscriptions):
 
 class Ledger(ResourceBase):
     resource_name = 'ledger'
+    time_field = 'time'
 
 
 class Balance(ResourceBase):
@@ -460,6 +595,7 @@ class Pricing(ResourceBase):
 
 class AuditLog(ResourceBase):
     resource_name = 'logs'
+    time_field = 'time'
 
 
 class Licenses(ResourceBase):
@@ -488,6 +624,11 @@ class CurrentUsage(ResourceBase):
     resource_name = 'currentusage'
 
 
+class Usage(ResourceBase):
+    resource_name = 'usage'
+    time_field = 'poll_time'
+
+
 class Snapshot(ResourceBase):
     resource_name = 'snapshots'
 
@@ -555,12 +696,21 @@ class WebsocketTimeoutError(Exception):
 
 class Websocket(object):
 
-    def __init__(self, timeout=10):
+    def __init__(self, timeout=10, ws_endpoint=None, **kwargs):
+        """
+        :param ws_endpoint: the websocket of the api_endpoint of the
+            kwargs. Default is the one of the config.
+        :param kwargs: the client arguments, like username and password
+        """
         self.timeout = timeout
-        accounts = Accounts()
+        accounts = Accounts(**kwargs)
         accounts.authenticate_asynchronous()
         cookie = accounts.c.resp.cookies['async_auth']
-        self.ws = WebsocketClient(cookie, self.timeout)
+        self.ws = WebsocketClient(
+            cookie,
+            self.timeout,
+            ws_endpoint=ws_endpoint
+        )
 
     def wait(self, message_filter=None, timeout=None):
         # message_filter = {'resource_type': ['drives']}
@@ -637,6 +787,7 @@ class Websocket(object):
 
 class BurstUsage(ResourceBase):
     resource_name = 'burstusage'
+    time_field = 'time'
 
 
 class Locations(ResourceBase):
@@ -0,0 +1,572 @@
+from __future__ import division
+import errno
+import heapq
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from builtins import object
+from collections import OrderedDict, defaultdict, deque
+
+import requests
+import simplejson
+
+from . import errors
+from future import standard_library
+standard_library.install_aliases()
+import urllib.error  # noqa: E402
+
+
+LOG = logging.getLogger(__name__)
+
+# 4xx statuses which may go away on their own
+RETRYABLE_CLIENT_STATUSES = (408, 409, 423, 429)
+
+# local errors which retrying cannot fix
+FATAL_ERRNOS = (
+    errno.ENOENT,
+    errno.EACCES,
+    errno.EPERM,
+    errno.EISDIR,
+    errno.EBADF,
+    errno.ENOSPC,
+)
+
+# truncated or garbled response bodies, e.g. from a dropped connection.
+# They are ValueErrors, which are fatal otherwise.
+JSON_DECODE_ERRORS = (simplejson.JSONDecodeError,)
+if hasattr(json, 'JSONDecodeError'):
+    JSON_DECODE_ERRORS += (json.JSONDecodeError,)
+
+
+class FatalError(Exception):
+    """
+    Raise from a task to fail it without retrying and abort the run.
+    """
+    pass
+
+
+class RetryableError(Exception):
+    """
+    Raise from a task to have it retried regardless of the cause.
+    """
+    pass
+
+
+class TaskError(Exception):
+    """
+    Raised by :meth:`TaskResult.raise_for_failures`. The result is available
+    as the *result* attribute.
+    """
+
+    def __init__(self, message, result):
+        super(TaskError, self).__init__(message)
+        self.result = result
+
+
+def _status_of(exc):
+    if isinstance(exc, errors.ApiClientError):
+        return exc.status_code
+    if isinstance(exc, urllib.error.HTTPError):
+        return exc.code
+    response = getattr(exc, 'response', None)
+    if isinstance(exc, requests.RequestException) and response is not None:
+        return response.status_code
+    return None
+
+
+def is_fatal(exc):
+    """
+    Tells errors that retrying cannot fix from transient ones.
+
+    Authentication and permission errors, 4xx responses other than timeouts,
+    conflicts and throttling, missing or unreadable local files and
+    programming errors are fatal. Connection problems, 5xx responses and
+    response bodies which are not valid JSON are retryable.
+    """
+    if isinstance(exc, FatalError):
+        return True
+    if isinstance(exc, RetryableError):
+        return False
+    if isinstance(exc, (errors.AuthError, errors.PermissionError)):
+        return True
+
+    status = _status_of(exc)
+    if status is not None:
+        return status // 100 == 4 and \
+            status not in RETRYABLE_CLIENT_STATUSES
+
+    if isinstance(exc, (requests.RequestException, urllib.error.URLError)):
+        return False
+    if isinstance(exc, JSON_DECODE_ERRORS):
+        return False
+    if isinstance(exc, EnvironmentError):
+        return exc.errno in FATAL_ERRNOS
+    return isinstance(exc, (TypeError, ValueError, AttributeError))
+
+
+class RetryPolicy(object):
+    """
+    A retry budget per task with exponential backoff.
+    """
+
+    def __init__(self, max_retries=5, backoff=1.0, max_backoff=60.0,
+                 jitter=0.1):
+        """
+        :param max_retries:
+            How many times a failing task is retried before it is given up.
+        :param backoff:
+            Delay before the first retry in seconds. Doubles on every retry.
+        :param max_backoff:
+            Upper bound of the delay in seconds.
+        :param jitter:
+            Fraction of the delay that is randomized, so that chunks which
+            failed together do not retry together.
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """
+        Delay in seconds before retry number *attempt*, counting from 1.
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * (1 + self.jitter * (2 * random.random() - 1))
+
+
+class TaskResult(object):
+    """
+    Outcome of a :class:`TaskScheduler` run.
+
+    :ivar succeeded: items which were processed successfully
+    :ivar failed: dictionary of failed item to the last exception
+    :ivar retries: total number of retries over all items
+    :ivar cancelled: True if the run was cancelled or aborted
+    :ivar skipped: items of a :class:`TaskGraph` which did not run because
+        an item they depend on failed
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = {}
+        self.retries = 0
+        self.cancelled = False
+        self.skipped = []
+
+    @property
+    def ok(self):
+        return not self.failed and not self.cancelled
+
+    def raise_for_failures(self):
+        if self.ok:
+            return
+        if self.failed:
+            item, exc = next(iter(self.failed.items()))
+            message = '{} item(s) failed, for example {!r}: {}'.format(
+                len(self.failed),
+                item,
+                exc
+            )
+        else:
+            message = 'Cancelled'
+        raise TaskError(message, self)
+
+    def __repr__(self):
+        return '<TaskResult(succeeded={}, failed={}, retries={}, ' \
+               'cancelled={})>'.format(
+                   len(self.succeeded),
+                   len(self.failed),
+                   self.retries,
+                   self.cancelled
+               )
+
+
+class TaskScheduler(object):
+    """
+    Runs a function over a set of items in a pool of worker threads.
+
+    Failed items are retried with exponential backoff until their retry
+    budget runs out. Fatal errors, as classified by *is_fatal*, are not
+    retried and by default abort the whole run. Backed off items wait in a
+    timer heap, so they do not hold a worker while waiting.
+    """
+
+    def __init__(
+            self,
+            func,
+            n_threads=4,
+            retry_policy=None,
+            is_fatal=is_fatal,
+            abort_on_fatal=True,
+            concurrency=None,
+            item_size=None,
+            on_success=None,
+            on_failure=None,
+            name='worker'
+    ):
+        """
+        :param func:
+            Called with each item. Raising an exception fails the item.
+        :param n_threads:
+            Number of worker threads.
+        :param retry_policy:
+            A :class:`RetryPolicy`. Default is RetryPolicy().
+        :param is_fatal:
+            Callable classifying an exception as fatal.
+        :param abort_on_fatal:
+            Cancel the remaining items after a fatal error.
+        :param concurrency:
+            An optional :class:`cloudsigma.adaptive.AdaptiveConcurrency`.
+            Workers acquire it around every item, so it decides how many of
+            the *n_threads* workers are active.
+        :param item_size:
+            Callable returning the size of an item in bytes, reported to
+            *concurrency*.
+        :param on_success:
+            Called with each item after *func* succeeded on it. An
+            exception from it cancels the run, the item is not retried.
+        :param on_failure:
+            Called as on_failure(item, exc, retrying) after *func* failed on
+            an item. *retrying* tells whether the item will be retried.
+        """
+        self.func = func
+        self.n_threads = n_threads
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.is_fatal = is_fatal
+        self.abort_on_fatal = abort_on_fatal
+        self.concurrency = concurrency
+        self.item_size = item_size or (lambda item: 0)
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.name = name
+
+        self.result = TaskResult()
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._outstanding = 0
+        self._threads = []
+        self._done = threading.Event()
+
+    def start(self, items):
+        with self._cond:
+            for item in items:
+                self._push(item, 0, 0)
+        if not self._outstanding:
+            self._done.set()
+            return
+        for i in range(self.n_threads):
+            thread = threading.Thread(
+                target=self._work,
+                name='{}-{}'.format(self.name, i)
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, items):
+        """
+        Adds items to a started run. Call it before the run is over, e.g.
+        from *on_success*.
+        """
+        with self._cond:
+            for item in items:
+                self._push(item, 0, 0)
+            self._cond.notify_all()
+
+    def _push(self, item, attempt, ready_at):
+        heapq.heappush(
+            self._heap,
+            (ready_at, next(self._counter), item, attempt)
+        )
+        self._outstanding += 1
+
+    def _next(self):
+        with self._cond:
+            while not self.result.cancelled and self._outstanding:
+                if self._heap:
+                    wait = self._heap[0][0] - time.time()
+                    if wait <= 0:
+                        ready_at, _, item, attempt = heapq.heappop(self._heap)
+                        return item, attempt
+                else:
+                    wait = None
+                self._cond.wait(wait)
+            return None
+
+    def _finish_item(self):
+        # must hold self._cond
+        self._outstanding -= 1
+        if not self._outstanding:
+            self._done.set()
+        self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            entry = self._next()
+            if entry is None:
+                return
+            item, attempt = entry
+
+            if self.concurrency:
+                self.concurrency.acquire()
+            started = time.time()
+            exc = None
+            try:
+                self.func(item)
+            except Exception as e:
+                exc = e
+            finally:
+                if self.concurrency:
+                    self.concurrency.release(
+                        self.item_size(item),
+                        time.time() - started,
+                        exc is None
+                    )
+
+            if exc is None and self.on_success:
+                try:
+                    self.on_success(item)
+                except Exception:
+                    # the item is done, retrying it would run func twice
+                    LOG.exception('on_success failed for {!r}, '
+                                  'cancelling'.format(item))
+                    with self._cond:
+                        self._cancel()
+
+            if exc is not None:
+                fatal = self.is_fatal(exc)
+                give_up = fatal or attempt >= self.retry_policy.max_retries
+                if self.on_failure:
+                    self.on_failure(item, exc, not give_up)
+
+            with self._cond:
+                if exc is None:
+                    self.result.succeeded.append(item)
+                    self._finish_item()
+                    continue
+
+                if give_up:
+                    LOG.error(
+                        'Giving up on {!r} after {} attempt(s): {!r}'.format(
+                            item,
+                            attempt + 1,
+                            exc
+                        )
+                    )
+                    self.result.failed[item] = exc
+                    self._finish_item()
+                    if fatal and self.abort_on_fatal:
+                        self._cancel()
+                    continue
+
+                delay = self.retry_policy.delay(attempt + 1)
+                LOG.warning(
+                    'Error for {!r}, retrying in {:0.1f}s: {!r}'.format(
+                        item,
+                        delay,
+                        exc
+                    )
+                )
+                self.result.retries += 1
+                self._outstanding -= 1
+                self._push(item, attempt + 1, time.time() + delay)
+                self._cond.notify_all()
+
+    def _cancel(self):
+        # must hold self._cond
+        self.result.cancelled = True
+        self._heap = []
+        self._done.set()
+        self._cond.notify_all()
+
+    def cancel(self):
+        """
+        Stops handing out items. Items already being processed finish.
+        """
+        with self._cond:
+            self._cancel()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the run to finish or be cancelled, then joins the workers.
+
+        :return: True if the run is over, False if *timeout* expired.
+        """
+        if not self._done.wait(timeout):
+            return False
+        for thread in self._threads:
+            thread.join()
+        return True
+
+    def run(self, items):
+        """
+        Processes *items* and blocks until done.
+
+        :return: the :class:`TaskResult`
+        """
+        self.start(items)
+        try:
+            self.wait()
+        except BaseException:
+            self.cancel()
+            raise
+        return self.result
+
+
+class TaskGraph(object):
+    """
+    Runs tasks which depend on other tasks in a pool of worker threads.
+
+    A task is started once all the tasks it depends on succeeded, so
+    independent branches run in parallel. The tasks are run and retried by a
+    :class:`TaskScheduler`. When a task fails for good, the tasks depending
+    on it, directly or not, are skipped and the other branches go on.
+
+    Usage::
+
+        graph = TaskGraph(n_threads=8)
+        graph.add('stop', lambda: server.stop(uuid))
+        graph.add('delete', lambda: server.delete(uuid), after=['stop'])
+        graph.run().raise_for_failures()
+    """
+
+    def __init__(self, n_threads=4, retry_policy=None, is_fatal=is_fatal,
+                 name='task'):
+        """
+        :param n_threads:
+            Number of worker threads.
+        :param retry_policy:
+            A :class:`RetryPolicy`. Default is RetryPolicy().
+        :param is_fatal:
+            Callable classifying an exception as fatal, i.e. not retried.
+        """
+        self.n_threads = n_threads
+        self.retry_policy = retry_policy
+        self.is_fatal = is_fatal
+        self.name = name
+        self.funcs = OrderedDict()
+        self.dependencies = {}
+        self._lock = threading.Lock()
+        self._waiting = None
+        self._dependents = None
+        self._scheduler = None
+
+    def __contains__(self, key):
+        return key in self.funcs
+
+    def __len__(self):
+        return len(self.funcs)
+
+    def add(self, key, func, after=()):
+        """
+        Adds a task.
+
+        :param key: a hashable name of the task
+        :param func: called without arguments to run the task
+        :param after: keys of the tasks which must succeed first. They may
+            be added later.
+        :return: the key
+        """
+        if key in self.funcs:
+            raise ValueError('Duplicate task {!r}'.format(key))
+        self.funcs[key] = func
+        self.dependencies[key] = set(after)
+        return key
+
+    def depend(self, key, *after):
+        """
+        Makes a task depend on more tasks.
+        """
+        self.dependencies[key].update(after)
+
+    def order(self):
+        """
+        :return: list of the keys in an order which runs every task after
+            its dependencies
+        :raise ValueError: on unknown dependencies and cycles
+        """
+        waiting = {}
+        dependents = defaultdict(list)
+        for key, after in self.dependencies.items():
+            for dependency in after:
+                if dependency not in self.funcs:
+                    raise ValueError('{!r} depends on the unknown task {!r}'
+                                     .format(key, dependency))
+                dependents[dependency].append(key)
+            waiting[key] = len(after)
+
+        ready = deque(key for key in self.funcs if not waiting[key])
+        order = []
+        while ready:
+            key = ready.popleft()
+            order.append(key)
+            for dependent in dependents[key]:
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    ready.append(dependent)
+        if len(order) != len(self.funcs):
+            raise ValueError('Cycle between the tasks {!r}'.format(
+                [key for key in self.funcs if waiting[key]]
+            ))
+        return order
+
+    def run(self):
+        """
+        Runs all tasks and blocks until done.
+
+        :return: the :class:`TaskResult`, with the keys of the tasks as
+            items
+        """
+        order = self.order()
+        self._waiting = dict(
+            (key, len(after)) for key, after in self.dependencies.items()
+        )
+        self._dependents = defaultdict(list)
+        for key in order:
+            for dependency in self.dependencies[key]:
+                self._dependents[dependency].append(key)
+
+        self._scheduler = TaskScheduler(
+            lambda key: self.funcs[key](),
+            n_threads=min(self.n_threads, len(order)) or 1,
+            retry_policy=self.retry_policy,
+            is_fatal=self.is_fatal,
+            abort_on_fatal=False,
+            on_success=self._succeeded,
+            on_failure=self._failed,
+            name=self.name
+        )
+        result = self._scheduler.run(
+            [key for key in order if not self._waiting[key]]
+        )
+        result.skipped = [key for key in order if self._waiting[key] is None]
+        return result
+
+    def _succeeded(self, key):
+        # runs before the scheduler counts the task as done, so the run
+        # cannot end before the ready dependents are submitted
+        ready = []
+        with self._lock:
+            for dependent in self._dependents[key]:
+                if self._waiting[dependent] is None:
+                    continue
+                self._waiting[dependent] -= 1
+                if not self._waiting[dependent]:
+                    ready.append(dependent)
+        if ready:
+            self._scheduler.submit(ready)
+
+    def _failed(self, key, exc, retrying):
+        if retrying:
+            return
+        with self._lock:
+            pending = deque(self._dependents[key])
+            while pending:
+                dependent = pending.popleft()
+                if self._waiting[dependent] is not None:
+                    self._waiting[dependent] = None
+                    pending.extend(self._dependents[dependent])
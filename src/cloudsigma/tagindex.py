@@ -0,0 +1,327 @@
+"""
+Resolution of tags into the resources tagged with them.
+
+:class:`TagIndex` lists all tags of the account once and keeps an inverted
+index from every tag to the uuids of its resources by resource type, so
+resolving tags takes no requests. The details of the resolved resources are
+fetched with list requests filtered by their uuids, concurrently, and
+projected to the wanted fields, instead of one request per tag and type.
+
+The index is kept fresh by the websocket events about tags and tagged
+resources, and is reloaded periodically as a fallback for missed events.
+
+Usage::
+
+    with TagIndex() as index:
+        index.resolve(['production', 'web'], match='all')
+        index.fetch(['production'], ['servers'], fields=['uuid', 'status'])
+"""
+from builtins import object, range
+import re
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+from past.builtins import basestring
+
+from . import errors, resource
+from .columnar import column_spec, get_path
+from .transport import Transport
+
+LOG = getLogger(__name__)
+
+RESOURCE_URI = re.compile(r'/([a-z_]+)/([^/]+)/?$')
+
+
+def resource_type(reference):
+    """
+    :return: the resource type of a tag resource reference, e.g. 'servers'
+    """
+    if reference.get('res_type'):
+        return reference['res_type']
+    match = RESOURCE_URI.search(reference.get('resource_uri') or '')
+    return match.group(1) if match else None
+
+
+def project(obj, fields):
+    """
+    :param fields: field names or dotted paths into nested objects, like
+        'runtime.status'
+    :return: dict of the values of the fields, by field name with the dots
+        replaced by underscores
+    """
+    projected = {}
+    for field in fields:
+        name, path = column_spec(field)
+        projected[name] = get_path(obj, path)
+    return projected
+
+
+class TagIndex(object):
+    """
+    An inverted index of the tags of an account.
+
+    :ivar names: dict of the tag name by tag uuid
+    :ivar resources: dict of the tagged uuids by tag uuid and resource type
+    """
+    # uuids per list request of fetch, and list requests sent at once
+    chunk_size = 100
+    n_threads = 8
+
+    def __init__(self, reload_interval=None, use_websocket=True,
+                 ws_endpoint=None, **kwargs):
+        """
+        :param reload_interval:
+            Seconds between reloads of all tags once started. Default is
+            300 with a websocket and 30 without.
+        :param use_websocket:
+            Keep the index fresh from the websocket events once started.
+            Not done if an api_endpoint is given without its ws_endpoint.
+        :param ws_endpoint:
+            The websocket of the api_endpoint. Default is the one of the
+            config.
+        :param kwargs:
+            The client arguments, like api_endpoint.
+        """
+        self.client_kwargs = kwargs
+        self.ws_endpoint = ws_endpoint
+        self.tags = resource.Tags(**kwargs)
+        self.names = {}
+        self.resources = {}
+        self.loaded = False
+        self.use_websocket = use_websocket
+        self.reload_interval = reload_interval
+        self.websocket = None
+        # for the event handling next to the reloads
+        self._transport = Transport(self.tags.c, pool_size=1)
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def load(self):
+        """
+        Lists all tags and rebuilds the index.
+        """
+        tags = self.tags.list_detail()
+        with self._lock:
+            self.names = {}
+            self.resources = {}
+            for tag in tags:
+                self._add(tag)
+            self.loaded = True
+        LOG.debug('Indexed %d tags', len(tags))
+
+    def _add(self, tag):
+        # must hold self._lock
+        self.names[tag['uuid']] = tag['name']
+        by_type = defaultdict(set)
+        for reference in tag.get('resources') or ():
+            by_type[resource_type(reference)].add(reference['uuid'])
+        self.resources[tag['uuid']] = by_type
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def tag_uuids(self, tag):
+        """
+        :param tag: a tag uuid or name
+        :return: list of the uuids of the tags with that uuid or name
+        """
+        self._ensure_loaded()
+        with self._lock:
+            if tag in self.names:
+                return [tag]
+            return [uuid for uuid, name in self.names.items() if name == tag]
+
+    def resolve(self, tags, resource_types=None, match='any'):
+        """
+        :param tags: tag uuids or names
+        :param resource_types: the types to resolve, e.g. ['servers'].
+            Default is all.
+        :param match: 'any' for the resources tagged with any of the tags,
+            'all' for the ones tagged with all of them
+        :return: dict of the sets of the resource uuids by type
+        """
+        if match not in ('any', 'all'):
+            raise ValueError('Invalid match {!r}'.format(match))
+        if isinstance(tags, basestring):
+            tags = [tags]
+        resolved = None
+        with self._lock:
+            for tag in tags:
+                tagged = defaultdict(set)
+                for tag_uuid in self.tag_uuids(tag):
+                    for type_, uuids in self.resources[tag_uuid].items():
+                        if resource_types is None or type_ in resource_types:
+                            tagged[type_] |= uuids
+                if resolved is None:
+                    resolved = tagged
+                elif match == 'any':
+                    for type_, uuids in tagged.items():
+                        resolved[type_] |= uuids
+                else:
+                    resolved = defaultdict(set, (
+                        (type_, uuids & tagged[type_])
+                        for type_, uuids in resolved.items()
+                    ))
+        return dict(
+            (type_, uuids) for type_, uuids in (resolved or {}).items()
+            if uuids
+        )
+
+    def fetch(self, tags, resource_types=None, fields=None, match='any'):
+        """
+        Fetches the details of the resources of tags. Every resource type
+        is listed filtered by the resolved uuids, in chunks of
+        *chunk_size* uuids, concurrently.
+
+        :param fields: the fields to keep of every object, see
+            :func:`project`. Only their top level fields are requested.
+            Default is all.
+        :return: dict of the lists of the objects by resource type
+        """
+        resolved = self.resolve(tags, resource_types, match)
+        if not resolved:
+            return {}
+        chunks = [
+            (type_, sorted(uuids)[index:index + self.chunk_size])
+            for type_, uuids in resolved.items()
+            for index in range(0, len(uuids), self.chunk_size)
+        ]
+        n_threads = min(self.n_threads, len(chunks))
+        transport = Transport(self.tags.c, pool_size=n_threads)
+        query_params = {'limit': 0}
+        if fields:
+            # the uuids are kept to check the filter
+            top_level = set(['uuid'])
+            for field in fields:
+                path = column_spec(field)[1]
+                if path:
+                    top_level.add(path[0])
+            query_params['fields'] = ','.join(sorted(top_level))
+
+        def fetch_chunk(type_, uuids):
+            objects = transport.api(
+                'GET',
+                '/{}/detail/'.format(type_),
+                query_params=dict(query_params, uuid__in=','.join(uuids)),
+                return_list=True
+            )
+            # in case the filter or the projection were not applied
+            uuids = set(uuids)
+            return [
+                project(obj, fields) if fields else obj
+                for obj in objects if obj['uuid'] in uuids
+            ]
+
+        fetched = dict((type_, []) for type_ in resolved)
+        try:
+            with ThreadPoolExecutor(n_threads) as executor:
+                futures = [
+                    (type_, executor.submit(fetch_chunk, type_, uuids))
+                    for type_, uuids in chunks
+                ]
+                for type_, future in futures:
+                    fetched[type_].extend(future.result())
+        finally:
+            transport.close()
+        return fetched
+
+    def handle_event(self, frame):
+        """
+        Updates the index from a websocket event. Events about tags refresh
+        the tag, events about other resources refresh the tags of the
+        resource.
+        """
+        match = RESOURCE_URI.search(frame.get('resource_uri') or '')
+        if not match:
+            return
+        type_, uuid = match.groups()
+        try:
+            obj = self._transport.api('GET', '/{}/{}/'.format(type_, uuid))
+        except errors.ClientError as exc:
+            if exc.status_code != 404:
+                raise
+            obj = None
+        with self._lock:
+            if type_ == 'tags':
+                self.names.pop(uuid, None)
+                self.resources.pop(uuid, None)
+                if obj is not None:
+                    self._add(obj)
+                return
+            if obj is not None and 'tags' not in obj:
+                return
+            tag_uuids = set(
+                reference['uuid'] if isinstance(reference, dict)
+                else reference
+                for reference in (obj or {}).get('tags') or ()
+            )
+            for tag_uuid, by_type in self.resources.items():
+                if tag_uuid in tag_uuids:
+                    by_type[type_].add(uuid)
+                else:
+                    by_type[type_].discard(uuid)
+
+    def start(self):
+        self.load()
+        self._stopped.clear()
+        if self.use_websocket and self.client_kwargs.get('api_endpoint') \
+                and not self.ws_endpoint:
+            # the websocket of the config belongs to another endpoint
+            LOG.info('Reloading the tags, no ws_endpoint for %s',
+                     self.client_kwargs['api_endpoint'])
+        elif self.use_websocket:
+            try:
+                self.websocket = resource.Websocket(
+                    timeout=1,
+                    ws_endpoint=self.ws_endpoint,
+                    **self.client_kwargs
+                )
+            except Exception as exc:
+                LOG.info('Reloading the tags, no websocket: %r', exc)
+        if self.reload_interval is None:
+            self.reload_interval = 300 if self.websocket else 30
+        targets = [self._reload_forever]
+        if self.websocket:
+            targets.append(self._listen)
+        for target in targets:
+            thread = threading.Thread(target=target, name='tag-index')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._transport.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _reload_forever(self):
+        while not self._stopped.wait(self.reload_interval):
+            try:
+                self.load()
+            except Exception as exc:
+                LOG.warning('Reloading the tags failed: %r', exc)
+
+    def _listen(self):
+        while not self._stopped.is_set():
+            try:
+                frame = self.websocket.ws.recv(timeout=1)
+            except Exception:
+                # timeouts, and errors the reloading covers for
+                continue
+            try:
+                self.handle_event(frame)
+            except Exception as exc:
+                LOG.debug('Handling %r failed: %r', frame, exc)
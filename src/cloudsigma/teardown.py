@@ -0,0 +1,304 @@
+"""
+Teardown of whole environments: servers, drives, snapshots and tags.
+
+A :class:`Teardown` plans its steps as a
+:class:`cloudsigma.scheduler.TaskGraph`:
+
+* running servers are stopped, then deleted,
+* drives mounted on servers which are kept are detached from them, which
+  needs the servers stopped,
+* drives are deleted after the servers they are mounted on were deleted or
+  detached, and after their snapshots,
+* tags are deleted after the objects of the teardown tagged with them, so
+  that a failed teardown can be found again by its tags.
+
+Independent branches, like the servers of different environments, run in
+parallel. The stops and the deletions of servers and drives are confirmed
+by one :class:`cloudsigma.fleet.StatusWatcher`, from websocket events or
+listings, instead of polling every object.
+
+Usage::
+
+    teardown = Teardown(servers=uuids, tags=[tag_uuid])
+    print(teardown.plan().order())
+    teardown.run().raise_for_failures()
+"""
+from builtins import object
+from collections import OrderedDict
+from functools import partial
+from logging import getLogger
+
+from . import errors, resource
+from .fleet import StatusWatcher
+from .scheduler import FatalError, RetryPolicy, TaskGraph
+from .transport import Transport
+
+LOG = getLogger(__name__)
+
+# the media of the attached drives deleted with their servers, by the
+# recurse option of Server.delete
+ATTACHED_MEDIA = {
+    None: (),
+    'all_drives': ('disk', 'cdrom'),
+    'disks': ('disk',),
+    'cdroms': ('cdrom',),
+}
+
+
+def uuids_of(references):
+    """
+    :return: list of the uuids of references like {'uuid': ...} or of uuids
+    """
+    return [
+        reference['uuid'] if isinstance(reference, dict) else reference
+        for reference in references or ()
+    ]
+
+
+class Teardown(object):
+    """
+    Deletes servers, drives, snapshots and tags in dependency order.
+    """
+
+    def __init__(self, servers=(), drives=(), snapshots=(), tags=(),
+                 attached='all_drives', n_threads=16, timeout=600,
+                 retry_policy=None, watcher=None, ws_endpoint=None,
+                 **kwargs):
+        """
+        :param servers, drives, snapshots, tags:
+            The uuids of the objects to delete.
+        :param attached:
+            Which drives mounted on the servers are deleted with them, like
+            the recurse option of Server.delete: 'all_drives', 'disks',
+            'cdroms' or None.
+        :param n_threads:
+            Number of steps run at once.
+        :param timeout:
+            Seconds a server may take to stop, and a server or drive to be
+            deleted.
+        :param retry_policy:
+            A :class:`cloudsigma.scheduler.RetryPolicy` for the requests.
+        :param watcher:
+            A started :class:`cloudsigma.fleet.StatusWatcher` of servers and
+            drives to share. By default every run starts its own.
+        :param ws_endpoint:
+            The websocket of the api_endpoint, for the watcher.
+        :param kwargs:
+            The client arguments, like api_endpoint.
+        """
+        if attached not in ATTACHED_MEDIA:
+            raise ValueError('Invalid attached {!r}'.format(attached))
+        self.servers = list(servers)
+        self.drives = list(drives)
+        self.snapshots = list(snapshots)
+        self.tags = list(tags)
+        self.attached = attached
+        self.n_threads = n_threads
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=3)
+        self.watcher = watcher
+        self.ws_endpoint = ws_endpoint
+        self.client_kwargs = kwargs
+        self.server = resource.Server(**kwargs)
+        self.drive = resource.Drive(**kwargs)
+        self.snapshot = resource.Snapshot(**kwargs)
+        self._transport = None
+        self._watcher = None
+
+    def _existing(self, client, uuids):
+        """
+        :return: OrderedDict of the details of the objects by uuid, without
+            the ones which do not exist
+        """
+        if not uuids:
+            return OrderedDict()
+        details = dict((obj['uuid'], obj) for obj in client.list_detail())
+        existing = OrderedDict()
+        for uuid in uuids:
+            if uuid in details:
+                existing[uuid] = details[uuid]
+            else:
+                LOG.warning(
+                    'Skipping %s, not found in %s',
+                    uuid,
+                    client.resource_name
+                )
+        return existing
+
+    def plan(self):
+        """
+        Looks up the objects and plans the steps. Steps are keyed by
+        ('stop', uuid), ('detach', server uuid) and ('delete', resource
+        name, uuid).
+
+        :return: the :class:`cloudsigma.scheduler.TaskGraph`
+        """
+        servers = self._existing(self.server, self.servers)
+        media = ATTACHED_MEDIA[self.attached]
+        drive_uuids = list(self.drives)
+        all_drives = None
+        if media and servers:
+            all_drives = dict(
+                (drive['uuid'], drive) for drive in self.drive.list_detail()
+            )
+            for server in servers.values():
+                for attached in server.get('drives') or ():
+                    uuid = uuids_of([attached['drive']])[0]
+                    drive = all_drives.get(uuid)
+                    if drive and drive.get('media') in media and \
+                            uuid not in drive_uuids:
+                        drive_uuids.append(uuid)
+        if all_drives is not None:
+            drives = OrderedDict(
+                (uuid, all_drives[uuid]) for uuid in drive_uuids
+                if uuid in all_drives
+            )
+        else:
+            drives = self._existing(self.drive, drive_uuids)
+        snapshots = self._existing(self.snapshot, self.snapshots)
+
+        graph = TaskGraph(
+            n_threads=self.n_threads,
+            retry_policy=self.retry_policy,
+            name='teardown'
+        )
+        deleted = {}
+        for uuid, server in servers.items():
+            after = []
+            if server['status'] != 'stopped':
+                after.append(graph.add(('stop', uuid), partial(
+                    self._stop, uuid)))
+            deleted[uuid] = graph.add(
+                ('delete', 'servers', uuid),
+                partial(self._delete, 'servers', uuid, True),
+                after
+            )
+        for uuid in snapshots:
+            deleted[uuid] = graph.add(
+                ('delete', 'snapshots', uuid),
+                partial(self._delete, 'snapshots', uuid, False)
+            )
+
+        detach = OrderedDict()
+        for uuid, drive in drives.items():
+            after = [
+                deleted[snapshot_uuid]
+                for snapshot_uuid, snapshot in snapshots.items()
+                if uuids_of([snapshot.get('drive')])[0] == uuid
+            ]
+            for server_uuid in uuids_of(drive.get('mounted_on')):
+                if server_uuid in servers:
+                    after.append(deleted[server_uuid])
+                else:
+                    detach.setdefault(server_uuid, []).append(uuid)
+                    after.append(('detach', server_uuid))
+            deleted[uuid] = graph.add(
+                ('delete', 'drives', uuid),
+                partial(self._delete, 'drives', uuid, True),
+                after
+            )
+        for server_uuid, detached in detach.items():
+            graph.add(
+                ('detach', server_uuid),
+                partial(self._detach, server_uuid, detached)
+            )
+
+        tagged = {}
+        for obj in list(servers.values()) + list(drives.values()) + \
+                list(snapshots.values()):
+            for tag_uuid in uuids_of(obj.get('tags')):
+                tagged.setdefault(tag_uuid, []).append(deleted[obj['uuid']])
+        for uuid in self.tags:
+            graph.add(
+                ('delete', 'tags', uuid),
+                partial(self._delete, 'tags', uuid, False),
+                tagged.get(uuid, ())
+            )
+        return graph
+
+    def run(self):
+        """
+        Plans and runs the teardown.
+
+        :return: the :class:`cloudsigma.scheduler.TaskResult`, with the
+            failed and skipped steps
+        """
+        watcher = self.watcher
+        if watcher is None:
+            watcher = StatusWatcher(
+                resource_classes=[resource.Server, resource.Drive],
+                ws_endpoint=self.ws_endpoint,
+                **self.client_kwargs
+            ).start()
+        self._watcher = watcher
+        self._transport = Transport(self.server.c, pool_size=self.n_threads)
+        try:
+            graph = self.plan()
+            result = graph.run()
+        finally:
+            self._transport.close()
+            if watcher is not self.watcher:
+                watcher.stop()
+        LOG.info(
+            'Teardown of %d steps: %d done, %d failed, %d skipped',
+            len(graph),
+            len(result.succeeded),
+            len(result.failed),
+            len(result.skipped)
+        )
+        return result
+
+    def _wait(self, uuid, status):
+        if not self._watcher.wait_for(uuid, status, self.timeout):
+            raise FatalError('{} is not {} after {}s'.format(
+                uuid,
+                status or 'deleted',
+                self.timeout
+            ))
+
+    def _stop(self, uuid):
+        status = self._watcher.statuses.get(uuid)
+        if status == 'starting':
+            self._wait(uuid, 'running')
+            status = 'running'
+        if status == 'running':
+            self._transport.api(
+                'POST',
+                '/servers/{}/action/'.format(uuid),
+                data={},
+                query_params={'do': 'stop'}
+            )
+        self._wait(uuid, 'stopped')
+
+    def _detach(self, server_uuid, drive_uuids):
+        server = self._transport.api('GET', '/servers/{}/'.format(server_uuid))
+        if server['status'] != 'stopped':
+            raise FatalError(
+                'Server {} is {}, stop it to detach the drives {}'.format(
+                    server_uuid,
+                    server['status'],
+                    ', '.join(drive_uuids)
+                )
+            )
+        server['drives'] = [
+            attached for attached in server['drives']
+            if uuids_of([attached['drive']])[0] not in drive_uuids
+        ]
+        self._transport.api(
+            'PUT',
+            '/servers/{}/'.format(server_uuid),
+            data=server
+        )
+
+    def _delete(self, resource_name, uuid, confirm):
+        try:
+            self._transport.api(
+                'DELETE',
+                '/{}/{}/'.format(resource_name, uuid)
+            )
+        except errors.ClientError as exc:
+            if exc.status_code != 404:
+                raise
+            return
+        if confirm:
+            self._wait(uuid, None)
@@ -0,0 +1,66 @@
+from __future__ import division
+import threading
+import time
+from builtins import object
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket limiting the rate of some resource, e.g.
+    bytes sent per second, over all threads sharing it.
+
+    Consumers take tokens before using the resource and sleep when the
+    bucket is in debt. Taking more tokens than the bucket holds is allowed,
+    the consumer then waits until the debt is paid off, so large chunks
+    still average out to the configured rate.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate:
+            Tokens added per second. None disables the limit.
+        :param burst:
+            Maximum number of tokens the bucket holds, i.e. how much can be
+            used at once after an idle period. Default is one second's worth
+            of tokens.
+        """
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = self.capacity or 0
+        self._updated_at = time.time()
+
+    @property
+    def capacity(self):
+        return self.burst if self.burst is not None else self.rate
+
+    def reserve(self, amount):
+        """
+        Takes *amount* tokens without waiting.
+
+        :return: seconds the caller has to wait before using them
+        """
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def consume(self, amount):
+        """
+        Takes *amount* tokens, sleeping until they are available.
+
+        :return: seconds slept
+        """
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
@@ -0,0 +1,146 @@
+"""
+Concurrent fetching of the history of time-indexed resources, like the
+ledger, the usages and the audit logs.
+
+A time range is fetched as consecutive windows, several at once over one
+pooled :class:`cloudsigma.transport.Transport`. The windows are sized by
+the density of the results seen so far, so each request returns about
+*target_objects* objects: busy periods are split into short windows, quiet
+ones are fetched in long windows. The objects are yielded in time order as
+soon as the windows before them are done.
+"""
+from builtins import object
+import concurrent.futures
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from logging import getLogger
+
+import iso8601
+from past.builtins import basestring
+
+LOG = getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=iso8601.UTC)
+
+
+def to_datetime(value):
+    """
+    :param value: an ISO 8601 string or a datetime, naive ones being UTC
+    :return: a timezone aware datetime
+    """
+    if isinstance(value, basestring):
+        return iso8601.parse_date(value)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=iso8601.UTC)
+    return value
+
+
+def to_microseconds(value):
+    """
+    :param value: an ISO 8601 string or a datetime, naive ones being UTC
+    :return: microseconds since the epoch
+    """
+    delta = to_datetime(value) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + \
+        delta.microseconds
+
+
+class WindowSizer(object):
+    """
+    Sizes the next window by the density of the windows fetched so far.
+    """
+
+    def __init__(self, window, min_window, max_window, target_objects):
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.target_objects = target_objects
+        self.objects = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, window, n_objects):
+        with self._lock:
+            self.objects += n_objects
+            self.seconds += window.total_seconds()
+
+    def next_window(self):
+        with self._lock:
+            if not self.seconds:
+                return self.window
+            if not self.objects:
+                return self.max_window
+            seconds = self.target_objects * self.seconds / self.objects
+        window = timedelta(seconds=seconds)
+        return max(self.min_window, min(self.max_window, window))
+
+
+def fetch_range(fetch, start, end, time_field, window=timedelta(hours=6),
+                min_window=timedelta(minutes=1), max_window=timedelta(days=7),
+                target_objects=2000, n_threads=4):
+    """
+    Fetches the objects of [*start*, *end*) in concurrent windows.
+
+    :param fetch:
+        Called as fetch(window_start, window_end) from worker threads,
+        returns the list of objects of [window_start, window_end).
+    :param start:
+        A datetime or an ISO 8601 string.
+    :param end:
+        A datetime or an ISO 8601 string.
+    :param time_field:
+        The field of the objects holding their time, to order them by.
+    :param window:
+        Size of the first windows, before the density is known.
+    :param target_objects:
+        Objects per window aimed at.
+    :param n_threads:
+        Number of windows fetched at once.
+    :return: a generator of the objects in time order
+    """
+    start, end = to_datetime(start), to_datetime(end)
+    sizer = WindowSizer(window, min_window, max_window, target_objects)
+
+    def fetch_window(window_start, window_end):
+        objects = fetch(window_start, window_end)
+        sizer.record(window_end - window_start, len(objects))
+        LOG.debug(
+            'Fetched %d objects from %s to %s',
+            len(objects),
+            window_start,
+            window_end
+        )
+        return objects
+
+    parsed = {}
+
+    def sort_key(obj):
+        value = obj[time_field]
+        try:
+            return parsed[value]
+        except KeyError:
+            parsed[value] = key = to_microseconds(value)
+            return key
+
+    executor = concurrent.futures.ThreadPoolExecutor(n_threads)
+    pending = deque()
+    next_start = start
+    try:
+        while pending or next_start < end:
+            while next_start < end and len(pending) < n_threads:
+                window_end = min(next_start + sizer.next_window(), end)
+                pending.append(executor.submit(
+                    fetch_window,
+                    next_start,
+                    window_end
+                ))
+                next_start = window_end
+            objects = pending.popleft().result()
+            objects.sort(key=sort_key)
+            for obj in objects:
+                yield obj
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
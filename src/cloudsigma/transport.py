@@ -0,0 +1,88 @@
+from builtins import object
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import errors
+from .generic import get_urljoin
+
+
+USER_AGENT = 'CloudSigma turlo client'
+
+
+class Transport(object):
+    """
+    A pooled HTTP session for bulk transfers, authenticated like the given
+    :class:`cloudsigma.generic.GenericClient`.
+
+    One transport is meant to be shared by all workers of a transfer, so
+    that they reuse a fixed set of keep-alive connections instead of opening
+    a connection per request.
+    """
+
+    def __init__(self, client, pool_size=4):
+        """
+        :param client:
+            The GenericClient providing the endpoint and the credentials.
+        :param pool_size:
+            Maximum number of connections kept open per host. Should be at
+            least the number of threads using the transport.
+        """
+        self.client = client
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['user-agent'] = USER_AGENT
+
+        if client.login_method == client.LOGIN_METHOD_BASIC:
+            self.session.auth = (client.username, client.password)
+        elif client.login_method == client.LOGIN_METHOD_SESSION:
+            self.session.cookies = client._session.cookies
+            for header in ('X-CSRFToken', 'Referer'):
+                if header in client._session.headers:
+                    self.session.headers[header] = \
+                        client._session.headers[header]
+
+    def url(self, path):
+        """
+        Full URL of an API path, e.g. '/drives/'.
+        """
+        return self.client._get_full_url(path)
+
+    def join(self, link):
+        """
+        Resolves a link returned by the API, which may be relative to the
+        API host.
+        """
+        return get_urljoin()(self.client.api_endpoint, link)
+
+    def check(self, response):
+        """
+        Raises the matching :class:`cloudsigma.errors.ApiClientError` unless
+        the response has a 2xx status.
+        """
+        if 200 <= response.status_code < 300:
+            return response
+        self.client._process_response(response)
+        raise errors.ApiClientError(
+            response.text,
+            status_code=response.status_code,
+            request_id=response.headers.get('X-REQUEST-ID', None)
+        )
+
+    def api(self, method, path, data=None, query_params=None,
+            return_list=False):
+        """
+        Makes an API call over the pooled session and returns the processed
+        response like the GenericClient methods do.
+        """
+        kwargs = {'params': query_params}
+        if data is not None:
+            kwargs['data'] = self.client.json.dumps(data)
+            kwargs['headers'] = {'content-type': 'application/json'}
+        response = self.session.request(method, self.url(path), **kwargs)
+        return self.client._process_response(response, return_list)
+
+    def close(self):
+        self.session.close()
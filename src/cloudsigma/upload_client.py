@@ -1,36 +1,22 @@
 from __future__ import division
 from __future__ import print_function
-import urllib.error
-import urllib.request
-import os
-import json
 import itertools
 import logging
-import urllib.parse
-import datetime
 import sys
-import queue
-import threading
 import argparse
-import time
 from past.utils import old_div
-from builtins import str, next, range, object
-from cloudsigma.generic import get_urlparse
+from builtins import next, range
+from cloudsigma.compression import CODECS
+from cloudsigma.delta import DeltaUpload
+from cloudsigma.upload_engine import ChunkLinkProtocol, FileSource, \
+    PROTOCOLS, StreamSource, UploadEngine
 from future import standard_library
 standard_library.install_aliases()
 
 
 LOG = logging.getLogger(__name__)
 
-INIT_HEADERS = {
-    'Content-Type': 'application/json',
-    'Accept': 'application/json'
-}
-
-UPLOAD_HEADERS = {
-    'Content-Type': 'application/octet-stream',
-    'Accept': 'application/json'
-}
+DEFAULT_CHUNK_SIZE = 10 * 1024 ** 2
 
 
 class UploadError(Exception):
@@ -56,7 +42,8 @@ def console_progress():
     return output_progress
 
 
-class CSUploader(object):
+class CSUploader(UploadEngine):
+    default_chunk_size = DEFAULT_CHUNK_SIZE
 
     def __init__(
             self,
@@ -67,235 +54,70 @@ class CSUploader(object):
             password,
             uuid=None,
             n_threads=5,
-            progress_callback=None
+            progress_callback=None,
+            use_journal=True,
+            journal_dir=None,
+            adaptive=False,
+            max_threads=16,
+            retry_policy=None
     ):
+        """
+        Uploads with the chunk link protocol. This is the
+        :class:`cloudsigma.upload_engine.UploadEngine` with the
+        :class:`cloudsigma.upload_engine.ChunkLinkProtocol` and a local image
+        file.
+
+        :param chunk_size:
+            The size of the chunk in bytes. If None, 10MB is used, or in
+            *adaptive* mode a new upload picks it from the file size and the
+            observed RTT.
+        """
         self.api_url = api_url
         self.image_path = image_path
-        self.chunk_size = chunk_size
-        self.username = username
-        self.password = password
-        self.uuid = uuid
-        self.drive_url = None
-        self.n_threads = n_threads
-        self.progress_callback = progress_callback
-        self.queue = queue.Queue()
-        self.spinner_pos = 0
-        self.opener = self.init_auth()
-
-        self.progress_lock = threading.RLock()
-        self.uploaded_size = 0
-
-    def start(self):
-        self.init_drive_url_or_create_drive()
-        LOG.info(
-            'Uploading {image_path} to {drive_url}'.format(
-                drive_url=self.drive_url,
-                image_path=self.image_path
-            )
+        super(CSUploader, self).__init__(
+            FileSource(image_path),
+            protocol=ChunkLinkProtocol(),
+            drive_uuid=uuid,
+            chunk_size=chunk_size,
+            n_threads=n_threads,
+            progress_callback=progress_callback,
+            progress_report_interval=0.5,
+            use_journal=use_journal,
+            journal_dir=journal_dir,
+            adaptive=adaptive,
+            max_threads=max_threads,
+            retry_policy=retry_policy,
+            generic_client_kwargs={
+                'api_endpoint': api_url,
+                'username': username,
+                'password': password,
+            }
         )
-        LOG.info('Total size is {size:0.1f} MB. '
-                 'Number of chunks {n_chunks}.'.format(
-                    size=old_div(self.size, 1024.0 ** 2),
-                    n_chunks=self.size // self.chunk_size))
-
-        self.enqueue_chunks()
 
-        watcher_t = threading.Thread(target=self.queue.join)
-        watcher_t.setDaemon(True)
-        watcher_t.start()
+    @property
+    def uuid(self):
+        return self.drive_uuid
 
-        self.start_threads()
-
-        while watcher_t.is_alive():
-            self.report_progress()
-            time.sleep(0.5)
-        self.report_progress()
+    @property
+    def size(self):
+        return self.file_size
 
+    def start(self):
+        self.upload()
         return self.uuid
 
-    def init_drive_url_or_create_drive(self):
-        self.size = os.path.getsize(self.image_path)
-        if self.uuid:
-            LOG.info('Resuming upload for drive {}'.format(self.uuid))
-            self.drive_url = '{}/drives/{}/'.format(
-                self.api_url.rstrip('/'),
-                self.uuid
-            )
-            remote_size = self.get_drive_size()
-            if self.size != remote_size:
-                raise UploadError(
-                    'Image file size {} differs from drive size {}'.format(
-                        self.size,
-                        remote_size
-                    )
-                )
-        else:
-            self.uuid = self.init_upload()
-            LOG.info(
-                'Initialized an upload for drive with {uuid}.'.format(
-                    uuid=self.uuid
-                )
-            )
-
-            self.drive_url = '{}/drives/{}/'.format(
-                self.api_url.rstrip('/'),
-                self.uuid
-            )
-
-    def init_upload(self, media='disk'):
-        url = '{}/initupload/'.format(self.api_url.rstrip('/'))
-        data = {
-            'name': 'Upload_{:%Y-%m-%d %H:%M:%S}'.format(
-                datetime.datetime.utcnow()),
-            'size': self.size,
-            'media': media
-        }
-        str_data = json.dumps(data)
-        req = urllib.request.Request(url, data=str_data, headers=INIT_HEADERS)
-        response = self.opener.open(req)
-        status = response.getcode()
-        body = response.read()
-        if not 200 <= status <= 299:
-            raise UploadError(
-                'Wrong response status code {}. Response was {}'.format(
-                    status,
-                    body
-                )
-            )
-        response_data = json.loads(body)
-
-        return response_data['objects'][0]['uuid']
-
-    def file_chunks(self):
-        """
-        Yields tuples (chunk_number, chunk_offset, real_chunk_size).
-
-        ``chunk_number`` is the number of the chunk. Numbering starts from 1.
-        ``chunk_offset`` can be used to seek in the file.
-        ``real_chunk_size`` is necessary because the last chunk is bigger
-
-        :return: yields (chunk_number, chunk_offset, real_chunk_size) tuples
-        """
-        n_chunks = self.size // self.chunk_size
-        if n_chunks > 0:
-            # excludes las chunk and starts from 1. last chunk is bigger
-            for chunk in range(n_chunks - 1):
-                offset = chunk * self.chunk_size
-                yield chunk, offset, self.chunk_size
-
-            last_chunk = n_chunks - 1
-            last_offset = last_chunk * self.chunk_size
-            last_chunk_size = self.size - last_offset
-
-            yield last_chunk, last_offset, last_chunk_size
-        else:  # chunk size bigger than file size
-            yield 0, 0, self.size
-
-    def enqueue_chunks(self):
-        for chunk_number, chunk_offset, real_chunk_size in self.file_chunks():
-            self.queue.put((chunk_number, chunk_offset, real_chunk_size))
-
-    def get_drive_size(self):
-        req = urllib.request.Request(self.drive_url, headers=INIT_HEADERS)
-        response = self.opener.open(req)
-        return int(json.loads(response.read())['size'])
-
-    def start_threads(self):
-        for _ in range(self.n_threads):
-            download_thread = threading.Thread(target=self.upload_enqueued)
-            download_thread.setDaemon(True)
-            download_thread.start()
-
-    def upload_enqueued(self):
-        while True:
-            chunk_number, chunk_offset, real_chunk_size = self.queue.get()
-            try:
-                self.upload_chunk(chunk_number, chunk_offset, real_chunk_size)
-            except:
-                LOG.exception(
-                    'Error ocurred for chunk {}'.format(chunk_number))
-                self.queue.put((chunk_number, chunk_offset, real_chunk_size))
-            finally:
-                # Always call task_done even on fail because in order to finish
-                # the number of put calls should be equal to task_done calls
-                self.queue.task_done()
-
-    def upload_chunk(self, chunk_number, chunk_offset, real_chunk_size):
-        try:
-            rel_url = self.get_chunk_upload_link(chunk_number)
-        except urllib.error.HTTPError as exc:
-            if exc.code != 416:
-                raise
-            LOG.info(
-                'skipping chunk {} because it is already uploaded'.format(
-                    chunk_number
-                )
-            )
-            self.update_progress(real_chunk_size)
-            return
-        urlparse = get_urlparse()
-        parsed = urlparse(self.drive_url)
-        upload_url = '{}://{}/{}'.format(
-            parsed.scheme,
-            parsed.hostname,
-            rel_url.lstrip('/')
-        )
-
-        with open(self.image_path, 'r') as f:
-            f.seek(chunk_offset)
-            data = f.read(real_chunk_size)
-            req = urllib.request.Request(
-                str(upload_url),
-                str(data),
-                headers=UPLOAD_HEADERS
-            )
-            self.opener.open(req)
-        self.update_progress(real_chunk_size)
-
-    def report_progress(self):
-        if self.progress_callback:
-            self.progress_callback(self.uploaded_size, self.size)
-
-    def update_progress(self, uploaded_size):
-        self.progress_lock.acquire()
-        self.uploaded_size += uploaded_size
-        self.progress_lock.release()
-
-    def get_chunk_upload_link(self, chunk_number):
-        url = '{drive_url}/action/?do=upload_chunk'.format(
-            drive_url=self.drive_url.rstrip('/')
-        )
-        data = json.dumps(
-            {
-                'chunk_number': chunk_number,
-                'chunk_size': self.chunk_size
-            }
-        )
-        req = urllib.request.Request(url, data, headers=INIT_HEADERS)
-        self.opener = self.init_auth()
-        response = self.opener.open(req)
-        response_data = json.loads(response.read())
-
-        return response_data['link']
-
-    def init_auth(self):
-        password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        password_mgr.add_password(
-            None,
-            self.api_url,
-            self.username,
-            self.password
-        )
-        handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
-        return urllib.request.build_opener(handler)
-
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Upload a disk image to CloudSigma drive.'
     )
 
-    parser.add_argument('disk_image', help='Disk image in RAW format.')
+    parser.add_argument(
+        'disk_image',
+        help='Disk image in RAW format, or - to read it from the standard '
+             'input, e.g. from qemu-img convert -O raw image.qcow2 '
+             '/dev/stdout.'
+    )
 
     parser.add_argument(
         'drive_uuid',
@@ -315,9 +137,10 @@ if __name__ == '__main__':
     parser.add_argument(
         '-s',
         '--chunk-size',
-        help='Size of the chunk. Default is 10MB.',
+        help='Size of the chunk. Default is 10MB, or picked from the file '
+             'size and the RTT with --adaptive.',
         type=int,
-        default=10 * 1024 ** 2
+        default=None
     )
 
     parser.add_argument(
@@ -331,15 +154,71 @@ if __name__ == '__main__':
         '--password',
         help='Password of the CloudSigma user.'
     )
-    args = parser.parse_args()
 
-    api_url = args.api_url
+    parser.add_argument(
+        '-n',
+        '--threads',
+        help='Number of parallel chunk uploads. Default is 5.',
+        type=int,
+        default=5
+    )
+
+    parser.add_argument(
+        '--protocol',
+        help='Upload protocol. Default is chunk_link.',
+        choices=sorted(PROTOCOLS),
+        default=ChunkLinkProtocol.name
+    )
+
+    parser.add_argument(
+        '--no-journal',
+        action='store_true',
+        help='Do not keep an on-disk journal of the uploaded chunks. Without '
+             'the journal a resumed upload asks the server about every chunk.'
+    )
+
+    parser.add_argument(
+        '--size',
+        help='Size of the image in bytes. Required when reading the image '
+             'from the standard input.',
+        type=int,
+        default=None
+    )
+
+    parser.add_argument(
+        '--content-encoding',
+        help='Compress the chunks before sending them. Only supported by '
+             'the chunk_link protocol.',
+        choices=sorted(CODECS),
+        default=None
+    )
+
+    parser.add_argument(
+        '--delta',
+        nargs='?',
+        const='manifest',
+        choices=['manifest', 'remote'],
+        default=None,
+        help='Only upload the chunks which changed since the last upload to '
+             'the drive, found with the manifest saved by the last delta '
+             'upload, or with --delta remote by hashing the drive. The '
+             'upload of the drive must not have finished, the server '
+             'refuses chunks it already has.'
+    )
 
-    image_path = args.disk_image
-    chunk_size = args.chunk_size
-    username = args.username
-    password = args.password
-    uuid = args.drive_uuid
+    parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        help='Adjust the number of parallel chunks to the measured '
+             'throughput.'
+    )
+    args = parser.parse_args()
+    if args.disk_image == '-' and not args.size:
+        parser.error('--size is required when reading from the standard input')
+    if args.delta and (args.disk_image == '-' or
+                       args.protocol != ChunkLinkProtocol.name):
+        parser.error('--delta needs an image file and the chunk_link '
+                     'protocol')
 
     logging.basicConfig(format='%(message)s', level=logging.INFO)
 
@@ -353,21 +232,51 @@ if __name__ == '__main__':
     signal.signal(signal.SIGINT, handler)
 
     try:
-        uploader = CSUploader(
-            api_url,
-            image_path,
-            chunk_size,
-            username,
-            password,
-            uuid,
-            progress_callback=console_progress()
+        if args.disk_image == '-':
+            source = StreamSource(
+                getattr(sys.stdin, 'buffer', sys.stdin),
+                args.size
+            )
+        else:
+            source = FileSource(args.disk_image)
+        upload_kwargs = dict(
+            drive_uuid=args.drive_uuid,
+            chunk_size=args.chunk_size or (
+                None if args.adaptive else DEFAULT_CHUNK_SIZE),
+            n_threads=args.threads,
+            progress_callback=console_progress(),
+            progress_report_interval=0.5,
+            use_journal=not args.no_journal,
+            adaptive=args.adaptive,
+            content_encoding=args.content_encoding,
+            generic_client_kwargs={
+                'api_endpoint': args.api_url,
+                'username': args.username,
+                'password': args.password,
+            }
         )
-        res = uploader.start()
+        if args.delta:
+            if not args.chunk_size and args.delta == 'manifest' and \
+                    args.drive_uuid:
+                # reuse the chunk size of the manifest
+                upload_kwargs['chunk_size'] = None
+            uploader = DeltaUpload(
+                source,
+                remote=args.delta == 'remote',
+                **upload_kwargs
+            )
+        else:
+            uploader = UploadEngine(
+                source,
+                protocol=args.protocol,
+                **upload_kwargs
+            )
+        uploader.upload()
     except:
         LOG.exception('Error')
         sys.exit(1)
 
     LOG.info('\nUpload finished successfully')
 
-    print(res)
+    print(uploader.drive_uuid)
     sys.exit()
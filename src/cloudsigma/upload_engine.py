@@ -0,0 +1,759 @@
+from __future__ import division
+import datetime
+import os
+import threading
+import time
+from builtins import object, range, str
+from logging import getLogger
+
+from past.builtins import basestring
+
+from . import errors
+from .adaptive import AdaptiveConcurrency, initial_chunk_size
+from .compression import CompressionPipeline, get_codec
+from .journal import ChunkJournal
+from .progress import TransferProgress
+from .resource import Drive, ResourceBase
+from .scheduler import FatalError, RetryableError, RetryPolicy, TaskScheduler
+from .transport import Transport
+
+
+LOG = getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 5 * 1024 ** 2
+
+UPLOAD_HEADERS = {
+    'Content-Type': 'application/octet-stream',
+    'Accept': 'application/json'
+}
+
+
+class FileSource(object):
+    """
+    A local image file to be uploaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.split(path)[1]
+        self.size = os.path.getsize(path)
+
+    def read(self, offset, size):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def journal(self, drive_uuid, chunk_size, protocol, journal_dir=None):
+        return ChunkJournal.for_upload(
+            self.path,
+            drive_uuid,
+            chunk_size,
+            protocol,
+            journal_dir=journal_dir
+        )
+
+    def start(self, chunk_size, n_chunks_in_flight):
+        pass
+
+    def release(self, offset, size):
+        pass
+
+
+class StreamSource(object):
+    """
+    An image read sequentially from a stream of a known size, e.g. a pipe,
+    an HTTP response or the output of qemu-img convert.
+
+    Chunks are cut from the stream as the upload asks for them. Data is
+    kept in memory until its chunk is uploaded, so failed chunks can be
+    retried, but at most *window_size* bytes are buffered. Reading a chunk
+    which does not fit in the window waits until earlier chunks are
+    uploaded. Only if no chunk is released for *stall_timeout* seconds, e.g.
+    because the chunks holding the window wait for a retry behind the
+    waiting ones, the read fails with a
+    :class:`cloudsigma.scheduler.RetryableError` to free its worker.
+
+    Streams cannot be journaled, so an interrupted upload resumed with a
+    drive uuid has to send the stream again from the start. Chunks already
+    on the server are read from the stream and skipped.
+    """
+
+    # seconds a read waits for room in the window without any progress
+    stall_timeout = 60
+
+    def __init__(self, stream, size, name='stream', window_size=None):
+        """
+        :param stream:
+            A file-like object with a read(size) method, or an iterator of
+            byte strings.
+        :param size:
+            Total number of bytes the stream yields.
+        :param name:
+            Name of the image, used as the default drive name.
+        :param window_size:
+            Maximum number of bytes buffered. By default the upload engine
+            makes room for twice the number of chunks in flight.
+        """
+        self.stream = stream
+        self.size = size
+        self.name = name
+        self.window_size = window_size
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._buffer = bytearray()
+        self._base = 0
+        self._position = 0
+        self._released = {}
+        self._leftover = b''
+        if hasattr(stream, 'read'):
+            self._next_block = stream.read
+        else:
+            self._next_block = self._next_item(iter(stream))
+
+    def _next_item(self, iterator):
+        def next_block(size):
+            data = self._leftover or next(iterator, b'')
+            self._leftover = data[size:]
+            return data[:size]
+        return next_block
+
+    def journal(self, drive_uuid, chunk_size, protocol, journal_dir=None):
+        return None
+
+    def start(self, chunk_size, n_chunks_in_flight):
+        if self.window_size is None:
+            # the last chunk may be up to twice the chunk size
+            self.window_size = (2 * n_chunks_in_flight + 1) * chunk_size
+
+    def read(self, offset, size):
+        with self._lock:
+            if offset < self._base:
+                raise FatalError(
+                    'Bytes {}-{} of {} were already released'.format(
+                        offset,
+                        offset + size - 1,
+                        self.name
+                    )
+                )
+            deadline = None
+            while self._position < offset + size:
+                self._trim()
+                if self.window_size and \
+                        self._position - self._base >= self.window_size:
+                    # back-pressure, not a failure: wait for room
+                    if deadline is None:
+                        deadline = time.time() + self.stall_timeout
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RetryableError(
+                            'Stream window of {} bytes was full for '
+                            '{}s'.format(self.window_size, self.stall_timeout)
+                        )
+                    base = self._base
+                    self._room.wait(remaining)
+                    if self._base != base:
+                        deadline = None
+                    continue
+                data = self._next_block(
+                    min(offset + size - self._position, 1024 ** 2)
+                )
+                if not data:
+                    raise FatalError(
+                        'Stream {} ended after {} of {} bytes'.format(
+                            self.name,
+                            self._position,
+                            self.size
+                        )
+                    )
+                self._buffer += data
+                self._position += len(data)
+            start = offset - self._base
+            return bytes(self._buffer[start:start + size])
+
+    def release(self, offset, size):
+        """
+        Marks a chunk as uploaded, so its data can be dropped.
+        """
+        with self._lock:
+            self._released[offset] = size
+            self._trim()
+            self._room.notify_all()
+
+    def _trim(self):
+        # must hold self._lock
+        while self._base in self._released:
+            size = self._released[self._base]
+            if self._base + size > self._position:
+                return
+            del self._released[self._base]
+            del self._buffer[:size]
+            self._base += size
+
+
+class ResumableJsProtocol(object):
+    """
+    The resumable.js protocol: chunks are posted as multipart forms to the
+    drive's upload URL. Chunks are numbered from 1 and a GET with the same
+    parameters tells whether a chunk is already on the server.
+    """
+    name = 'resumable'
+    first_chunk_number = 1
+    supports_content_encoding = False
+
+    def upload_chunk(self, engine, chunk_number, chunk_offset,
+                     real_chunk_size, probe):
+        """
+        :return: False if the chunk was already on the server
+        """
+        transport = engine.transport
+        upload_url = transport.url(
+            '/drives/{}/upload/'.format(engine.drive_uuid)
+        )
+        # do str() on numbers because requests multipart encoding
+        # assumes integers are file descriptors
+        resumable_js_data = {
+            'resumableChunkNumber': str(chunk_number),
+            'resumableChunkSize': str(engine.chunk_size),
+            'resumableTotalSize': str(engine.file_size),
+            'resumableIdentifier': engine.source.name,
+            'resumableFilename': engine.source.name,
+        }
+
+        if probe:
+            res = transport.session.get(upload_url, params=resumable_js_data)
+            if 199 < res.status_code < 300:
+                return False
+
+        file_data = engine.read_chunk(chunk_offset, real_chunk_size)
+        resumable_js_data_multipart = list(resumable_js_data.items()) \
+            + [('file', file_data)]
+        transport.check(
+            transport.session.post(
+                upload_url,
+                files=resumable_js_data_multipart
+            )
+        )
+        return True
+
+
+class ChunkLinkProtocol(object):
+    """
+    The chunk link protocol: for every chunk the drive's upload_chunk action
+    returns a short-lived link, and the raw chunk data is posted to it.
+    Chunks are numbered from 0. The action fails with 416 for chunks that
+    are already uploaded.
+    """
+    name = 'chunk_link'
+    first_chunk_number = 0
+    supports_content_encoding = True
+
+    def get_chunk_upload_link(self, engine, chunk_number):
+        res_data = engine.transport.api(
+            'POST',
+            '/drives/{}/action/'.format(engine.drive_uuid),
+            {'chunk_number': chunk_number, 'chunk_size': engine.chunk_size},
+            query_params={'do': 'upload_chunk'}
+        )
+        return res_data['link']
+
+    def upload_chunk(self, engine, chunk_number, chunk_offset,
+                     real_chunk_size, probe):
+        """
+        :return: False if the chunk was already on the server
+        """
+        try:
+            link = self.get_chunk_upload_link(engine, chunk_number)
+        except errors.ClientError as exc:
+            if exc.status_code != 416:
+                raise
+            return False
+
+        data = engine.read_chunk(chunk_offset, real_chunk_size)
+        res = engine.transport.session.post(
+            engine.transport.join(link),
+            data=data,
+            headers=engine.upload_headers
+        )
+        if res.status_code == 415 and engine.codec:
+            raise FatalError(
+                'The server does not accept chunks with the {} content '
+                'encoding, upload without content_encoding'.format(
+                    engine.codec.name
+                )
+            )
+        # timeouts, conflicts and throttling are retried with a fresh link,
+        # other 4xx responses cannot succeed and fail the upload
+        engine.transport.check(res)
+        return True
+
+
+PROTOCOLS = {
+    ResumableJsProtocol.name: ResumableJsProtocol,
+    ChunkLinkProtocol.name: ChunkLinkProtocol,
+}
+
+
+class UploadEngine(ResourceBase):
+    """
+    Uploads a drive image in parallel chunks with a pluggable protocol.
+
+    All chunk requests go through one pooled :class:`Transport`, failed
+    chunks are retried by a :class:`cloudsigma.scheduler.TaskScheduler` and
+    progress is tracked in a :class:`cloudsigma.progress.TransferProgress`.
+    Subscribe to *progress* for the rates, retries and latencies of the
+    chunks as they happen.
+    """
+    resource_name = 'initupload'
+    default_chunk_size = DEFAULT_CHUNK_SIZE
+
+    def __init__(
+            self,
+            source,
+            protocol=None,
+            drive_uuid=None,
+            chunk_size=None,
+            n_threads=4,
+            drive_name=None,
+            drive_media='disk',
+            progress_callback=None,
+            progress_report_interval=1,
+            use_journal=True,
+            journal_dir=None,
+            adaptive=False,
+            max_threads=16,
+            retry_policy=None,
+            transport=None,
+            throttle=None,
+            content_encoding=None,
+            compression_level=None,
+            compress_threads=2,
+            generic_client_kwargs=None
+    ):
+        """
+        :param source:
+            The image to upload, e.g. a :class:`FileSource`.
+        :param protocol:
+            A protocol instance or name, 'resumable' (default) or
+            'chunk_link'.
+        :param drive_uuid:
+            If given will try to resume the upload to the given drive uuid
+        :param chunk_size:
+            The size of the chunk in bytes. Defaults to *default_chunk_size*.
+            In adaptive mode a new upload picks it from the file size and the
+            observed RTT. A resumed upload must use the chunk size it was
+            started with.
+        :param n_threads:
+            Number of parallel upload threads. In adaptive mode this is the
+            initial number of chunks in flight.
+        :param drive_name:
+            The name of the uploaded drive. If not given it will be set to
+            Upload_<current date time>
+        :param drive_media:
+            The media of the uploaded drive. Default is "disk".
+        :param progress_callback:
+            Called as progress_callback(uploaded_size, file_size) when chunks
+            are done, at most every *progress_report_interval* seconds.
+        :param progress_report_interval:
+            Minimum seconds between *progress_callback* calls. Default is 1
+            second.
+        :param use_journal:
+            Keep an on-disk journal of the uploaded chunks. When resuming,
+            chunks recorded in the journal are skipped without asking the
+            server about them.
+        :param journal_dir:
+            Directory for the journal files. See
+            :class:`cloudsigma.journal.ChunkJournal`.
+        :param adaptive:
+            Adjust the number of chunks in flight to the measured throughput
+            and latency, up to *max_threads*. See
+            :class:`cloudsigma.adaptive.AdaptiveConcurrency`.
+        :param retry_policy:
+            A :class:`cloudsigma.scheduler.RetryPolicy` for failed chunks.
+            Errors which retrying cannot fix abort the upload.
+        :param transport:
+            A :class:`cloudsigma.transport.Transport` to share with other
+            transfers. By default the engine creates its own.
+        :param throttle:
+            A :class:`cloudsigma.throttle.TokenBucket` limiting the bytes
+            sent per second. Share one bucket between engines to cap their
+            aggregate bandwidth.
+        :param content_encoding:
+            Compress the chunks with 'gzip' or 'zstd' and send them with a
+            Content-Encoding header. Only the chunk_link protocol supports
+            it. Default is no compression.
+        :param compression_level:
+            Level of the *content_encoding*. See
+            :mod:`cloudsigma.compression` for the defaults.
+        :param compress_threads:
+            Number of threads compressing chunks ahead of the upload
+            threads. Default is 2.
+        :param generic_client_kwargs:
+            Keyword arguments for the GenericClient __init__
+        """
+        self.generic_client_kwargs = generic_client_kwargs or {}
+        super(UploadEngine, self).__init__(**self.generic_client_kwargs)
+        if protocol is None or isinstance(protocol, basestring):
+            protocol = PROTOCOLS[protocol or ResumableJsProtocol.name]()
+        self.source = source
+        self.protocol = protocol
+        self.drive_uuid = drive_uuid
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads
+        self.adaptive = adaptive
+        self.max_threads = max_threads
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.use_journal = use_journal
+        self.journal_dir = journal_dir
+        self.progress_report_interval = progress_report_interval
+        self.create_data = {
+            'name': drive_name or 'Upload_{:%Y-%m-%d %H:%M:%S}'.format(
+                datetime.datetime.utcnow()),
+            'media': drive_media,
+            'size': self.file_size
+        }
+
+        self.dc = Drive(**self.generic_client_kwargs)
+        self._transport = transport
+        self.throttle = throttle
+        self.codec = get_codec(content_encoding, compression_level)
+        if self.codec and not self.protocol.supports_content_encoding:
+            raise ValueError(
+                'The {} protocol does not support content encoding'.format(
+                    self.protocol.name
+                )
+            )
+        self.compress_threads = compress_threads
+        self.pipeline = None
+        self.sent_size = 0
+        self._sent_lock = threading.Lock()
+        self.progress = TransferProgress(
+            self.file_size,
+            progress_callback,
+            report_interval=progress_report_interval
+        )
+        self.journal = None
+        self.scheduler = None
+        self.result = None
+        self.finished = False
+        self.rtt = None
+        self._drive_size = None
+        # Whether chunks have to be checked on the server before uploading.
+        # Only needed when resuming, a freshly created drive is empty.
+        self.probe_chunks = True
+
+    @property
+    def file_size(self):
+        return self.source.size
+
+    @property
+    def chunks_in_flight(self):
+        """
+        Maximum number of chunks being uploaded at a time.
+        """
+        return self.max_threads if self.adaptive else self.n_threads
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            self._transport = Transport(
+                self.c,
+                pool_size=self.chunks_in_flight
+            )
+        return self._transport
+
+    @property
+    def uploaded_size(self):
+        return self.progress.done
+
+    @property
+    def remote_size(self):
+        if self._drive_size:
+            return self._drive_size
+
+        started = time.time()
+        drive = self.dc.get(self.drive_uuid)
+        self.rtt = time.time() - started
+        self._drive_size = drive['size']
+
+        return self._drive_size
+
+    def prepare(self):
+        """
+        Creates the drive or checks the drive being resumed, picks the chunk
+        size and opens the journal.
+        """
+        new_upload = not self.drive_uuid
+        if new_upload:
+            drive = self.create(self.create_data)
+            self.drive_uuid = drive['uuid']
+            self.probe_chunks = False
+            LOG.info(
+                'Initialized an upload for drive with {uuid}.'.format(
+                    uuid=self.drive_uuid
+                )
+            )
+        else:
+            # also after a failed run of a new drive, whose chunks may be on
+            # the server without being in the journal
+            self.probe_chunks = True
+            LOG.info('Resuming upload for drive {}'.format(self.drive_uuid))
+
+        if self.remote_size != self.file_size:
+            raise ValueError(
+                'File {} has different size from remote drive {}:'
+                ' {} != {}'.format(
+                    self.source.name,
+                    self.drive_uuid,
+                    self.file_size,
+                    self.remote_size
+                )
+            )
+
+        if not self.chunk_size:
+            if self.adaptive and new_upload:
+                self.chunk_size = initial_chunk_size(
+                    self.file_size,
+                    self.rtt,
+                    n_threads=self.n_threads
+                )
+                LOG.debug(
+                    'Picked chunk size {} for RTT {:0.3f}s'.format(
+                        self.chunk_size,
+                        self.rtt
+                    )
+                )
+            else:
+                self.chunk_size = self.default_chunk_size
+
+        if self.use_journal:
+            self.journal = self.source.journal(
+                self.drive_uuid,
+                self.chunk_size,
+                self.protocol.name,
+                journal_dir=self.journal_dir
+            )
+            if self.journal and self.journal.exists:
+                LOG.info(
+                    'Journal has {} completed chunks, skipping them'.format(
+                        len(self.journal.completed)
+                    )
+                )
+        n_chunks_in_flight = self.chunks_in_flight
+        if self.codec:
+            n_chunks_in_flight += self.compress_threads * 2
+        self.source.start(self.chunk_size, n_chunks_in_flight)
+        self.progress.reset()
+        self.finished = False
+        LOG.info(
+            'Uploading {name} to drive {uuid}. Total size is {size:0.1f} MB. '
+            'Number of chunks {n_chunks}.'.format(
+                name=self.source.name,
+                uuid=self.drive_uuid,
+                size=self.file_size / 1024.0 ** 2,
+                n_chunks=max(1, self.file_size // self.chunk_size)
+            )
+        )
+
+    def upload(self):
+        self.prepare()
+        self.scheduler = self.make_scheduler()
+        chunks = self.pending_chunks()
+        if self.codec:
+            chunks = list(chunks)
+            self.pipeline = CompressionPipeline(
+                self.source,
+                self.codec,
+                chunks,
+                n_threads=self.compress_threads,
+                lookahead=self.compress_threads * 2
+            )
+        self.scheduler.start(chunks)
+
+        LOG.debug('waiting for the upload to finish')
+        try:
+            self.scheduler.wait()
+        except BaseException:
+            self.scheduler.cancel()
+            raise
+        finally:
+            if self.pipeline:
+                self.pipeline.close()
+                self.pipeline = None
+        return self.finish(self.scheduler.result)
+
+    def finish(self, result):
+        """
+        Records the outcome of a run, keeps the journal of a failed run for
+        resuming and raises :class:`cloudsigma.scheduler.TaskError` if any
+        chunk failed.
+        """
+        self.progress.finish()
+        self.finished = True
+        self.result = result
+
+        if self.journal:
+            if self.result.ok:
+                self.journal.discard()
+            else:
+                self.journal.close()
+
+        LOG.debug('upload finished: {!r}'.format(self.result))
+        self.result.raise_for_failures()
+        return self.result
+
+    def retry(self):
+        return self.upload()
+
+    def cancel(self):
+        """
+        Cancels a running upload. Chunks being sent are finished and
+        recorded in the journal, so the upload can be resumed.
+        """
+        if self.scheduler:
+            self.scheduler.cancel()
+
+    def file_chunks(self):
+        """
+        Yields tuples (chunk_number, chunk_offset, real_chunk_size).
+
+        ``chunk_number`` is the number of the chunk. Numbering starts from
+        the protocol's *first_chunk_number*.
+        ``chunk_offset`` can be used to seek in the file.
+        ``real_chunk_size`` is necessary because the last chunk is bigger
+
+        :return: yields (chunk_number, chunk_offset, real_chunk_size) tuples
+        """
+        first = self.protocol.first_chunk_number
+        n_chunks = self.file_size // self.chunk_size
+        if n_chunks > 0:
+            # excludes last chunk. last chunk is bigger
+            for chunk in range(n_chunks - 1):
+                offset = chunk * self.chunk_size
+                yield chunk + first, offset, self.chunk_size
+
+            last_chunk = n_chunks - 1
+            last_offset = last_chunk * self.chunk_size
+            last_chunk_size = self.file_size - last_offset
+
+            yield last_chunk + first, last_offset, last_chunk_size
+        else:  # chunk size bigger than file size
+            yield first, 0, self.file_size
+
+    def pending_chunks(self):
+        """
+        Yields the chunks from :meth:`file_chunks` which are not recorded as
+        done in the journal.
+        """
+        for chunk in self.file_chunks():
+            chunk_number, chunk_offset, real_chunk_size = chunk
+            if self.journal and self.journal.is_done(chunk_number):
+                LOG.debug(
+                    'Chunk {} is in the journal, skipping'.format(chunk_number)
+                )
+                self.progress.skip(real_chunk_size, chunk=chunk)
+                continue
+            yield chunk
+
+    def make_scheduler(self):
+        n_threads = self.n_threads
+        concurrency = None
+        if self.adaptive:
+            concurrency = AdaptiveConcurrency(
+                initial=self.n_threads,
+                maximum=self.max_threads
+            )
+            n_threads = self.max_threads
+        return TaskScheduler(
+            self.upload_enqueued,
+            n_threads=n_threads,
+            retry_policy=self.retry_policy,
+            concurrency=concurrency,
+            item_size=lambda chunk: chunk[2],
+            on_failure=self.chunk_failed,
+            name='upload'
+        )
+
+    def upload_enqueued(self, chunk):
+        chunk_number, chunk_offset, real_chunk_size = chunk
+        LOG.debug(
+            'Uploading chunk {}:{}:{}'.format(
+                chunk_number,
+                chunk_offset,
+                real_chunk_size
+            )
+        )
+        self.progress.chunk_started()
+        started = time.time()
+        sent = self.upload_chunk(chunk_number, chunk_offset, real_chunk_size)
+        self.chunk_done(chunk, sent, time.time() - started)
+
+    def chunk_done(self, chunk, sent, latency=None):
+        """
+        Records an uploaded chunk in the journal and the progress.
+
+        :param sent: False if the chunk was already on the server
+        :param latency: seconds the upload of the chunk took
+        """
+        chunk_number, chunk_offset, real_chunk_size = chunk
+        if self.journal:
+            self.journal.mark_done(chunk_number)
+        self.source.release(chunk_offset, real_chunk_size)
+        if not sent:
+            LOG.debug('Chunk {} already uploaded'.format(chunk_number))
+        self.progress.chunk_done(
+            real_chunk_size,
+            sent=sent,
+            latency=latency,
+            chunk=chunk
+        )
+
+    def chunk_failed(self, chunk, exc, retrying):
+        self.progress.chunk_failed(exc, retrying, chunk=chunk)
+
+    def upload_chunk(self, chunk_number, chunk_offset, real_chunk_size):
+        """
+        Uploads one chunk with the protocol.
+
+        :return: False if the chunk was already on the server
+        """
+        return self.protocol.upload_chunk(
+            self,
+            chunk_number,
+            chunk_offset,
+            real_chunk_size,
+            self.probe_chunks
+        )
+
+    @property
+    def upload_headers(self):
+        if not self.codec:
+            return UPLOAD_HEADERS
+        headers = dict(UPLOAD_HEADERS)
+        headers['Content-Encoding'] = self.codec.name
+        return headers
+
+    def read_chunk(self, chunk_offset, real_chunk_size):
+        """
+        Reads a chunk from the source to be sent, compressed with the
+        *content_encoding* if any, waiting for the bandwidth budget of the
+        *throttle*.
+        """
+        if not self.codec:
+            data = self.source.read(chunk_offset, real_chunk_size)
+        elif self.pipeline:
+            data = self.pipeline.get(chunk_offset, real_chunk_size)
+        else:
+            data = self.codec.compress(
+                self.source.read(chunk_offset, real_chunk_size)
+            )
+        with self._sent_lock:
+            self.sent_size += len(data)
+        if self.throttle:
+            self.throttle.consume(len(data))
+        return data
+
+    def update_progress(self, uploaded_size):
+        self.progress.add(uploaded_size)
+
+    def report_progress(self):
+        self.progress.report()
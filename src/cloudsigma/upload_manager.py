@@ -0,0 +1,310 @@
+from __future__ import division
+import functools
+import heapq
+import itertools
+import threading
+import time
+from builtins import object
+from logging import getLogger
+
+from past.builtins import basestring
+
+from .progress import TransferProgress
+from .resource import Drive
+from .scheduler import RetryPolicy, TaskError, TaskResult, TaskScheduler
+from .throttle import TokenBucket
+from .transport import Transport
+from .upload_engine import FileSource, UploadEngine
+
+
+LOG = getLogger(__name__)
+
+
+class UploadManager(object):
+    """
+    Uploads many images through one pool of worker threads.
+
+    Chunks of all images share the workers, one pooled
+    :class:`cloudsigma.transport.Transport` and an optional aggregate
+    bandwidth cap, instead of every upload running its own thread pool.
+
+    Chunks are handed out in proportion to the *priority* of their image:
+    an image with priority 2 gets twice the bytes of an image with priority
+    1 while both have chunks left. Once an image is done, its share goes to
+    the remaining ones.
+    """
+
+    def __init__(
+            self,
+            n_threads=8,
+            bandwidth=None,
+            retry_policy=None,
+            progress_callback=None,
+            progress_report_interval=1,
+            generic_client_kwargs=None
+    ):
+        """
+        :param n_threads:
+            Number of chunks uploaded at a time over all images. Default is 8.
+        :param bandwidth:
+            Aggregate upload limit in bytes per second. Default is no limit.
+        :param retry_policy:
+            A :class:`cloudsigma.scheduler.RetryPolicy` for failed chunks.
+        :param progress_callback:
+            Called as progress_callback(uploaded_size, total_size) over all
+            images when chunks are done, at most every
+            *progress_report_interval* seconds. Use :meth:`status` for the
+            progress of every image, or :meth:`subscribe` for detailed
+            progress events.
+        :param progress_report_interval:
+            Minimum seconds between *progress_callback* calls. Default is 1
+            second.
+        :param generic_client_kwargs:
+            Keyword arguments for the GenericClient __init__
+        """
+        self.generic_client_kwargs = generic_client_kwargs or {}
+        self.n_threads = n_threads
+        self.throttle = TokenBucket(bandwidth) if bandwidth else None
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.progress_callback = progress_callback
+        self.progress_report_interval = progress_report_interval
+        self.transport = Transport(
+            Drive(**self.generic_client_kwargs).c,
+            pool_size=n_threads
+        )
+
+        self.uploads = []
+        self.priorities = []
+        self.listeners = []
+        self.scheduler = None
+        self.result = None
+        self._reported_at = None
+        self._report_lock = threading.Lock()
+
+    @property
+    def bandwidth(self):
+        return self.throttle.rate if self.throttle else None
+
+    @bandwidth.setter
+    def bandwidth(self, bandwidth):
+        """
+        Changes the bandwidth limit, also while uploading. None removes
+        the limit.
+        """
+        if not bandwidth:
+            self._set_throttle(None)
+        elif self.throttle is None:
+            self._set_throttle(TokenBucket(bandwidth))
+        else:
+            self.throttle.rate = bandwidth
+
+    def _set_throttle(self, throttle):
+        self.throttle = throttle
+        for engine in self.uploads:
+            engine.throttle = throttle
+
+    def add(
+            self,
+            image,
+            priority=1,
+            protocol=None,
+            drive_uuid=None,
+            chunk_size=None,
+            drive_name=None,
+            drive_media='disk',
+            use_journal=True,
+            journal_dir=None
+    ):
+        """
+        Adds an image to upload.
+
+        :param image:
+            Path of the image or a source like
+            :class:`cloudsigma.upload_engine.FileSource`.
+        :param priority:
+            Relative share of the bandwidth for this image. Default is 1.
+        :return:
+            The :class:`cloudsigma.upload_engine.UploadEngine` of the image.
+            See it for the remaining parameters.
+        """
+        if priority <= 0:
+            raise ValueError('priority must be positive, got {}'.format(
+                priority
+            ))
+        if isinstance(image, basestring):
+            image = FileSource(image)
+        engine = UploadEngine(
+            image,
+            protocol=protocol,
+            drive_uuid=drive_uuid,
+            chunk_size=chunk_size,
+            n_threads=self.n_threads,
+            drive_name=drive_name,
+            drive_media=drive_media,
+            use_journal=use_journal,
+            journal_dir=journal_dir,
+            retry_policy=self.retry_policy,
+            transport=self.transport,
+            throttle=self.throttle,
+            generic_client_kwargs=self.generic_client_kwargs
+        )
+        engine.progress.subscribe(
+            functools.partial(self._on_progress, engine)
+        )
+        self.uploads.append(engine)
+        self.priorities.append(priority)
+        return engine
+
+    def subscribe(self, listener):
+        """
+        Adds a callable which is called with the
+        :class:`cloudsigma.progress.ProgressEvent` of every image. The
+        *source* attribute of the events is the source of the image.
+        """
+        self.listeners.append(listener)
+
+    @property
+    def total_size(self):
+        return sum(engine.file_size for engine in self.uploads)
+
+    @property
+    def uploaded_size(self):
+        return sum(engine.uploaded_size for engine in self.uploads)
+
+    def status(self):
+        """
+        :return: a list of dictionaries with the progress of every image
+        """
+        return [
+            {
+                'name': engine.source.name,
+                'drive_uuid': engine.drive_uuid,
+                'priority': priority,
+                'size': engine.file_size,
+                'uploaded': engine.uploaded_size,
+                'rate': engine.progress.rate,
+                'finished': engine.finished,
+                'ok': engine.result.ok if engine.result else None,
+            }
+            for engine, priority in zip(self.uploads, self.priorities)
+        ]
+
+    def interleaved_chunks(self):
+        """
+        Yields (upload_index, chunk) tuples of all pending chunks, ordered by
+        stride scheduling: every image advances a virtual clock by the size
+        of its chunks divided by its priority, and the image with the
+        earliest clock goes next.
+        """
+        counter = itertools.count()
+        heap = []
+        for index, engine in enumerate(self.uploads):
+            chunks = engine.pending_chunks()
+            for chunk in chunks:
+                heap.append((0, next(counter), index, chunk, chunks))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            clock, _, index, chunk, chunks = heapq.heappop(heap)
+            yield index, chunk
+            clock += chunk[2] / self.priorities[index]
+            for chunk in chunks:
+                heapq.heappush(
+                    heap,
+                    (clock, next(counter), index, chunk, chunks)
+                )
+                break
+
+    def run(self):
+        """
+        Uploads all added images. Drives are created or checked first, then
+        the chunks of all images are uploaded together.
+
+        :return:
+            The aggregate :class:`cloudsigma.scheduler.TaskResult` with
+            (upload_index, chunk) items. Every engine gets the result of its
+            own chunks as its *result* attribute.
+        :raises cloudsigma.scheduler.TaskError: if any chunk failed
+        """
+        for engine in self.uploads:
+            engine.prepare()
+
+        self.scheduler = TaskScheduler(
+            self.upload_enqueued,
+            n_threads=self.n_threads,
+            retry_policy=self.retry_policy,
+            item_size=lambda item: item[1][2],
+            on_failure=self.chunk_failed,
+            name='upload'
+        )
+        self.scheduler.start(self.interleaved_chunks())
+        try:
+            self.scheduler.wait()
+        except BaseException:
+            self.scheduler.cancel()
+            raise
+        self.result = self.scheduler.result
+
+        for index, engine in enumerate(self.uploads):
+            try:
+                engine.finish(self.split_result(index))
+            except TaskError as exc:
+                LOG.error('Upload of {} failed: {}'.format(
+                    engine.source.name,
+                    exc
+                ))
+        self.report_progress()
+        self.result.raise_for_failures()
+        return self.result
+
+    def split_result(self, index):
+        """
+        The part of the aggregate result which belongs to an upload. Retries
+        are only counted in the aggregate result.
+        """
+        result = TaskResult()
+        result.succeeded = [
+            chunk for i, chunk in self.result.succeeded if i == index
+        ]
+        result.failed = dict(
+            (chunk, exc) for (i, chunk), exc in self.result.failed.items()
+            if i == index
+        )
+        result.cancelled = self.result.cancelled
+        return result
+
+    def cancel(self):
+        """
+        Cancels all uploads. Chunks being sent are finished and recorded in
+        the journals, so the uploads can be resumed.
+        """
+        if self.scheduler:
+            self.scheduler.cancel()
+
+    def upload_enqueued(self, item):
+        index, chunk = item
+        self.uploads[index].upload_enqueued(chunk)
+
+    def chunk_failed(self, item, exc, retrying):
+        index, chunk = item
+        self.uploads[index].chunk_failed(chunk, exc, retrying)
+
+    def _on_progress(self, engine, event):
+        event.source = engine.source
+        for listener in list(self.listeners):
+            listener(event)
+        if event.kind not in (TransferProgress.CHUNK_DONE,
+                              TransferProgress.CHUNK_SKIPPED):
+            return
+        now = time.time()
+        with self._report_lock:
+            if self._reported_at is not None and \
+                    now - self._reported_at < self.progress_report_interval:
+                return
+            self._reported_at = now
+        self.report_progress()
+
+    def report_progress(self):
+        if self.progress_callback:
+            self.progress_callback(self.uploaded_size, self.total_size)
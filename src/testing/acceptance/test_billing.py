@@ -1,7 +1,9 @@
 import unittest
+from decimal import Decimal
 from nose.plugins.attrib import attr
 
 import cloudsigma.resource as cr
+from cloudsigma.pricing import PricingEngine
 
 from testing.utils import DumpResponse
 
@@ -51,3 +53,36 @@ class BillingDocs(unittest.TestCase):
             client.get()
         with DumpResponse(clients=[client])('licenses_schema'):
             client.get_schema()
+
+
+@attr('acceptance_test')
+class PricingEngineTest(unittest.TestCase):
+
+    def test_price_matches_subscription_calculator(self):
+        engine = PricingEngine()
+        calculator = cr.SubscriptionCalculator()
+        quotes = [
+            (2000, '1 month', 'cpu'),
+            (4 * 1024 ** 3, '1 month', 'mem'),
+            (50 * 1024 ** 3, '3 months', 'dssd'),
+            (8000, '1 year', 'cpu'),
+            (16 * 1024 ** 3, '2 years', 'mem'),
+        ]
+        for amount, period, resource_type in quotes:
+            expected = Decimal(str(
+                calculator.get_price(amount, period, resource_type)
+            ))
+            price = engine.price(amount, period, resource_type)
+            self.assertAlmostEqual(
+                price,
+                expected,
+                delta=Decimal('0.01'),
+                msg='{} {} for {}'.format(amount, resource_type, period)
+            )
+
+        prices, total = engine.price_many(
+            dict(amount=amount, period=period, resource=resource_type)
+            for amount, period, resource_type in quotes
+        )
+        self.assertEqual(len(prices), len(quotes))
+        self.assertEqual(total, sum(prices))
@@ -16,6 +16,7 @@ import cloudsigma.resource as cr
 from testing.acceptance.common import StatefulResourceTestBase
 from cloudsigma.generic import GenericClient
 from cloudsigma import upload_client
+from cloudsigma.download import Download
 from testing.utils import DumpResponse
 
 
@@ -134,6 +135,19 @@ class UploadTest(StatefulResourceTestBase):
         self.assertTrue(200 <= status <= 299,
                         'Download returned an error status {}. STDERR:\n{}'.format(status, p_stderr))
 
+    def do_parallel_download(self, uuid):
+        sleep(180)
+        self.addCleanup(self.del_file, self.downloaded_path)
+        download = Download(
+            uuid,
+            self.downloaded_path,
+            chunk_size=1024 ** 2,
+            use_journal=False
+        )
+        result = download.download()
+        LOG.debug('Download finished: {!r}'.format(result))
+        self.assertTrue(result.ok)
+
     def compare_upload_and_download(self):
 
         downloaded_size = os.stat(self.downloaded_path).st_size
@@ -165,6 +179,13 @@ class UploadTest(StatefulResourceTestBase):
         self.do_download(uuid)
         self.compare_upload_and_download()
 
+    def test_upload_and_parallel_download(self):
+        uuid, p_stderr = self.do_upload()
+        self.addCleanup(self._clean_drives, [uuid])
+        self._wait_for_status(uuid, 'unmounted', cr.Drive())
+        self.do_parallel_download(uuid)
+        self.compare_upload_and_download()
+
     def test_curl_upload_and_download(self):
         uuid, p_stderr = self.do_curl_upload()
         self.addCleanup(self._clean_drives, [uuid])
@@ -0,0 +1,141 @@
+"""
+Compares the per server attribution of burst charges of cloudsigma.billing
+with the loop over the ledger entries of the previous samples/server_bill.py,
+on generated usages polled every five minutes.
+
+Run from the src directory, for example::
+
+    python -m testing.benchmarks.bench_billing --servers 200 --days 7
+"""
+from __future__ import division, print_function
+import argparse
+import bisect
+import random
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from cloudsigma import billing
+
+INTERVAL = 300
+SERVER_RESOURCES = ['cpu', 'mem']
+DRIVE_RESOURCES = ['dssd']
+
+
+def make_account(n_servers, days, seed=0):
+    """
+    :return: tuple of the servers, the usages and the ledger entries
+    """
+    rng = random.Random(seed)
+    servers = []
+    objects = []
+    for _ in range(n_servers):
+        server_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+        drives = [
+            {'drive': {'uuid': str(uuid.UUID(int=rng.getrandbits(128)))}}
+            for _ in range(rng.randint(1, 2))
+        ]
+        servers.append({'uuid': server_uuid, 'drives': drives})
+        objects.extend((server_uuid, name) for name in SERVER_RESOURCES)
+        objects.extend(
+            (drive['drive']['uuid'], name)
+            for drive in drives for name in DRIVE_RESOURCES
+        )
+
+    start = datetime(2020, 1, 1)
+    usages = []
+    ledger = []
+    for step in range(days * 86400 // INTERVAL):
+        poll_time = start + timedelta(seconds=step * INTERVAL)
+        totals = defaultdict(int)
+        for object_uuid, name in objects:
+            amount = rng.randint(0, 4000)
+            totals[name] += amount
+            usages.append({
+                'uuid': object_uuid,
+                'resource': name,
+                'amount': str(amount),
+                'poll_time': poll_time.isoformat() + '+00:00',
+            })
+        ledger_time = poll_time + timedelta(seconds=1)
+        for name, total in sorted(totals.items()):
+            ledger.append({
+                'amount': '{:.8f}'.format(rng.random()),
+                'billing_cycle': step + 1,
+                'interval': INTERVAL,
+                'reason': 'Burst: {} of {} for {} seconds'.format(
+                    total, name, INTERVAL),
+                'resource_amount': str(total),
+                'time': ledger_time.isoformat() + '+00:00',
+            })
+    return servers, usages, ledger
+
+
+def parse_time(value):
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def loop_attribution(servers, usages, ledger):
+    """
+    The loop of the previous sample, without the API requests.
+    """
+    owners = billing.server_owners(servers)
+    usages = sorted(usages, key=lambda usage: usage['poll_time'])
+    bisect_list = [parse_time(usage['poll_time']) for usage in usages]
+    result = defaultdict(int)
+    for entry in ledger:
+        if not entry['billing_cycle']:
+            continue
+        match = billing.BURST_REASON.search(entry['reason'])
+        if not match:
+            continue
+        start_date = parse_time(entry['time']) - timedelta(
+            seconds=entry['interval'] - 1)
+        index = bisect.bisect_left(bisect_list, start_date)
+        while index != len(bisect_list):
+            usage = usages[index]
+            index += 1
+            if usage['poll_time'] >= entry['time']:
+                break
+            if usage['resource'] != match.group(1):
+                continue
+            server = owners.get(usage['uuid'])
+            if server:
+                result[server] += Decimal(usage['amount']) / \
+                    Decimal(entry['resource_amount']) * \
+                    Decimal(entry['amount'])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--servers', type=int, default=200)
+    parser.add_argument('--days', type=int, default=7)
+    args = parser.parse_args()
+
+    servers, usages, ledger = make_account(args.servers, args.days)
+    print('{} servers, {} usages, {} ledger entries'.format(
+        args.servers, len(usages), len(ledger)))
+
+    started = time.time()
+    expected = loop_attribution(servers, usages, ledger)
+    print('loop          {:8.2f} s'.format(time.time() - started))
+
+    started = time.time()
+    attribution = billing.attribute(
+        ledger, usages, billing.server_owners(servers))
+    print('vectorized    {:8.2f} s'.format(time.time() - started))
+
+    result = attribution.by_server()
+    assert sorted(result) == sorted(expected)
+    # the loop rounds every share to 28 digits, the engine only the sums
+    difference = max(
+        abs(result[server] - expected[server]) for server in expected)
+    print('largest difference {:.3E}, total {}'.format(
+        difference, attribution.total()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Compares cloning replicated clusters on the stand-in one clone after the
+other, feeding the uuids of the earlier replicas into the avoid list of the
+next, with cloudsigma.clones.CloneBatch.
+
+Every cluster clones its own source drive into replicas which avoid each
+other, and the stand-in places every clone on the least used storage host
+outside of its avoid list. Run from the src directory, for example::
+
+    python -m testing.benchmarks.bench_clones --clusters 20 --replicas 3
+"""
+from __future__ import division, print_function
+import argparse
+import time
+from collections import Counter
+
+from cloudsigma.clones import CloneBatch
+from cloudsigma.resource import Drive
+from testing.benchmarks import standin
+
+
+def serial_clones(drive, sources, replicas, poll_interval=0.5):
+    clusters = []
+    for index, source in enumerate(sources):
+        uuids = []
+        for replica in range(replicas):
+            uuids.append(drive.clone(
+                source,
+                {'name': 'serial-{}-{}'.format(index, replica)},
+                avoid=list(uuids)
+            )['uuid'])
+        clusters.append(uuids)
+    for uuid in [uuid for uuids in clusters for uuid in uuids]:
+        while drive.get(uuid)['status'] != 'unmounted':
+            time.sleep(poll_interval)
+    return clusters
+
+
+def batch_clones(client_kwargs, sources, replicas, n_threads):
+    batch = CloneBatch(n_threads=n_threads, **client_kwargs)
+    keys = [
+        batch.replicas('cluster-{}'.format(index), 'drives', source, replicas)
+        for index, source in enumerate(sources)
+    ]
+    result = batch.run()
+    result.raise_for_failures()
+    return [[batch.clones[key]['uuid'] for key in cluster] for cluster in keys]
+
+
+def colocated(store, clusters):
+    """
+    :return: number of replicas on the same host as another replica of
+        their cluster
+    """
+    return sum(
+        count - 1
+        for uuids in clusters
+        for count in Counter(store.hosts[uuid] for uuid in uuids).values()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--transition', type=float, default=2,
+                        help='Seconds a clone takes to finish.')
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='Seconds the server waits per request.')
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    server, store, endpoint = standin.serve(
+        latency=args.latency,
+        transition=args.transition
+    )
+    client_kwargs = {
+        'api_endpoint': endpoint,
+        'username': 'bench@example.com',
+        'password': 'bench',
+    }
+    sources = []
+    for index in range(args.clusters):
+        source = store.create(1024, 'source-{}'.format(index))
+        source['status'] = 'unmounted'
+        sources.append(source['uuid'])
+    print('{} clusters of {} replicas, {:0.1f}s clones, {:0.0f} ms '
+          'latency'.format(args.clusters, args.replicas, args.transition,
+                           args.latency * 1000))
+    try:
+        for name, clone in [
+                ('serial clones',
+                 lambda: serial_clones(
+                     Drive(**client_kwargs), sources, args.replicas)),
+                ('batch clones',
+                 lambda: batch_clones(
+                     client_kwargs, sources, args.replicas, args.threads))]:
+            started = time.time()
+            clusters = clone()
+            print('{:<16} {:7.1f}s {} clones, {} co-located'.format(
+                name,
+                time.time() - started,
+                sum(len(uuids) for uuids in clusters),
+                colocated(store, clusters)
+            ))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Measures the requests reaching the stand-in server when many threads get
+the same drive at once through one client, like upload workers asking for
+its size or waiters refreshing it after a websocket event, with and without
+GET coalescing.
+
+Run from the src directory, for example::
+
+    python -m testing.benchmarks.bench_coalesce --threads 64 --rounds 20
+"""
+from __future__ import division, print_function
+import argparse
+import threading
+import time
+
+from cloudsigma.resource import Drive
+from testing.benchmarks import standin
+
+
+def storm(drive, drive_uuid, n_threads, rounds):
+    """
+    :return: the seconds taken by *rounds* of *n_threads* concurrent GETs
+    """
+    def get(gate):
+        gate.wait()
+        drive.get(drive_uuid)
+
+    elapsed = 0
+    for _ in range(rounds):
+        gate = threading.Event()
+        threads = [
+            threading.Thread(target=get, args=(gate,))
+            for _ in range(n_threads)
+        ]
+        for thread in threads:
+            thread.start()
+        started = time.time()
+        gate.set()
+        for thread in threads:
+            thread.join()
+        elapsed += time.time() - started
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds the server waits per request.')
+    args = parser.parse_args()
+
+    server, store, endpoint = standin.serve(latency=args.latency)
+    drive_uuid = store.create(1024 ** 2)['uuid']
+    print('{} threads, {} rounds, {:0.0f} ms latency'.format(
+        args.threads, args.rounds, args.latency * 1000))
+    print('{:<12} {:>10} {:>10} {:>10}'.format(
+        'coalescing', 'requests', 'shared', 'seconds'))
+    try:
+        for coalesce in (False, True):
+            store.calls.clear()
+            drive = Drive(
+                api_endpoint=endpoint,
+                username='bench@example.com',
+                password='bench',
+                coalesce_gets=coalesce
+            )
+            elapsed = storm(drive, drive_uuid, args.threads, args.rounds)
+            print('{:<12} {:>10} {:>10} {:10.2f}'.format(
+                'on' if coalesce else 'off',
+                sum(store.calls.values()),
+                drive.c.single_flight.shared,
+                elapsed
+            ))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
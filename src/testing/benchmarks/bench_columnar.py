@@ -0,0 +1,90 @@
+"""
+Compares reports over a large list of servers computed by looping over the
+dicts with the vectorized aggregations of cloudsigma.columnar, and the size
+of a columnar snapshot with the size of the JSON list.
+
+Run from the src directory, for example::
+
+    python -m testing.benchmarks.bench_columnar --objects 50000
+"""
+from __future__ import division, print_function
+import argparse
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+
+from cloudsigma import columnar
+from cloudsigma.json_codec import get_json_codec
+from testing.benchmarks.bench_json import best_time, make_payload
+
+
+def loop_report(servers):
+    mem = defaultdict(int)
+    for server in servers:
+        if server['status'] == 'running':
+            mem[server['cpu']] += server['mem']
+    return mem
+
+
+def directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--objects', type=int, default=50000,
+                        help='Number of servers. Default is 50000.')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    servers = make_payload('servers', args.objects)['objects']
+    data = get_json_codec().dumps(servers)
+
+    def export():
+        return columnar.export(
+            list(servers),
+            columnar.SERVER_COLUMNS,
+            columnar.SERVER_RELATIONS,
+            name='servers',
+            release=True
+        )
+
+    snapshot = export()
+    running = snapshot['servers'].filter(
+        snapshot['servers']['status'] == 'running')
+    print('{} servers, {} running, {} drives attached'.format(
+        args.objects, len(running), len(snapshot['server_drives'])))
+    print('export        {:8.3f} s'.format(best_time(export, args.repeat)))
+    print('loop report   {:8.4f} s'.format(
+        best_time(lambda: loop_report(servers), args.repeat)))
+    running_mem = running.aggregate('cpu', 'mem', how='sum')
+    print('filter + sum  {:8.4f} s'.format(best_time(
+        lambda: snapshot['servers'].filter(
+            snapshot['servers']['status'] == 'running'
+        ).aggregate('cpu', 'mem', how='sum'),
+        args.repeat
+    )))
+    expected = loop_report(servers)
+    assert dict(zip(*[values for _, values in running_mem.columns])) == \
+        dict((cpu, float(mem)) for cpu, mem in expected.items())
+
+    print('JSON          {:8.1f} MB'.format(len(data) / 1024 ** 2))
+    path = tempfile.mkdtemp()
+    try:
+        formats = ['npz'] + (['parquet'] if columnar.pyarrow else [])
+        for format in formats:
+            target = os.path.join(path, format)
+            snapshot.write(target, format=format)
+            print('{:<13} {:8.1f} MB'.format(
+                format, directory_size(target) / 1024 ** 2))
+            assert len(columnar.Snapshot.read(target)['servers']) == \
+                args.objects
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
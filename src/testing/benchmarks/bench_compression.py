@@ -0,0 +1,166 @@
+"""
+Reports the CPU versus wire tradeoff of the upload content encodings.
+
+For every image and encoding it measures the compression ratio, the CPU
+time to compress the image on one core, and the time to upload it through
+the stand-in server at a capped bandwidth, which simulates a WAN link. Run
+from the src directory, for example::
+
+    python -m testing.benchmarks.bench_compression --size 64 --bandwidth 20
+"""
+from __future__ import division, print_function
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from cloudsigma.compression import get_codec, zstandard
+from cloudsigma.throttle import TokenBucket
+from cloudsigma.upload_engine import FileSource, UploadEngine
+from testing.benchmarks.bench_upload import file_digest, run, start_server
+
+BLOCK_SIZE = 1024 ** 2
+
+
+def sparse_block(index):
+    # a mostly empty disk: a few MB of data in every 8 MB
+    if index % 8 < 2:
+        return os.urandom(BLOCK_SIZE)
+    return b'\0' * BLOCK_SIZE
+
+
+def text_block(index):
+    words = b'cloud drive server image kernel module package config log '
+    line = b' '.join(
+        words[i:i + 6] for i in range(index % 7, len(words), 11)
+    ) + b'\n'
+    return (line * (BLOCK_SIZE // len(line) + 1))[:BLOCK_SIZE]
+
+
+def random_block(index):
+    return os.urandom(BLOCK_SIZE)
+
+
+IMAGE_KINDS = {
+    'sparse': sparse_block,
+    'text': text_block,
+    'random': random_block,
+}
+
+
+def make_image(kind, size):
+    image = tempfile.NamedTemporaryFile(suffix='.img', delete=False)
+    with image:
+        for index in range(size // BLOCK_SIZE):
+            image.write(IMAGE_KINDS[kind](index))
+    return image.name
+
+
+def measure_cpu(path, codec, chunk_size):
+    """
+    :return: tuple of the compressed size and the CPU seconds on one core
+    """
+    source = FileSource(path)
+    compressed = 0
+    cpu = 0.0
+    for offset in range(0, source.size, chunk_size):
+        data = source.read(offset, chunk_size)
+        started = time.process_time()
+        compressed += len(codec.compress(data))
+        cpu += time.process_time() - started
+    return compressed, cpu
+
+
+def parse_encoding(spec):
+    """
+    'gzip:6' -> ('gzip', 6), 'none' -> (None, None)
+    """
+    if spec == 'none':
+        return None, None
+    name, _, level = spec.partition(':')
+    return name, int(level) if level else None
+
+
+def main():
+    default_encodings = ['none', 'gzip:1', 'gzip:6']
+    if zstandard is not None:
+        default_encodings += ['zstd:1', 'zstd:3', 'zstd:9']
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=64,
+                        help='Image size in MB. Default is 64.')
+    parser.add_argument('--chunk-size', type=int, default=4,
+                        help='Chunk size in MB. Default is 4.')
+    parser.add_argument('--bandwidth', type=float, default=20,
+                        help='Upload bandwidth cap in MB/s. Default is 20.')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds the server waits per request.')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--images', nargs='+', default=sorted(IMAGE_KINDS),
+                        choices=sorted(IMAGE_KINDS))
+    parser.add_argument('--encodings', nargs='+', default=default_encodings,
+                        help='Encodings as name:level. Default is '
+                             '{}.'.format(' '.join(default_encodings)))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    chunk_size = args.chunk_size * BLOCK_SIZE
+    server, endpoint = start_server(args.latency)
+    client_kwargs = {
+        'api_endpoint': endpoint,
+        'username': 'bench@example.com',
+        'password': 'bench',
+    }
+
+    print('{} MB images in {} MB chunks, {} MB/s link, {} threads'.format(
+        args.size, args.chunk_size, args.bandwidth, args.threads))
+    print('{:<8} {:<8} {:>6} {:>8} {:>10} {:>8} {:>9} {:>9}'.format(
+        'image', 'encoding', 'ratio', 'CPU s', 'MB/s/core', 'wire MB',
+        'upload s', 'MB/s'))
+    try:
+        for kind in args.images:
+            image = make_image(kind, args.size * BLOCK_SIZE)
+            image_digest = file_digest(image)
+            try:
+                for spec in args.encodings:
+                    name, level = parse_encoding(spec)
+                    codec = get_codec(name, level)
+                    wire, cpu = args.size * BLOCK_SIZE, 0.0
+                    if codec:
+                        wire, cpu = measure_cpu(image, codec, chunk_size)
+
+                    engine = UploadEngine(
+                        FileSource(image),
+                        protocol='chunk_link',
+                        chunk_size=chunk_size,
+                        n_threads=args.threads,
+                        use_journal=False,
+                        throttle=TokenBucket(
+                            args.bandwidth * BLOCK_SIZE,
+                            burst=chunk_size
+                        ),
+                        content_encoding=codec,
+                        generic_client_kwargs=client_kwargs
+                    )
+                    elapsed, ok = run(engine, image_digest)
+                    print('{:<8} {:<8} {:6.2f} {:8.2f} {:10.1f} {:8.1f} '
+                          '{:9.2f} {:9.1f} {}'.format(
+                              kind,
+                              spec,
+                              args.size * BLOCK_SIZE / wire,
+                              cpu,
+                              args.size / cpu if cpu else float('inf'),
+                              wire / BLOCK_SIZE,
+                              elapsed,
+                              args.size / elapsed,
+                              'ok' if ok else 'DATA MISMATCH'
+                          ))
+            finally:
+                os.unlink(image)
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares starting servers of the stand-in one after the other, polling each
+until it runs, with starting, restarting and stopping them all with
+cloudsigma.fleet. Restarts confirmed sooner than the stand-in takes to
+restart a server were confirmed from the status before the restart, and are
+reported as early.
+
+The serial loop is timed on a sample of the servers and extrapolated. Run
+from the src directory, for example::
+
+    python -m testing.benchmarks.bench_fleet --servers 200 --transition 2
+"""
+from __future__ import division, print_function
+import argparse
+import time
+
+from cloudsigma.fleet import Fleet, StatusWatcher
+from cloudsigma.resource import Server
+from testing.benchmarks import standin
+
+
+def serial_start(server, uuids, poll_interval=0.5):
+    for uuid in uuids:
+        server.start(uuid)
+        while server.get(uuid)['status'] != 'running':
+            time.sleep(poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--servers', type=int, default=200)
+    parser.add_argument('--transition', type=float, default=2,
+                        help='Seconds a server takes to start or stop.')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds the server waits per request.')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='Fleet action requests per second.')
+    parser.add_argument('--serial-sample', type=int, default=5)
+    args = parser.parse_args()
+
+    server, store, endpoint = standin.serve(
+        latency=args.latency,
+        transition=args.transition
+    )
+    client_kwargs = {
+        'api_endpoint': endpoint,
+        'username': 'bench@example.com',
+        'password': 'bench',
+    }
+    uuids = [
+        store.create_server('server-{}'.format(index))['uuid']
+        for index in range(args.servers)
+    ]
+    print('{} servers, {:0.1f}s transitions, {:0.0f} ms latency'.format(
+        args.servers, args.transition, args.latency * 1000))
+    try:
+        sample = uuids[:args.serial_sample]
+        started = time.time()
+        serial_start(Server(**client_kwargs), sample)
+        elapsed = (time.time() - started) / len(sample) * len(uuids)
+        print('{:<28} {:8.1f}s (extrapolated)'.format('serial start', elapsed))
+
+        watcher = StatusWatcher(use_websocket=False, **client_kwargs)
+        with watcher:
+            fleet = Fleet(rate=args.rate, watcher=watcher, **client_kwargs)
+            for name, action, kwargs in [
+                    ('fleet start', 'start', {}),
+                    ('fleet restart', 'restart', {}),
+                    ('fleet stop, canary + waves', 'stop',
+                     {'canary': 1, 'wave_size': len(uuids) // 4 or 1})]:
+                report = fleet.run(action, uuids, **kwargs)
+                early = sum(
+                    1 for outcome in report.outcomes.values()
+                    if outcome.state == 'done' and
+                    outcome.seconds < args.transition
+                )
+                print('{:<28} {:8.1f}s {} {} early'.format(
+                    name, report.seconds, report.summary(), early))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
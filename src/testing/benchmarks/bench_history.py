@@ -0,0 +1,100 @@
+"""
+Compares fetching a month of ledger entries from the stand-in server in one
+request, in sequential seven day windows as samples/server_bill.py did, and
+with ResourceBase.list_range. Then syncs a HistoryStore, and syncs it again
+for one more day, which only fetches that day.
+
+The server waits per request and per returned object, like a real query.
+Run from the src directory, for example::
+
+    python -m testing.benchmarks.bench_history --days 30 --threads 4 8
+"""
+from __future__ import division, print_function
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from cloudsigma.history import HistoryStore
+from cloudsigma.resource import Ledger
+from testing.benchmarks.bench_upload import start_server
+
+START = datetime(2020, 1, 1)
+
+
+def one_request(ledger, start, end):
+    return ledger.list({'time__gte': start, 'time__lt': end})
+
+
+def weekly(ledger, start, end):
+    objects = []
+    window_start = start
+    while window_start < end:
+        window_end = min(window_start + timedelta(days=7), end)
+        objects.extend(ledger.list({
+            'time__gte': window_start,
+            'time__lt': window_end,
+        }))
+        window_start = window_end
+    return objects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds the server waits per request.')
+    parser.add_argument('--object-latency', type=float, default=0.0001,
+                        help='Seconds the server waits per object.')
+    parser.add_argument('--threads', type=int, nargs='+', default=[4, 8])
+    args = parser.parse_args()
+
+    server, endpoint = start_server(
+        args.latency,
+        '--object-latency',
+        str(args.object_latency),
+        '--ledger-days',
+        str(args.days)
+    )
+    ledger = Ledger(
+        api_endpoint=endpoint,
+        username='bench@example.com',
+        password='bench'
+    )
+    end = START + timedelta(days=args.days)
+    runs = [
+        ('one request', lambda: one_request(ledger, START, end)),
+        ('weekly windows', lambda: weekly(ledger, START, end)),
+    ] + [
+        ('list_range threads={}'.format(n), lambda n=n: list(
+            ledger.list_range(START, end, n_threads=n)))
+        for n in args.threads
+    ]
+    store = HistoryStore(':memory:')
+    try:
+        expected = None
+        for name, fetch in runs:
+            started = time.time()
+            objects = fetch()
+            elapsed = time.time() - started
+            ids = [obj['id'] for obj in objects]
+            if expected is None:
+                expected = ids
+            print('{:<24} {:7.2f}s {:8d} entries {}'.format(
+                name,
+                elapsed,
+                len(objects),
+                'ok' if ids == expected else 'MISMATCH'
+            ))
+        for name, sync_end in [
+                ('store first sync', end - timedelta(days=1)),
+                ('store sync of a day', end)]:
+            started = time.time()
+            added = store.sync(ledger, start=START, end=sync_end)
+            print('{:<24} {:7.2f}s {:8d} new'.format(
+                name, time.time() - started, added))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
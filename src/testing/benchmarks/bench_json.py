@@ -0,0 +1,203 @@
+"""
+Measures the JSON decoding and encoding throughput of the available codecs
+on list responses shaped like the servers, drives and ledger of a large
+account.
+
+The "requests + deepcopy" row is the previous response handling, which
+decoded with requests and copied the result. Run from the src directory,
+for example::
+
+    python -m testing.benchmarks.bench_json --objects 2000
+"""
+from __future__ import division, print_function
+import argparse
+import copy
+import random
+import time
+import uuid
+
+import requests
+
+from cloudsigma.json_codec import available_codecs, get_json_codec
+
+
+def resource_uri(resource, resource_uuid):
+    return '/api/2.0/{}/{}/'.format(resource, resource_uuid)
+
+
+def make_drive(rng):
+    drive_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+    return {
+        'uuid': drive_uuid,
+        'name': 'drive-{}'.format(rng.randint(0, 10 ** 6)),
+        'size': rng.choice([10, 20, 50, 100]) * 1024 ** 3,
+        'status': rng.choice(['mounted', 'unmounted']),
+        'media': 'disk',
+        'storage_type': rng.choice(['dssd', 'magnetic']),
+        'allow_multimount': False,
+        'affinities': [],
+        'jobs': [],
+        'licenses': [],
+        'meta': {'description': 'Ubuntu 18.04 with some tools', 'arch': '64'},
+        'mounted_on': [{
+            'uuid': str(uuid.UUID(int=rng.getrandbits(128))),
+            'resource_uri': resource_uri('servers', drive_uuid),
+        }],
+        'owner': {
+            'uuid': '6f7a1c3e-4e2b-4d8a-9c1f-2a3b4c5d6e7f',
+            'resource_uri': resource_uri(
+                'user', '6f7a1c3e-4e2b-4d8a-9c1f-2a3b4c5d6e7f'),
+        },
+        'resource_uri': resource_uri('drives', drive_uuid),
+        'runtime': {
+            'snapshots_allocated_size': 0,
+            'storage_type': 'dssd',
+        },
+        'tags': [],
+        'grantees': [],
+    }
+
+
+def make_server(rng):
+    server_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+    return {
+        'uuid': server_uuid,
+        'name': 'server-{}'.format(rng.randint(0, 10 ** 6)),
+        'cpu': rng.choice([1000, 2000, 4000, 8000]),
+        'mem': rng.choice([1, 2, 4, 8]) * 1024 ** 3,
+        'smp': rng.randint(1, 8),
+        'status': rng.choice(['running', 'stopped']),
+        'vnc_password': 'secret',
+        'cpu_type': 'amd',
+        'cpus_instead_of_cores': False,
+        'enable_numa': False,
+        'hv_relaxed': False,
+        'hv_tsc': False,
+        'auto_start': False,
+        'context': True,
+        'meta': {'description': 'web node', 'ssh_public_key': 'ssh-rsa ' +
+                 'A' * 372},
+        'drives': [
+            {
+                'boot_order': index + 1,
+                'dev_channel': '0:{}'.format(index),
+                'device': 'virtio',
+                'drive': {
+                    'uuid': str(uuid.UUID(int=rng.getrandbits(128))),
+                    'resource_uri': resource_uri('drives', server_uuid),
+                },
+            }
+            for index in range(rng.randint(1, 3))
+        ],
+        'nics': [
+            {
+                'boot_order': None,
+                'firewall_policy': None,
+                'ip_v4_conf': {'conf': 'dhcp', 'ip': None},
+                'ip_v6_conf': None,
+                'mac': '22:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}'.format(
+                    *[rng.randint(0, 255) for _ in range(5)]),
+                'model': 'virtio',
+                'runtime': {
+                    'interface_type': 'public',
+                    'io': {'bytes_recv': rng.getrandbits(40),
+                           'bytes_sent': rng.getrandbits(40),
+                           'packets_recv': rng.getrandbits(30),
+                           'packets_sent': rng.getrandbits(30)},
+                    'ip_v4': {
+                        'uuid': '185.12.{}.{}'.format(
+                            rng.randint(0, 255), rng.randint(0, 255)),
+                    },
+                    'ip_v6': None,
+                },
+                'vlan': None,
+            }
+        ],
+        'owner': {
+            'uuid': '6f7a1c3e-4e2b-4d8a-9c1f-2a3b4c5d6e7f',
+            'resource_uri': resource_uri(
+                'user', '6f7a1c3e-4e2b-4d8a-9c1f-2a3b4c5d6e7f'),
+        },
+        'requirements': [],
+        'resource_uri': resource_uri('servers', server_uuid),
+        'runtime': {'active_since': '2020-01-01T00:00:00+00:00',
+                    'nics': []},
+        'tags': [],
+    }
+
+
+def make_ledger(rng):
+    return {
+        'amount': '{:.8f}'.format(rng.random() * 10),
+        'billing_cycle': rng.randint(1, 10 ** 6),
+        'end_time': '2020-02-01T{:02d}:00:00+00:00'.format(rng.randint(0, 23)),
+        'id': str(rng.randint(0, 10 ** 9)),
+        'interval': 300,
+        'reason': 'Burst: cpu of {} for 300 seconds'.format(
+            rng.randint(100, 10000)),
+        'resource_uri': resource_uri('ledger', rng.randint(0, 10 ** 9)),
+        'start_time': '2020-02-01T{:02d}:00:00+00:00'.format(
+            rng.randint(0, 23)),
+        'time': '2020-02-01T00:05:00+00:00',
+    }
+
+
+FIXTURES = {
+    'servers': make_server,
+    'drives': make_drive,
+    'ledger': make_ledger,
+}
+
+
+def make_payload(kind, n_objects, seed=0):
+    rng = random.Random(seed)
+    return {
+        'meta': {'limit': 0, 'offset': 0, 'total_count': n_objects},
+        'objects': [FIXTURES[kind](rng) for _ in range(n_objects)],
+    }
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.time()
+        function()
+        times.append(time.time() - started)
+    return min(times)
+
+
+def requests_deepcopy(data):
+    response = requests.models.Response()
+    response._content = data
+    response.encoding = 'utf-8'
+    return lambda: copy.deepcopy(response.json())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--objects', type=int, default=2000,
+                        help='Objects per list response. Default is 2000.')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    codecs = [get_json_codec(name) for name in available_codecs()]
+    print('{:<8} {:<22} {:>8} {:>12} {:>12}'.format(
+        'payload', 'codec', 'MB', 'decode MB/s', 'encode MB/s'))
+    for kind in sorted(FIXTURES):
+        payload = make_payload(kind, args.objects)
+        data = get_json_codec('simplejson').dumps(payload)
+        size = len(data) / 1024 ** 2
+
+        elapsed = best_time(requests_deepcopy(data), args.repeat)
+        print('{:<8} {:<22} {:8.1f} {:12.1f} {:>12}'.format(
+            kind, 'requests + deepcopy', size, size / elapsed, '-'))
+        for codec in codecs:
+            assert codec.loads(data) == payload
+            decode = best_time(lambda: codec.loads(data), args.repeat)
+            encode = best_time(lambda: codec.dumps(payload), args.repeat)
+            print('{:<8} {:<22} {:8.1f} {:12.1f} {:12.1f}'.format(
+                kind, codec.name, size, size / decode, size / encode))
+
+
+if __name__ == '__main__':
+    main()
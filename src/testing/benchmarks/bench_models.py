@@ -0,0 +1,110 @@
+"""
+Compares plain dicts with the compact models of cloudsigma.models on a
+large list of servers: memory held, time to decode the response and time
+to access fields.
+
+The schema of the models is inferred from the generated servers the way the
+API describes its fields. Run from the src directory, for example::
+
+    python -m testing.benchmarks.bench_models --objects 20000
+"""
+from __future__ import division, print_function
+import argparse
+import gc
+import time
+import timeit
+import tracemalloc
+
+from cloudsigma.json_codec import get_json_codec
+from cloudsigma.models import model_from_schema, to_models
+from testing.benchmarks.bench_json import make_payload
+
+SCHEMA_TYPES = {
+    dict: 'dict',
+    list: 'list',
+    bool: 'boolean',
+    int: 'integer',
+    float: 'float',
+    str: 'string',
+    type(None): 'string',
+}
+
+
+def infer_schema(obj):
+    return {
+        'fields': dict(
+            (key, {'type': SCHEMA_TYPES[type(value)]})
+            for key, value in obj.items()
+        ),
+    }
+
+
+def measure(function):
+    """
+    :return: tuple of the result, seconds taken and MB allocated by it
+    """
+    gc.collect()
+    tracemalloc.start()
+    started = time.time()
+    result = function()
+    elapsed = time.time() - started
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, elapsed, allocated / 1024 ** 2
+
+
+def access_time(function, number=100000):
+    """
+    :return: nanoseconds per call
+    """
+    return min(timeit.repeat(function, number=number, repeat=3)) \
+        / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--objects', type=int, default=20000,
+                        help='Number of servers. Default is 20000.')
+    parser.add_argument('--codec', default=None,
+                        help='JSON codec. Default is the fastest available.')
+    args = parser.parse_args()
+
+    codec = get_json_codec(args.codec)
+    payload = make_payload('servers', args.objects)
+    data = codec.dumps(payload)
+    model = model_from_schema('Server', infer_schema(payload['objects'][0]))
+    del payload
+
+    variants = [
+        ('dicts', lambda: codec.loads(data)['objects']),
+        ('models', lambda: to_models(model, codec.loads(data)['objects'])),
+        ('compact models', lambda: to_models(
+            model, codec.loads(data)['objects'], compact=True)),
+    ]
+    print('{} servers, {:0.1f} MB of JSON, {} codec'.format(
+        args.objects, len(data) / 1024 ** 2, codec.name))
+    print('{:<16} {:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+        'variant', 'MB held', 'decode s', 'field ns', 'nested ns',
+        'B/object'))
+    for name, decode in variants:
+        servers, elapsed, allocated = measure(decode)
+        server = servers[-1]
+        if name == 'dicts':
+            field = access_time(lambda: server['cpu'])
+            nested = access_time(lambda: server['nics'][0]['mac'])
+        else:
+            field = access_time(lambda: server.cpu)
+            nested = access_time(lambda: server.nics[0].mac)
+        print('{:<16} {:10.1f} {:10.3f} {:12.0f} {:12.0f} {:12.0f}'.format(
+            name,
+            allocated,
+            elapsed,
+            field,
+            nested,
+            allocated * 1024 ** 2 / len(servers)
+        ))
+        servers = server = None
+
+
+if __name__ == '__main__':
+    main()
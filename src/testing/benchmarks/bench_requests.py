@@ -0,0 +1,151 @@
+"""
+Measures the client side overhead of preparing API requests.
+
+The URL resolution, request preparation and log hook are timed in a loop
+without any I/O, and a loop of small GETs runs against the stand-in server
+to show the share of the overhead in a whole request. Run from the src
+directory, for example::
+
+    python -m testing.benchmarks.bench_requests --number 20000
+"""
+from __future__ import division, print_function
+import argparse
+import logging
+import timeit
+
+import requests
+
+from cloudsigma.generic import GenericClient, format_exchange, \
+    wrap_with_log_hook
+from cloudsigma.resource import Drive
+from testing.benchmarks.bench_upload import start_server
+
+URLS = [
+    '/drives/',
+    '/drives/detail/',
+    '/servers/1b4c7e3d-3c2a-4a59-b6a2-0a4e6b5f2f11/',
+    '/api/2.0/libdrives/',
+]
+
+
+def per_call(function, number):
+    """
+    :return: microseconds per call, the best of three runs
+    """
+    return min(timeit.repeat(function, number=number, repeat=3)) \
+        / number * 1e6
+
+
+def bench_urls(client, number):
+    def cached():
+        for url in URLS:
+            client._get_full_url(url)
+
+    def uncached():
+        for url in URLS:
+            client.api_endpoint = client.api_endpoint
+            client._get_full_url(url)
+
+    return [
+        ('full url, cached', per_call(cached, number) / len(URLS)),
+        ('full url, uncached', per_call(uncached, number) / len(URLS)),
+    ]
+
+
+def bench_prepare(client, number):
+    def prepare():
+        kwargs = client._get_req_args(query_params={'limit': 0})
+        requests.Request(
+            'GET',
+            client._get_full_url('/drives/'),
+            **kwargs
+        ).prepare()
+
+    def req_args():
+        client._get_req_args(query_params={'limit': 0})
+
+    return [
+        ('request args', per_call(req_args, number)),
+        ('prepared request', per_call(prepare, number)),
+    ]
+
+
+def bench_log_hook(client, number):
+    """
+    Times the debug log hook on a response with a 64KB body while the
+    logger is disabled for the level, against formatting the log record.
+    """
+    response = requests.models.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.headers['Content-Type'] = 'application/json'
+    response._content = b'{"objects": []}'.ljust(64 * 1024)
+    response.request = requests.Request(
+        'PUT',
+        client._get_full_url('/drives/'),
+        data=response._content,
+        **client._get_req_args()
+    ).prepare()
+
+    hook = wrap_with_log_hook('DEBUG')
+    logging.getLogger('cloudsigma.generic').setLevel(logging.INFO)
+    return [
+        ('log hook, disabled', per_call(lambda: hook(response), number)),
+        ('log record formatting',
+         per_call(lambda: format_exchange(response), number)),
+    ]
+
+
+def bench_gets(client_kwargs, number):
+    drive = Drive(**client_kwargs)
+    drive_uuid = requests.post(
+        drive.c._get_full_url('/initupload/'),
+        json={'size': 1024 ** 2}
+    ).json()['objects'][0]['uuid']
+    drive.get(drive_uuid)
+
+    def get():
+        drive.get(drive_uuid)
+
+    return [('small GET, stand-in', per_call(get, number))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--number', type=int, default=20000,
+                        help='Calls per timed loop. Default is 20000.')
+    parser.add_argument('--gets', type=int, default=500,
+                        help='Requests of the GET loop. Default is 500, 0 '
+                             'skips it.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    client = GenericClient(
+        api_endpoint='https://zrh.cloudsigma.com/api/2.0/',
+        username='bench@example.com',
+        password='bench'
+    )
+    results = bench_urls(client, args.number)
+    results += bench_prepare(client, args.number // 10)
+    results += bench_log_hook(client, args.number // 10)
+    if args.gets:
+        server, endpoint = start_server(0)
+        try:
+            results += bench_gets(
+                {
+                    'api_endpoint': endpoint,
+                    'username': 'bench@example.com',
+                    'password': 'bench',
+                },
+                args.gets
+            )
+        finally:
+            server.terminate()
+
+    print('{:<24} {:>12}'.format('operation', 'us per call'))
+    for name, micros in results:
+        print('{:<24} {:12.2f}'.format(name, micros))
+
+
+if __name__ == '__main__':
+    main()
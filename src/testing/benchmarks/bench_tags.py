@@ -0,0 +1,107 @@
+"""
+Compares resolving tags of the stand-in into the details of their servers
+and drives with the per tag helpers of Tags, with
+cloudsigma.tagindex.TagIndex.
+
+The server waits per request and per returned object, like a real query.
+Run from the src directory, for example::
+
+    python -m testing.benchmarks.bench_tags --tags 60 --resolve 30
+"""
+from __future__ import division, print_function
+import argparse
+import time
+
+from cloudsigma.resource import Tags
+from cloudsigma.tagindex import TagIndex
+from testing.benchmarks import standin
+
+
+def per_tag(client_kwargs, tags):
+    client = Tags(**client_kwargs)
+    resolved = {'servers': {}, 'drives': {}}
+    for tag in tags:
+        for server in client.servers(tag):
+            resolved['servers'][server['uuid']] = server
+        for drive in client.drives(tag):
+            resolved['drives'][drive['uuid']] = drive
+    return resolved
+
+
+def indexed(client_kwargs, tags, fields):
+    index = TagIndex(**client_kwargs)
+    fetched = index.fetch(tags, ['servers', 'drives'], fields=fields)
+    return dict(
+        (type_, dict((obj['uuid'], obj) for obj in objects))
+        for type_, objects in fetched.items()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tags', type=int, default=60)
+    parser.add_argument('--servers-per-tag', type=int, default=20)
+    parser.add_argument('--resolve', type=int, default=30,
+                        help='Number of tags resolved.')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds the server waits per request.')
+    parser.add_argument('--object-latency', type=float, default=0.0001,
+                        help='Seconds the server waits per object.')
+    args = parser.parse_args()
+
+    server, store, endpoint = standin.serve(
+        latency=args.latency,
+        object_latency=args.object_latency
+    )
+    client_kwargs = {
+        'api_endpoint': endpoint,
+        'username': 'bench@example.com',
+        'password': 'bench',
+    }
+    tags = []
+    for index in range(args.tags):
+        tagged = []
+        for number in range(args.servers_per_tag):
+            drive = store.create(1024, 'drive-{}-{}'.format(index, number))
+            tagged.append(('drives', drive['uuid']))
+            tagged.append(('servers', store.create_server(
+                'server-{}-{}'.format(index, number),
+                drives=[drive['uuid']]
+            )['uuid']))
+        tags.append(store.create_tag('tag-{}'.format(index), tagged)['uuid'])
+    print('{} tags of {} servers and drives, {:0.0f} ms latency'.format(
+        args.tags, args.servers_per_tag, args.latency * 1000))
+    try:
+        expected = None
+        for name, resolve in [
+                ('per tag helpers', lambda: per_tag(
+                    client_kwargs, tags[:args.resolve])),
+                ('tag index', lambda: indexed(
+                    client_kwargs, tags[:args.resolve],
+                    ['uuid', 'name', 'status'])),
+                ('tag index, by name', lambda: indexed(
+                    client_kwargs,
+                    ['tag-{}'.format(index) for index in range(args.resolve)],
+                    ['uuid', 'name', 'status']))]:
+            store.calls.clear()
+            started = time.time()
+            resolved = resolve()
+            elapsed = time.time() - started
+            uuids = dict(
+                (type_, set(objects)) for type_, objects in resolved.items()
+            )
+            if expected is None:
+                expected = uuids
+            print('{:<20} {:7.2f}s {:4d} requests {:6d} objects {}'.format(
+                name,
+                elapsed,
+                sum(store.calls.values()),
+                sum(len(objects) for objects in resolved.values()),
+                'ok' if uuids == expected else 'MISMATCH'
+            ))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Compares tearing down environments of the stand-in one server after the
+other, polling every step like the cleanup of the acceptance tests, with
+cloudsigma.teardown.
+
+Every environment has a server, half of them running, with a boot and a data
+drive, a snapshot of the data drive and a tag on all of them. The serial
+teardown is timed on a sample of the environments and extrapolated. Run from
+the src directory, for example::
+
+    python -m testing.benchmarks.bench_teardown --environments 50
+"""
+from __future__ import division, print_function
+import argparse
+import time
+
+from cloudsigma import errors
+from cloudsigma.resource import Drive, Server, Snapshot, Tags
+from cloudsigma.teardown import Teardown
+from testing.benchmarks import standin
+
+
+def create_environment(store, index):
+    boot = store.create(1024, 'boot-{}'.format(index))['uuid']
+    data = store.create(1024, 'data-{}'.format(index))['uuid']
+    server = store.create_server(
+        'server-{}'.format(index),
+        'running' if index % 2 else 'stopped',
+        [boot, data]
+    )['uuid']
+    snapshot = store.create_snapshot(data)['uuid']
+    tag = store.create_tag('env-{}'.format(index), [
+        ('servers', server),
+        ('drives', boot),
+        ('drives', data),
+        ('snapshots', snapshot),
+    ])['uuid']
+    return {
+        'servers': [server],
+        'drives': [boot, data],
+        'snapshots': [snapshot],
+        'tags': [tag],
+    }
+
+
+def wait_deleted(client, uuid, poll_interval):
+    while True:
+        try:
+            client.get(uuid)
+        except errors.ClientError as exc:
+            if exc.status_code == 404:
+                return
+            raise
+        time.sleep(poll_interval)
+
+
+def serial_teardown(client_kwargs, environment, poll_interval=0.5):
+    server, drive = Server(**client_kwargs), Drive(**client_kwargs)
+    for uuid in environment['servers']:
+        if server.get(uuid)['status'] != 'stopped':
+            server.stop(uuid)
+            while server.get(uuid)['status'] != 'stopped':
+                time.sleep(poll_interval)
+        server.delete(uuid)
+        wait_deleted(server, uuid, poll_interval)
+    for uuid in environment['snapshots']:
+        Snapshot(**client_kwargs).delete(uuid)
+    for uuid in environment['drives']:
+        drive.delete(uuid)
+        wait_deleted(drive, uuid, poll_interval)
+    for uuid in environment['tags']:
+        Tags(**client_kwargs).delete(uuid)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--environments', type=int, default=50)
+    parser.add_argument('--transition', type=float, default=1,
+                        help='Seconds a server takes to stop, and servers '
+                             'and drives take to be deleted.')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds the server waits per request.')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--serial-sample', type=int, default=4)
+    args = parser.parse_args()
+
+    server, store, endpoint = standin.serve(
+        latency=args.latency,
+        transition=args.transition
+    )
+    client_kwargs = {
+        'api_endpoint': endpoint,
+        'username': 'bench@example.com',
+        'password': 'bench',
+    }
+    environments = [
+        create_environment(store, index)
+        for index in range(args.environments + args.serial_sample)
+    ]
+    sample = environments[args.environments:]
+    environments = environments[:args.environments]
+    print('{} environments, {:0.1f}s transitions, {:0.0f} ms latency'.format(
+        args.environments, args.transition, args.latency * 1000))
+    try:
+        started = time.time()
+        for environment in sample:
+            serial_teardown(client_kwargs, environment)
+        elapsed = (time.time() - started) / len(sample) * len(environments)
+        print('{:<24} {:8.1f}s (extrapolated)'.format(
+            'serial teardown', elapsed))
+
+        started = time.time()
+        teardown = Teardown(
+            servers=[uuid for env in environments for uuid in env['servers']],
+            snapshots=[
+                uuid for env in environments for uuid in env['snapshots']
+            ],
+            tags=[uuid for env in environments for uuid in env['tags']],
+            n_threads=args.threads,
+            **client_kwargs
+        )
+        result = teardown.run()
+        print('{:<24} {:8.1f}s {} steps, {} failed, {} skipped'.format(
+            'teardown',
+            time.time() - started,
+            len(result.succeeded),
+            len(result.failed),
+            len(result.skipped)
+        ))
+        print('left: {} servers, {} drives, {} snapshots, {} tags'.format(
+            len(store.servers),
+            len(store.drives),
+            len(store.snapshots),
+            len(store.tags)
+        ))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
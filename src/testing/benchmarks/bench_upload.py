@@ -0,0 +1,142 @@
+"""
+Compares the threaded and the asyncio upload paths against the stand-in
+server.
+
+The server runs in a separate process, so that it does not compete with the
+client for the GIL. Run from the src directory, for example::
+
+    python -m testing.benchmarks.bench_upload --size 256 --latency 0.02
+"""
+from __future__ import division, print_function
+import argparse
+import logging
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from cloudsigma.upload_engine import FileSource, UploadEngine
+
+try:
+    from cloudsigma.async_upload import AsyncUploadEngine, aiohttp
+except (ImportError, SyntaxError):
+    AsyncUploadEngine = aiohttp = None
+
+
+def make_image(size):
+    image = tempfile.NamedTemporaryFile(suffix='.img', delete=False)
+    with image:
+        block = os.urandom(1024 ** 2)
+        for _ in range(size // len(block)):
+            image.write(block)
+        image.write(block[:size % len(block)])
+    return image.name
+
+
+def start_server(latency, *args):
+    """
+    Starts the stand-in server in a subprocess.
+
+    :param args: more command line arguments of the server
+    :return: tuple of the process and the API endpoint URL
+    """
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            '-m',
+            'testing.benchmarks.standin',
+            '--latency',
+            str(latency),
+        ] + list(args),
+        stdout=subprocess.PIPE,
+        universal_newlines=True
+    )
+    return process, process.stdout.readline().strip()
+
+
+def file_digest(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run(engine, image_digest):
+    started = time.time()
+    engine.upload()
+    elapsed = time.time() - started
+    res = requests.get(engine.transport.url(
+        '/drives/{}/download/'.format(engine.drive_uuid)))
+    ok = hashlib.md5(res.content).hexdigest() == image_digest
+    return elapsed, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=128,
+                        help='Image size in MB. Default is 128.')
+    parser.add_argument('--chunk-size', type=int, default=1,
+                        help='Chunk size in MB. Default is 1.')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds the server waits per request.')
+    parser.add_argument('--protocol', default='chunk_link',
+                        choices=('chunk_link', 'resumable'))
+    parser.add_argument('--threads', type=int, nargs='+', default=[4, 16],
+                        help='Thread counts of the threaded path.')
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[4, 16, 64],
+                        help='Window sizes of the asyncio path.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    server, endpoint = start_server(args.latency)
+    image = make_image(args.size * 1024 ** 2)
+    image_digest = file_digest(image)
+    client_kwargs = {
+        'api_endpoint': endpoint,
+        'username': 'bench@example.com',
+        'password': 'bench',
+    }
+    common = {
+        'protocol': args.protocol,
+        'chunk_size': args.chunk_size * 1024 ** 2,
+        'use_journal': False,
+        'generic_client_kwargs': client_kwargs,
+    }
+
+    runs = [
+        ('threads={}'.format(n), lambda n=n: UploadEngine(
+            FileSource(image), n_threads=n, **common))
+        for n in args.threads
+    ]
+    if aiohttp is not None:
+        runs += [
+            ('asyncio in_flight={}'.format(n), lambda n=n: AsyncUploadEngine(
+                FileSource(image), max_in_flight=n, **common))
+            for n in args.in_flight
+        ]
+    else:
+        print('aiohttp is not installed, skipping the asyncio path')
+
+    print('{} MB in {} MB chunks, {} protocol, {:0.0f} ms latency'.format(
+        args.size, args.chunk_size, args.protocol, args.latency * 1000))
+    try:
+        for name, make_engine in runs:
+            elapsed, ok = run(make_engine(), image_digest)
+            print('{:<22} {:7.2f}s {:8.1f} MB/s {}'.format(
+                name,
+                elapsed,
+                args.size / elapsed,
+                'ok' if ok else 'DATA MISMATCH'
+            ))
+    finally:
+        os.unlink(image)
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
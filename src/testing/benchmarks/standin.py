@@ -0,0 +1,648 @@
+"""
+An in-memory stand-in for the drive upload and download endpoints of the
+API, for benchmarking the transfer code without a CloudSigma account.
+
+It implements just enough of the API for the upload and download engines:
+creating uploads, getting and listing drives, the drive schema, both chunk
+upload protocols and ranged downloads. It also serves a generated ledger
+and usages filtered by time, for the history fetching, and servers which
+start and stop after a delay, for the fleet actions. Servers have mounted
+drives, and with snapshots and tags they can be deleted, for the teardowns,
+listed by tag, and listed filtered by uuid and projected to some fields.
+Drive clones are placed on the least used of a few storage hosts, avoiding
+the hosts of the drives in their avoid list, for the batch clones.
+Every request can be delayed to simulate the round trip time of a real link,
+and list requests by the number of objects to simulate the query time.
+"""
+import bisect
+import cgi
+import io
+import re
+import threading
+import time
+import uuid
+from builtins import object, range, str
+from collections import Counter
+from datetime import datetime, timedelta
+
+import simplejson
+
+from cloudsigma.compression import get_codec
+from cloudsigma.timeline import EPOCH, to_microseconds
+from future import standard_library
+standard_library.install_aliases()
+from http.server import BaseHTTPRequestHandler, HTTPServer  # noqa: E402
+from socketserver import ThreadingMixIn  # noqa: E402
+from urllib.parse import parse_qsl, urlparse  # noqa: E402
+
+
+API_PATH = '/api/2.0'
+
+DRIVE_SCHEMA = {
+    'fields': {
+        'uuid': {'type': 'string', 'readonly': True},
+        'name': {'type': 'string', 'readonly': False},
+        'size': {'type': 'integer', 'readonly': False},
+        'status': {'type': 'string', 'readonly': True},
+        'resource_uri': {'type': 'string', 'readonly': True},
+    },
+}
+
+
+class DriveStore(object):
+    """
+    Drives and their data, shared by all request handlers.
+
+    :ivar calls: counter of (method, path pattern, action) of the requests
+    :ivar fail: counter of failures to inject, by a substring of the path
+    :ivar latency: seconds to wait before answering a request
+    :ivar object_latency: seconds to wait per object of a list
+    :ivar ledger: generated ledger entries, in time order
+    :ivar usages: usage entries, served filtered by poll_time
+    :ivar transition: seconds a server takes to start or stop, servers and
+        drives take to be deleted and clones take to finish
+    :ivar hosts: the storage host of every cloned drive
+    """
+
+    def __init__(self, latency=0, object_latency=0, transition=0,
+                 n_hosts=8):
+        self.lock = threading.Lock()
+        self.data = {}
+        self.drives = {}
+        self.chunks = {}
+        self.written = {}
+        self.calls = Counter()
+        self.fail = Counter()
+        self.latency = latency
+        self.object_latency = object_latency
+        self.ledger = []
+        self.ledger_times = []
+        self.usages = []
+        self.servers = {}
+        self.snapshots = {}
+        self.tags = {}
+        self.transition = transition
+        self.hosts = {}
+        self.n_hosts = n_hosts
+
+    def generate_ledger(self, days, start=datetime(2020, 1, 1)):
+        """
+        Generates burst charges every five minutes, more of them during the
+        day than at night.
+        """
+        for step in range(days * 288):
+            time = start + timedelta(minutes=5 * step)
+            n_entries = 6 if 8 <= time.hour < 20 else 1
+            for index in range(n_entries):
+                self.ledger.append({
+                    'id': str(len(self.ledger)),
+                    'amount': '0.01000000',
+                    'billing_cycle': step + 1,
+                    'interval': 300,
+                    'reason': 'Burst: 100 of cpu for 300 seconds',
+                    'resource_amount': '100',
+                    'time': time.isoformat() + '+00:00',
+                })
+                self.ledger_times.append(to_microseconds(time))
+
+    def create_server(self, name=None, status='stopped', drives=()):
+        server_uuid = str(uuid.uuid4())
+        with self.lock:
+            self.servers[server_uuid] = {
+                'uuid': server_uuid,
+                'name': name,
+                'status': status,
+                'resource_uri': '{}/servers/{}/'.format(API_PATH, server_uuid),
+                'drives': [],
+                'tags': [],
+            }
+            self._mount(server_uuid, drives)
+        return self.servers[server_uuid]
+
+    def _mount(self, server_uuid, drive_uuids):
+        # must hold self.lock
+        server = self.servers[server_uuid]
+        for drive_uuid in [attached['drive']['uuid']
+                           for attached in server['drives']]:
+            drive = self.drives[drive_uuid]
+            drive['mounted_on'] = [
+                mount for mount in drive['mounted_on']
+                if mount['uuid'] != server_uuid
+            ]
+            if not drive['mounted_on']:
+                drive['status'] = 'unmounted'
+        server['drives'] = []
+        for index, drive_uuid in enumerate(drive_uuids):
+            drive = self.drives[drive_uuid]
+            drive['mounted_on'].append(reference('servers', server_uuid))
+            drive['status'] = 'mounted'
+            server['drives'].append({
+                'boot_order': index + 1,
+                'dev_channel': '0:{}'.format(index),
+                'device': 'virtio',
+                'drive': reference('drives', drive_uuid),
+            })
+
+    def update_server(self, server_uuid, data):
+        """
+        :return: the server, or None if it is not stopped
+        """
+        with self.lock:
+            server = self.servers[server_uuid]
+            if server['status'] != 'stopped':
+                return None
+            if 'drives' in data:
+                self._mount(server_uuid, [
+                    attached['drive']['uuid'] for attached in data['drives']
+                ])
+            return dict(server)
+
+    def create_snapshot(self, drive_uuid, name=None):
+        snapshot_uuid = str(uuid.uuid4())
+        with self.lock:
+            self.snapshots[snapshot_uuid] = dict(
+                reference('snapshots', snapshot_uuid),
+                name=name,
+                status='available',
+                drive=reference('drives', drive_uuid),
+                tags=[]
+            )
+        return self.snapshots[snapshot_uuid]
+
+    def create_tag(self, name, resources):
+        """
+        :param resources: tuples of the resource name and the uuid of the
+            tagged objects
+        """
+        tag_uuid = str(uuid.uuid4())
+        with self.lock:
+            self.tags[tag_uuid] = dict(
+                reference('tags', tag_uuid),
+                name=name,
+                resources=[]
+            )
+            for resource_name, obj_uuid in resources:
+                getattr(self, resource_name)[obj_uuid]['tags'].append(
+                    reference('tags', tag_uuid)
+                )
+                self.tags[tag_uuid]['resources'].append(dict(
+                    reference(resource_name, obj_uuid),
+                    res_type=resource_name
+                ))
+        return self.tags[tag_uuid]
+
+    def delete(self, resource_name, obj_uuid):
+        """
+        Deletes servers and drives after the transition time, and snapshots
+        and tags at once.
+
+        :return: an error message if the object cannot be deleted
+        """
+        with self.lock:
+            objects = getattr(self, resource_name)
+            obj = objects[obj_uuid]
+            if resource_name == 'servers' and obj['status'] != 'stopped':
+                return 'The server is not stopped'
+            if resource_name == 'drives' and obj['mounted_on']:
+                return 'The drive is mounted'
+            if resource_name not in ('servers', 'drives'):
+                del objects[obj_uuid]
+                return None
+            obj['status'] = 'deleting'
+
+        def finish():
+            with self.lock:
+                if resource_name == 'servers':
+                    self._mount(obj_uuid, [])
+                del objects[obj_uuid]
+
+        timer = threading.Timer(self.transition, finish)
+        timer.daemon = True
+        timer.start()
+        return None
+
+    def server_action(self, server_uuid, action):
+        """
+        :return: the server, or None if the action is not allowed in its
+            status
+        """
+        transitions = {
+            'start': ('stopped', 'starting', 'running'),
+            'stop': ('running', 'stopping', 'stopped'),
+            'shutdown': ('running', 'stopping', 'stopped'),
+            'restart': ('running', 'starting', 'running'),
+        }
+        allowed, status, final = transitions[action]
+        with self.lock:
+            server = self.servers[server_uuid]
+            if server['status'] != allowed:
+                return None
+            server['status'] = status
+
+        def finish():
+            with self.lock:
+                server['status'] = final
+
+        timer = threading.Timer(self.transition, finish)
+        timer.daemon = True
+        timer.start()
+        return server
+
+    def create(self, size, name=None):
+        drive_uuid = str(uuid.uuid4())
+        with self.lock:
+            self.data[drive_uuid] = bytearray(size)
+            self.drives[drive_uuid] = {
+                'uuid': drive_uuid,
+                'size': size,
+                'name': name,
+                'status': 'uploading',
+                'resource_uri': '{}/drives/{}/'.format(API_PATH, drive_uuid),
+                'media': 'disk',
+                'mounted_on': [],
+                'tags': [],
+            }
+            self.chunks[drive_uuid] = set()
+            self.written[drive_uuid] = 0
+        return self.drives[drive_uuid]
+
+    def clone(self, drive_uuid, name=None, avoid=()):
+        """
+        Clones a drive to the least used storage host which holds none of
+        the drives in *avoid*, or to the least used host if all do.
+        """
+        with self.lock:
+            source = self.drives[drive_uuid]
+            used = Counter(self.hosts.values())
+            avoided = set(self.hosts.get(uuid) for uuid in avoid)
+            hosts = [
+                host for host in range(self.n_hosts) if host not in avoided
+            ] or list(range(self.n_hosts))
+            host = min(hosts, key=lambda host: used[host])
+        clone = self.create(source['size'], name or source['name'])
+        with self.lock:
+            self.data[clone['uuid']][:] = self.data[drive_uuid]
+            self.hosts[clone['uuid']] = host
+            clone['status'] = 'cloning'
+
+        def finish():
+            with self.lock:
+                clone['status'] = 'unmounted'
+
+        timer = threading.Timer(self.transition, finish)
+        timer.daemon = True
+        timer.start()
+        return clone
+
+    def write(self, drive_uuid, offset, data, chunk_key):
+        with self.lock:
+            self.data[drive_uuid][offset:offset + len(data)] = data
+            self.chunks[drive_uuid].add(chunk_key)
+            self.written[drive_uuid] += len(data)
+            drive = self.drives[drive_uuid]
+            if drive['status'] == 'uploading' and \
+                    self.written[drive_uuid] >= drive['size']:
+                drive['status'] = 'unmounted'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+    def send(self, status, body=b'', content_type='application/json',
+             headers=None):
+        if isinstance(body, (dict, list)):
+            body = simplejson.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def route(self, method):
+        url = urlparse(self.path)
+        query = dict(parse_qsl(url.query))
+        pattern = re.sub(r'/\d+/', '/N/', url.path)
+        pattern = re.sub('[0-9a-f-]{36}', 'U', pattern)
+        self.store.calls[(method, pattern, query.get('do'))] += 1
+
+        if self.store.latency:
+            time.sleep(self.store.latency)
+        for part in list(self.store.fail):
+            if part in self.path and self.store.fail[part] > 0:
+                self.store.fail[part] -= 1
+                self.read_body()
+                return self.send(500, {'error': 'injected failure'})
+        try:
+            return getattr(self, 'handle_' + method.lower())(url.path, query)
+        except KeyError as exc:
+            return self.send(404, {'error': 'Not found: {}'.format(exc)})
+
+    def handle_get(self, path, query):
+        match = re.match(API_PATH + r'/drives/([^/]+)/upload/?$', path)
+        if match:
+            chunk_key = ('resumable', int(query['resumableChunkNumber']))
+            done = chunk_key in self.store.chunks[match.group(1)]
+            return self.send(200 if done else 404)
+
+        match = re.match(API_PATH + r'/drives/([^/]+)/download/?$', path)
+        if match:
+            return self.send_range(self.store.data[match.group(1)])
+
+        if re.match(API_PATH + r'/drives/schema/?$', path):
+            return self.send(200, DRIVE_SCHEMA)
+
+        if re.match(API_PATH + r'/drives/(detail/)?$', path):
+            with self.store.lock:
+                drives = list(self.store.drives.values())
+            return self.send_list(self.filter_objects(drives, query))
+
+        match = re.match(API_PATH + r'/drives/([^/]+)/?$', path)
+        if match:
+            return self.send(200, self.store.drives[match.group(1)])
+
+        if re.match(API_PATH + r'/servers/(detail/)?$', path):
+            with self.store.lock:
+                servers = [
+                    dict(server) for server in self.store.servers.values()
+                ]
+            return self.send_list(self.filter_objects(servers, query))
+
+        match = re.match(API_PATH + r'/servers/([^/]+)/?$', path)
+        if match:
+            return self.send(200, self.store.servers[match.group(1)])
+
+        match = re.match(API_PATH + r'/(snapshots|tags)/(detail/)?$', path)
+        if match:
+            with self.store.lock:
+                objects = [
+                    dict(obj)
+                    for obj in getattr(self.store, match.group(1)).values()
+                ]
+            return self.send_list(self.filter_objects(objects, query))
+
+        match = re.match(API_PATH + r'/tags/([^/]+)/([a-z]+)/?$', path)
+        if match:
+            with self.store.lock:
+                objects = getattr(self.store, match.group(2))
+                tagged = [
+                    dict(objects[tagged['uuid']])
+                    for tagged in self.store.tags[match.group(1)]['resources']
+                    if tagged['res_type'] == match.group(2)
+                ]
+            return self.send_list(tagged)
+
+        match = re.match(API_PATH + r'/(snapshots|tags)/([^/]+)/?$', path)
+        if match:
+            objects = getattr(self.store, match.group(1))
+            return self.send(200, objects[match.group(2)])
+
+        if re.match(API_PATH + r'/ledger/?$', path):
+            return self.send_list(self.filter_ledger(query))
+        if re.match(API_PATH + r'/usage/?$', path):
+            return self.send_list(self.filter_usages(query))
+        return self.send(404, {'error': path})
+
+    def handle_put(self, path, query):
+        match = re.match(API_PATH + r'/servers/([^/]+)/?$', path)
+        if match:
+            server = self.store.update_server(
+                match.group(1),
+                simplejson.loads(self.read_body())
+            )
+            if server is None:
+                return self.send(403, {'error': 'The server is not stopped'})
+            return self.send(200, server)
+        return self.send(404, {'error': path})
+
+    def handle_delete(self, path, query):
+        match = re.match(
+            API_PATH + r'/(servers|drives|snapshots|tags)/([^/]+)/?$',
+            path
+        )
+        if match:
+            error = self.store.delete(match.group(1), match.group(2))
+            if error:
+                return self.send(403, {'error': error})
+            return self.send(204)
+        return self.send(404, {'error': path})
+
+    def filter_ledger(self, query):
+        times = self.store.ledger_times
+        low, high = 0, len(times)
+        for name, value in query.items():
+            if name == 'time__gte':
+                low = bisect.bisect_left(times, to_microseconds(value))
+            elif name == 'time__gt':
+                low = bisect.bisect_right(times, to_microseconds(value))
+            elif name == 'time__lt':
+                high = bisect.bisect_left(times, to_microseconds(value))
+            elif name == 'time__lte':
+                high = bisect.bisect_right(times, to_microseconds(value))
+        return self.store.ledger[low:high]
+
+    def filter_objects(self, objects, query):
+        if query.get('uuid__in'):
+            uuids = set(query['uuid__in'].split(','))
+            objects = [obj for obj in objects if obj['uuid'] in uuids]
+        if query.get('fields'):
+            fields = query['fields'].split(',')
+            objects = [
+                dict((name, obj[name]) for name in fields if name in obj)
+                for obj in objects
+            ]
+        return objects
+
+    def filter_usages(self, query):
+        low = to_microseconds(query.get('poll_time__gte', EPOCH))
+        high = query.get('poll_time__lt')
+        high = to_microseconds(high) if high else None
+        with self.store.lock:
+            usages = list(self.store.usages)
+        return [
+            usage for usage in usages
+            if to_microseconds(usage['poll_time']) >= low and
+            (high is None or to_microseconds(usage['poll_time']) < high)
+        ]
+
+    def send_list(self, objects):
+        if self.store.object_latency:
+            time.sleep(self.store.object_latency * len(objects))
+        return self.send(200, {
+            'meta': {'limit': 0, 'offset': 0, 'total_count': len(objects)},
+            'objects': objects,
+        })
+
+    def send_range(self, data):
+        byte_range = self.headers.get('Range')
+        if not byte_range:
+            return self.send(200, bytes(data), 'application/octet-stream')
+        first, last = byte_range.split('=')[1].split('-')
+        first, last = int(first), min(int(last), len(data) - 1)
+        return self.send(
+            206,
+            bytes(data[first:last + 1]),
+            'application/octet-stream',
+            {'Content-Range': 'bytes {}-{}/{}'.format(first, last, len(data))}
+        )
+
+    def handle_post(self, path, query):
+        if re.match(API_PATH + r'/initupload/?$', path):
+            request = simplejson.loads(self.read_body())
+            drive = request.get('objects', [request])[0]
+            drive = self.store.create(int(drive['size']), drive.get('name'))
+            return self.send(201, {'objects': [drive]})
+
+        match = re.match(API_PATH + r'/drives/([^/]+)/action/?$', path)
+        if match and query.get('do') == 'upload_chunk':
+            request = simplejson.loads(self.read_body())
+            chunk_number = request['chunk_number']
+            drive_uuid = match.group(1)
+            if ('link', chunk_number) in self.store.chunks[drive_uuid]:
+                return self.send(416, {'error': 'Chunk already uploaded'})
+            return self.send(200, {
+                'link': '/upload/{}/{}/{}/'.format(
+                    drive_uuid,
+                    chunk_number,
+                    request['chunk_size']
+                )
+            })
+
+        match = re.match(API_PATH + r'/drives/([^/]+)/action/?$', path)
+        if match and query.get('do') == 'clone':
+            request = simplejson.loads(self.read_body() or b'{}')
+            clone = self.store.clone(
+                match.group(1),
+                request.get('name'),
+                [uuid for uuid in query.get('avoid', '').split(',') if uuid]
+            )
+            return self.send(202, dict(clone))
+
+        match = re.match(API_PATH + r'/servers/([^/]+)/action/?$', path)
+        if match:
+            self.read_body()
+            server = self.store.server_action(match.group(1), query['do'])
+            if server is None:
+                return self.send(403, {'error': 'Not allowed in this status'})
+            return self.send(202, dict(server))
+
+        match = re.match(r'/upload/([^/]+)/(\d+)/(\d+)/?$', path)
+        if match:
+            chunk_number = int(match.group(2))
+            data = self.read_body()
+            content_encoding = self.headers.get('Content-Encoding')
+            if content_encoding:
+                data = get_codec(content_encoding).decompress(data)
+            self.store.write(
+                match.group(1),
+                chunk_number * int(match.group(3)),
+                data,
+                ('link', chunk_number)
+            )
+            return self.send(200, {'ok': True})
+
+        match = re.match(API_PATH + r'/drives/([^/]+)/upload/?$', path)
+        if match:
+            form = cgi.FieldStorage(
+                fp=io.BytesIO(self.read_body()),
+                environ={
+                    'REQUEST_METHOD': 'POST',
+                    'CONTENT_TYPE': self.headers['Content-Type'],
+                    'CONTENT_LENGTH': self.headers['Content-Length'],
+                }
+            )
+            chunk_number = int(form.getvalue('resumableChunkNumber'))
+            chunk_size = int(form.getvalue('resumableChunkSize'))
+            data = form['file'].file.read()
+            self.store.write(
+                match.group(1),
+                (chunk_number - 1) * chunk_size,
+                data,
+                ('resumable', chunk_number)
+            )
+            return self.send(200)
+        return self.send(404, {'error': path})
+
+
+def reference(resource_name, obj_uuid):
+    return {
+        'uuid': obj_uuid,
+        'resource_uri': '{}/{}/{}/'.format(API_PATH, resource_name, obj_uuid),
+    }
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections of a parallel transfer
+    request_queue_size = 128
+
+
+def serve(port=0, latency=0, object_latency=0, ledger_days=0, transition=0):
+    """
+    Starts a stand-in server on localhost in a background thread.
+
+    :return: tuple of the server, its DriveStore and the API endpoint URL
+    """
+    store = DriveStore(
+        latency=latency,
+        object_latency=object_latency,
+        transition=transition
+    )
+    store.generate_ledger(ledger_days)
+    handler = type('Handler', (StandInHandler,), {'store': store})
+    server = StandInServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    endpoint = 'http://127.0.0.1:{}{}/'.format(
+        server.server_address[1],
+        API_PATH
+    )
+    return server, store, endpoint
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Runs a stand-in server.')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--object-latency', type=float, default=0)
+    parser.add_argument('--ledger-days', type=int, default=0)
+    args = parser.parse_args()
+
+    server, store, endpoint = serve(
+        args.port,
+        args.latency,
+        args.object_latency,
+        args.ledger_days
+    )
+    print(endpoint)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
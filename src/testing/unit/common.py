@@ -0,0 +1,36 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from testing.benchmarks import standin
+
+
+class StandInTestBase(unittest.TestCase):
+    """
+    Runs against a stand-in server of the API, see
+    :mod:`testing.benchmarks.standin`, with a temporary directory for the
+    journals and manifests.
+    """
+
+    def setUp(self):
+        super(StandInTestBase, self).setUp()
+        self.server, self.store, endpoint = standin.serve()
+        self.client_kwargs = {
+            'api_endpoint': endpoint,
+            'username': 'test@example.com',
+            'password': 'test',
+        }
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+        super(StandInTestBase, self).tearDown()
+
+    def write_image(self, data, name='image.raw'):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
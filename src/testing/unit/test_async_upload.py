@@ -0,0 +1,64 @@
+import os
+import unittest
+
+from cloudsigma.scheduler import RetryPolicy
+from cloudsigma.upload_engine import FileSource
+from testing.unit.common import StandInTestBase
+
+try:
+    from cloudsigma.async_upload import AsyncUploadEngine, aiohttp
+except (ImportError, SyntaxError):
+    AsyncUploadEngine = aiohttp = None
+
+CHUNK_SIZE = 64 * 1024
+N_CHUNKS = 4
+
+
+@unittest.skipIf(aiohttp is None, 'needs aiohttp')
+class AsyncUploadEngineTest(StandInTestBase):
+
+    def setUp(self):
+        super(AsyncUploadEngineTest, self).setUp()
+        self.image = os.urandom(N_CHUNKS * CHUNK_SIZE)
+        self.path = self.write_image(self.image)
+        self.drive_uuid = self.store.create(len(self.image))['uuid']
+
+    def upload_first_chunks(self, protocol, n_chunks):
+        first = 1 if protocol == 'resumable' else 0
+        key = 'link' if protocol == 'chunk_link' else protocol
+        for chunk in range(n_chunks):
+            offset = chunk * CHUNK_SIZE
+            self.store.write(
+                self.drive_uuid,
+                offset,
+                self.image[offset:offset + CHUNK_SIZE],
+                (key, chunk + first)
+            )
+
+    def upload(self, protocol):
+        engine = AsyncUploadEngine(
+            FileSource(self.path),
+            protocol=protocol,
+            drive_uuid=self.drive_uuid,
+            chunk_size=CHUNK_SIZE,
+            journal_dir=self.temp_dir,
+            retry_policy=RetryPolicy(max_retries=1, backoff=0.01),
+            generic_client_kwargs=self.client_kwargs
+        )
+        engine.upload()
+        return engine
+
+    def check_uploaded_chunks_are_not_read(self, protocol):
+        self.upload_first_chunks(protocol, 3)
+        engine = self.upload(protocol)
+        self.assertTrue(engine.result.ok)
+        self.assertEqual(bytes(self.store.data[self.drive_uuid]), self.image)
+        self.assertEqual(engine.sent_size, CHUNK_SIZE)
+        self.assertEqual(engine.progress.transferred, CHUNK_SIZE)
+        self.assertEqual(engine.progress.skipped, 3 * CHUNK_SIZE)
+
+    def test_resumable(self):
+        self.check_uploaded_chunks_are_not_read('resumable')
+
+    def test_chunk_link(self):
+        self.check_uploaded_chunks_are_not_read('chunk_link')
@@ -0,0 +1,79 @@
+import os
+
+from cloudsigma.delta import BlockManifest, DeltaUpload
+from cloudsigma.scheduler import FatalError, RetryPolicy, TaskError
+from cloudsigma.upload_engine import FileSource
+from testing.unit.common import StandInTestBase
+
+CHUNK_SIZE = 64 * 1024
+
+
+class DeltaUploadTest(StandInTestBase):
+
+    def upload(self, path, drive_uuid=None):
+        uploader = DeltaUpload(
+            FileSource(path),
+            drive_uuid=drive_uuid,
+            chunk_size=CHUNK_SIZE,
+            manifest_dir=self.temp_dir,
+            journal_dir=self.temp_dir,
+            retry_policy=RetryPolicy(max_retries=1, backoff=0.01),
+            generic_client_kwargs=self.client_kwargs
+        )
+        uploader.upload()
+        return uploader
+
+    def test_changed_chunk_of_finished_drive_is_refused(self):
+        image = bytearray(os.urandom(4 * CHUNK_SIZE))
+        path = self.write_image(bytes(image))
+        drive_uuid = self.upload(path).drive_uuid
+        manifest_path = BlockManifest.default_path(drive_uuid, self.temp_dir)
+        manifest = BlockManifest.load(manifest_path)
+        self.assertEqual(self.store.data[drive_uuid], image)
+
+        # the same chunk changes twice, neither change can be uploaded
+        for value in (1, 2):
+            changed = bytearray(image)
+            changed[CHUNK_SIZE:CHUNK_SIZE + 4] = bytes(bytearray([value] * 4))
+            self.write_image(bytes(changed))
+            with self.assertRaises(FatalError):
+                self.upload(path, drive_uuid)
+            self.assertEqual(self.store.data[drive_uuid], image)
+            self.assertEqual(
+                BlockManifest.load(manifest_path).hashes,
+                manifest.hashes
+            )
+
+    def test_already_uploaded_changed_chunk_fails(self):
+        old = os.urandom(4 * CHUNK_SIZE)
+        drive_uuid = self.store.create(len(old))['uuid']
+        # an interrupted upload sent the first chunk of the old image
+        self.store.write(drive_uuid, 0, old[:CHUNK_SIZE], ('link', 0))
+        old_path = self.write_image(old, 'old.raw')
+        BlockManifest.from_source(
+            FileSource(old_path),
+            CHUNK_SIZE,
+            drive_uuid=drive_uuid
+        ).save(BlockManifest.default_path(drive_uuid, self.temp_dir))
+
+        new = b'\0' * CHUNK_SIZE + old[CHUNK_SIZE:]
+        with self.assertRaises(TaskError) as context:
+            self.upload(self.write_image(new), drive_uuid)
+        failed = context.exception.result.failed
+        self.assertEqual(list(failed), [(0, 0, CHUNK_SIZE)])
+        self.assertIsInstance(failed[(0, 0, CHUNK_SIZE)], FatalError)
+        self.assertEqual(
+            BlockManifest.load(
+                BlockManifest.default_path(drive_uuid, self.temp_dir)
+            ).hashes,
+            BlockManifest.from_source(FileSource(old_path), CHUNK_SIZE).hashes
+        )
+
+    def test_new_drive_saves_the_manifest(self):
+        image = os.urandom(3 * CHUNK_SIZE)
+        uploader = self.upload(self.write_image(image))
+        self.assertEqual(bytes(self.store.data[uploader.drive_uuid]), image)
+        self.assertEqual(
+            BlockManifest.load(uploader.manifest_path).hashes,
+            uploader.manifest.hashes
+        )
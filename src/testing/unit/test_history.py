@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+from cloudsigma.history import HistoryStore
+from cloudsigma.resource import Ledger, Usage
+from testing.unit.common import StandInTestBase
+
+START = datetime(2020, 1, 1)
+
+
+class HistoryStoreTest(StandInTestBase):
+
+    def setUp(self):
+        super(HistoryStoreTest, self).setUp()
+        self.history = HistoryStore(':memory:')
+
+    def tearDown(self):
+        self.history.close()
+        super(HistoryStoreTest, self).tearDown()
+
+    def add_usages(self, steps, server_uuid='server-1'):
+        for step in steps:
+            poll_time = START + timedelta(minutes=5 * step)
+            for name in ('cpu', 'mem'):
+                self.store.usages.append({
+                    'uuid': server_uuid,
+                    'resource': name,
+                    'amount': str(step),
+                    'poll_time': poll_time.isoformat() + '+00:00',
+                })
+
+    def test_usages_of_one_object(self):
+        self.add_usages(range(10))
+        usage = Usage(**self.client_kwargs)
+        added = self.history.sync(
+            usage,
+            start=START,
+            end=START + timedelta(hours=1)
+        )
+        self.assertEqual(added, 20)
+        self.assertEqual(self.history.count(usage), 20)
+        self.assertEqual(
+            [entry['amount'] for entry in self.history.query(usage)][::2],
+            [str(step) for step in range(10)]
+        )
+
+    def test_resync_skips_stored_entries(self):
+        self.add_usages(range(10))
+        usage = Usage(**self.client_kwargs)
+        self.history.sync(usage, start=START, end=START + timedelta(hours=1))
+        # the overlap fetches the last entries again
+        self.add_usages(range(10, 14))
+        added = self.history.sync(usage, end=START + timedelta(hours=2))
+        self.assertEqual(added, 8)
+        self.assertEqual(self.history.count(usage), 28)
+
+    def test_ledger_entries_by_id(self):
+        self.store.generate_ledger(1)
+        ledger = Ledger(**self.client_kwargs)
+        end = START + timedelta(days=1)
+        self.assertEqual(
+            self.history.sync(ledger, start=START, end=end),
+            len(self.store.ledger)
+        )
+        # the overlap fetches the last entries again
+        self.assertEqual(
+            self.history.sync(ledger, end=end + timedelta(hours=1)),
+            0
+        )
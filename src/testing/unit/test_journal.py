@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudsigma.journal import ChunkJournal
+
+KEY = ('upload', 'resumable', '/images/a.raw', 1024, 0, 'drive-1', 256)
+
+
+class ChunkJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.journal_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.journal_dir)
+
+    def journal(self, key=KEY):
+        return ChunkJournal(key, journal_dir=self.journal_dir)
+
+    def test_resume(self):
+        journal = self.journal()
+        self.assertFalse(journal.exists)
+        for chunk_number in (0, 1, 5, 1):
+            journal.mark_done(chunk_number)
+        journal.close()
+
+        resumed = self.journal()
+        self.assertTrue(resumed.exists)
+        self.assertEqual(resumed.completed, frozenset([0, 1, 5]))
+        self.assertTrue(resumed.is_done(5))
+        self.assertFalse(resumed.is_done(2))
+
+    def test_other_transfer(self):
+        journal = self.journal()
+        journal.mark_done(0)
+        journal.close()
+        other = self.journal(KEY[:-1] + (512,))
+        self.assertFalse(other.exists)
+
+    def test_truncated_last_line(self):
+        journal = self.journal()
+        journal.mark_done(0)
+        journal.mark_done(1)
+        journal.close()
+        with open(journal.path, 'a') as f:
+            f.write('2')
+
+        resumed = self.journal()
+        self.assertEqual(resumed.completed, frozenset([0, 1]))
+        resumed.mark_done(3)
+        resumed.close()
+        self.assertEqual(self.journal().completed, frozenset([0, 1, 3]))
+
+    def test_header_of_other_transfer(self):
+        journal = self.journal()
+        with open(journal.path, 'w') as f:
+            f.write('["download"]\n0\n1\n')
+        self.assertFalse(self.journal().exists)
+
+    def test_discard(self):
+        journal = self.journal()
+        journal.mark_done(0)
+        journal.discard()
+        self.assertFalse(os.path.exists(journal.path))
+        self.assertFalse(self.journal().exists)
+
+    def test_for_upload_follows_the_file(self):
+        path = os.path.join(self.journal_dir, 'image.raw')
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 1024)
+        journal = ChunkJournal.for_upload(
+            path, 'drive-1', 256, 'resumable', journal_dir=self.journal_dir
+        )
+        journal.mark_done(0)
+        journal.close()
+
+        with open(path, 'ab') as f:
+            f.write(b'\0')
+        resumed = ChunkJournal.for_upload(
+            path, 'drive-1', 256, 'resumable', journal_dir=self.journal_dir
+        )
+        self.assertFalse(resumed.exists)
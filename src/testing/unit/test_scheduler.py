@@ -0,0 +1,163 @@
+import threading
+import unittest
+
+import simplejson
+
+from cloudsigma import errors
+from cloudsigma.scheduler import (FatalError, RetryPolicy, TaskError,
+                                  TaskGraph, TaskScheduler, is_fatal)
+
+FAST_RETRIES = RetryPolicy(max_retries=2, backoff=0.01, jitter=0)
+
+
+class Flaky(object):
+    """
+    Fails every item *failures* times with *exc*, then succeeds.
+    """
+
+    def __init__(self, failures, exc=IOError):
+        self.failures = failures
+        self.exc = exc
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, item):
+        with self.lock:
+            self.calls[item] = self.calls.get(item, 0) + 1
+            calls = self.calls[item]
+        if calls <= self.failures:
+            raise self.exc('failure {} of {!r}'.format(calls, item))
+
+
+class IsFatalTest(unittest.TestCase):
+
+    def test_fatal(self):
+        self.assertTrue(is_fatal(FatalError()))
+        self.assertTrue(is_fatal(errors.AuthError('denied')))
+        self.assertTrue(is_fatal(TypeError()))
+        self.assertTrue(is_fatal(ValueError('invalid size')))
+
+    def test_retryable(self):
+        self.assertFalse(is_fatal(IOError('connection reset')))
+        try:
+            simplejson.loads('{"uuid": "trunc')
+        except ValueError as e:
+            self.assertFalse(is_fatal(e))
+        else:
+            self.fail('the document decoded')
+
+
+class TaskSchedulerTest(unittest.TestCase):
+
+    def test_retries(self):
+        func = Flaky(2)
+        result = TaskScheduler(func, retry_policy=FAST_RETRIES).run(
+            range(5)
+        )
+        self.assertTrue(result.ok)
+        self.assertEqual(sorted(result.succeeded), list(range(5)))
+        self.assertEqual(result.retries, 10)
+
+    def test_retry_budget(self):
+        func = Flaky(3)
+        result = TaskScheduler(func, retry_policy=FAST_RETRIES).run([1])
+        self.assertEqual(list(result.failed), [1])
+        self.assertEqual(func.calls[1], 3)
+        self.assertRaises(TaskError, result.raise_for_failures)
+
+    def test_fatal_error_aborts(self):
+        func = Flaky(1, exc=FatalError)
+        result = TaskScheduler(
+            func,
+            n_threads=1,
+            retry_policy=FAST_RETRIES
+        ).run(range(5))
+        self.assertTrue(result.cancelled)
+        self.assertEqual(list(result.failed), [0])
+        self.assertEqual(result.retries, 0)
+        self.assertEqual(list(func.calls), [0])
+
+    def test_cancel(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def func(item):
+            started.set()
+            release.wait(5)
+
+        scheduler = TaskScheduler(func, n_threads=1)
+        scheduler.start(range(5))
+        started.wait(5)
+        scheduler.cancel()
+        release.set()
+        self.assertTrue(scheduler.wait(5))
+        self.assertTrue(scheduler.result.cancelled)
+        self.assertEqual(scheduler.result.succeeded, [0])
+
+    def test_on_success_error_is_not_retried(self):
+        func = Flaky(0)
+
+        def on_success(item):
+            raise KeyError(item)
+
+        result = TaskScheduler(
+            func,
+            n_threads=1,
+            retry_policy=FAST_RETRIES,
+            on_success=on_success
+        ).run(range(5))
+        self.assertTrue(result.cancelled)
+        self.assertEqual(result.succeeded, [0])
+        self.assertEqual(result.retries, 0)
+        self.assertEqual(func.calls, {0: 1})
+
+
+class TaskGraphTest(unittest.TestCase):
+
+    def test_runs_after_dependencies(self):
+        done = []
+        graph = TaskGraph(n_threads=4)
+        graph.add('delete', lambda: done.append('delete'), after=['stop'])
+        graph.add('stop', lambda: done.append('stop'))
+        graph.add('detach', lambda: done.append('detach'), after=['stop'])
+        result = graph.run()
+        self.assertTrue(result.ok)
+        self.assertEqual(done[0], 'stop')
+        self.assertEqual(sorted(done), ['delete', 'detach', 'stop'])
+
+    def test_retries(self):
+        flaky = Flaky(1)
+        graph = TaskGraph(retry_policy=FAST_RETRIES)
+        graph.add('a', lambda: flaky('a'))
+        graph.add('b', lambda: flaky('b'), after=['a'])
+        result = graph.run()
+        self.assertTrue(result.ok)
+        self.assertEqual(result.retries, 2)
+
+    def test_skips_dependents_of_failed_tasks(self):
+        def fail():
+            raise FatalError('stop failed')
+
+        graph = TaskGraph(retry_policy=FAST_RETRIES)
+        graph.add('stop', fail)
+        graph.add('delete', lambda: None, after=['stop'])
+        graph.add('delete_drive', lambda: None, after=['delete'])
+        graph.add('unrelated', lambda: None)
+        result = graph.run()
+        self.assertEqual(list(result.failed), ['stop'])
+        self.assertEqual(result.succeeded, ['unrelated'])
+        self.assertEqual(result.skipped, ['delete', 'delete_drive'])
+        self.assertFalse(result.cancelled)
+
+    def test_cycle(self):
+        graph = TaskGraph()
+        graph.add('a', lambda: None, after=['c'])
+        graph.add('b', lambda: None, after=['a'])
+        graph.add('c', lambda: None, after=['b'])
+        graph.add('d', lambda: None)
+        self.assertRaises(ValueError, graph.run)
+
+    def test_unknown_dependency(self):
+        graph = TaskGraph()
+        graph.add('a', lambda: None, after=['b'])
+        self.assertRaises(ValueError, graph.order)
@@ -0,0 +1,55 @@
+import unittest
+
+from cloudsigma.throttle import TokenBucket
+from cloudsigma.upload_manager import UploadManager
+from testing.unit.common import StandInTestBase
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_unlimited_bucket_can_be_limited(self):
+        bucket = TokenBucket(None)
+        self.assertEqual(bucket.reserve(1000), 0)
+        bucket.rate = 1000
+        wait = bucket.reserve(500)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.5)
+
+    def test_burst(self):
+        bucket = TokenBucket(1000, burst=100)
+        self.assertEqual(bucket.reserve(100), 0)
+        self.assertGreater(bucket.reserve(100), 0)
+
+
+class UploadManagerBandwidthTest(StandInTestBase):
+
+    def setUp(self):
+        super(UploadManagerBandwidthTest, self).setUp()
+        self.manager = UploadManager(
+            n_threads=2,
+            generic_client_kwargs=self.client_kwargs
+        )
+        self.engine = self.manager.add(self.write_image(b'\0' * 1024))
+
+    def test_limit_and_unlimit(self):
+        self.assertIsNone(self.manager.bandwidth)
+        self.assertIsNone(self.engine.throttle)
+
+        self.manager.bandwidth = 1000
+        self.assertEqual(self.manager.bandwidth, 1000)
+        self.assertIs(self.engine.throttle, self.manager.throttle)
+        self.assertEqual(self.engine.throttle.reserve(1000), 0)
+
+        self.manager.bandwidth = None
+        self.assertIsNone(self.manager.bandwidth)
+        self.assertIsNone(self.engine.throttle)
+
+        self.manager.bandwidth = 2000
+        self.assertEqual(self.manager.bandwidth, 2000)
+        self.assertIs(self.engine.throttle, self.manager.throttle)
+        self.assertEqual(self.engine.throttle.reserve(1000), 0)
+
+    def test_engines_added_later_share_the_limit(self):
+        self.manager.bandwidth = 1000
+        engine = self.manager.add(self.write_image(b'\0' * 1024, 'b.raw'))
+        self.assertIs(engine.throttle, self.manager.throttle)
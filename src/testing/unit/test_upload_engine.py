@@ -0,0 +1,88 @@
+import os
+
+from cloudsigma.scheduler import RetryPolicy, TaskError
+from cloudsigma.upload_engine import FileSource, UploadEngine
+from testing.unit.common import StandInTestBase
+
+CHUNK_SIZE = 64 * 1024
+N_CHUNKS = 4
+
+
+class UploadEngineTest(StandInTestBase):
+
+    def setUp(self):
+        super(UploadEngineTest, self).setUp()
+        self.image = os.urandom(N_CHUNKS * CHUNK_SIZE)
+        self.path = self.write_image(self.image)
+
+    def engine(self, protocol, drive_uuid=None, use_journal=True):
+        return UploadEngine(
+            FileSource(self.path),
+            protocol=protocol,
+            drive_uuid=drive_uuid,
+            chunk_size=CHUNK_SIZE,
+            n_threads=1,
+            use_journal=use_journal,
+            journal_dir=self.temp_dir,
+            retry_policy=RetryPolicy(max_retries=0),
+            generic_client_kwargs=self.client_kwargs
+        )
+
+    def chunk_posts(self, path_part):
+        return sum(
+            count for (method, pattern, _), count in self.store.calls.items()
+            if method == 'POST' and path_part in pattern
+        )
+
+    def fail_once(self, engine, path_part):
+        self.store.fail[path_part] = 1
+        with self.assertRaises(TaskError) as context:
+            engine.upload()
+        self.assertEqual(len(context.exception.result.failed), 1)
+        self.assertEqual(
+            len(context.exception.result.succeeded),
+            N_CHUNKS - 1
+        )
+
+    def test_resume_from_the_journal(self):
+        engine = self.engine('chunk_link')
+        self.fail_once(engine, '/upload/')
+        self.assertTrue(engine.journal.exists)
+
+        engine.retry()
+        self.assertTrue(engine.result.ok)
+        self.assertEqual(bytes(self.store.data[engine.drive_uuid]),
+                         self.image)
+        # the failed chunk once more, the journaled ones are skipped
+        self.assertEqual(self.chunk_posts('/upload/U/'), N_CHUNKS + 1)
+        self.assertFalse(os.path.exists(engine.journal.path))
+
+    def test_retry_probes_the_chunks_of_a_new_drive(self):
+        engine = self.engine('resumable', use_journal=False)
+        self.fail_once(engine, '/upload/')
+
+        engine.retry()
+        self.assertTrue(engine.result.ok)
+        self.assertEqual(bytes(self.store.data[engine.drive_uuid]),
+                         self.image)
+        self.assertEqual(self.chunk_posts('/upload/'), N_CHUNKS + 1)
+        self.assertEqual(engine.progress.transferred, CHUNK_SIZE)
+
+    def test_uploaded_chunks_are_not_sent_again(self):
+        drive_uuid = self.store.create(len(self.image))['uuid']
+        for chunk_number in (0, 2):
+            offset = chunk_number * CHUNK_SIZE
+            self.store.write(
+                drive_uuid,
+                offset,
+                self.image[offset:offset + CHUNK_SIZE],
+                ('link', chunk_number)
+            )
+
+        engine = self.engine('chunk_link', drive_uuid=drive_uuid)
+        engine.upload()
+        self.assertTrue(engine.result.ok)
+        self.assertEqual(bytes(self.store.data[drive_uuid]), self.image)
+        self.assertEqual(self.chunk_posts('/upload/U/'), 2)
+        self.assertEqual(engine.progress.transferred, 2 * CHUNK_SIZE)
+        self.assertEqual(engine.progress.done, len(self.image))